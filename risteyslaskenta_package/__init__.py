@@ -1,19 +1,19 @@
 import os
+from typing import TYPE_CHECKING
 
-from qgis.gui import QgisInterface
-
-from risteyslaskenta_package.qgis_plugin_tools.infrastructure.debugging import (  # noqa F401
-    setup_debugpy,
-    setup_ptvsd,
-    setup_pydevd,
-)
+# The package is also imported by the worker processes of the parallel mode, so
+# QGIS and the debugging tools are only imported when they are needed
+if TYPE_CHECKING:
+    from qgis.gui import QgisInterface
 
 debugger = os.environ.get("QGIS_PLUGIN_USE_DEBUGGER", "").lower()
 if debugger in {"debugpy", "ptvsd", "pydevd"}:
-    locals()["setup_" + debugger]()
+    from risteyslaskenta_package.qgis_plugin_tools.infrastructure import debugging
+
+    getattr(debugging, "setup_" + debugger)()
 
 
-def classFactory(iface: QgisInterface):  # noqa N802
+def classFactory(iface: "QgisInterface"):  # noqa N802
     from risteyslaskenta_package.plugin import Plugin
 
     return Plugin()
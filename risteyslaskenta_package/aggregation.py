@@ -0,0 +1,35 @@
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+# Ways to combine the traffic counts of the periods of a flow
+AGGREGATION_METHODS = ("sum", "mean", "max")
+
+
+@dataclass
+class AggregationSettings:
+    """How the traffic data rows of the same intersection and direction are
+    combined before the curves are calculated.
+
+    Data from multiple days or times has one row per period for each direction,
+    which would produce stacked curves on top of each other. With aggregation,
+    one curve is drawn per direction. If a period field is given, the counts of
+    each period are kept in the result, and the rows can be limited to the
+    periods between period_start and period_end (inclusive)."""
+
+    method: str = "sum"
+    period_field: Optional[str] = None
+    period_start: Optional[str] = None
+    period_end: Optional[str] = None
+
+
+def aggregate_counts(counts: Sequence[int], method: str) -> int:
+    """Combines the traffic counts of the periods of a flow.
+
+    The mean is rounded to whole vehicles, as the counts are integers."""
+    if method == "sum":
+        return sum(counts)
+    if method == "mean":
+        return round(sum(counts) / len(counts))
+    if method == "max":
+        return max(counts)
+    raise ValueError(f"Unknown aggregation method: {method}")
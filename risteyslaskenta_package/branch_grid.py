@@ -0,0 +1,94 @@
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from risteyslaskenta_package.intersection import (
+    Branch,
+    Flow,
+    calculate_intersection_center_point,
+)
+
+# Default distance (in map units) from the intersection center within which
+# branches are searched by proximity
+BRANCH_SEARCH_RADIUS = 100.0
+
+
+class BranchGrid:
+    """Grid index of branch locations for finding branches by proximity.
+
+    The branches are bucketed into square cells whose size is the search radius,
+    so the candidates for a search are always in the 3x3 cells around the search
+    point. The cells are sorted once with numpy, so building the index stays fast
+    for millions of branches and a search is a few binary searches."""
+
+    def __init__(
+        self, branches: Sequence[Branch], radius: float = BRANCH_SEARCH_RADIUS
+    ) -> None:
+        self.branches = list(branches)
+        self.radius = radius
+        self.coords = np.array(
+            [(branch.x, branch.y) for branch in self.branches], dtype=float
+        ).reshape(-1, 2)
+        self.branch_numbers = np.array([branch.haara for branch in self.branches])
+        keys = self._cell_keys(np.floor(self.coords / radius).astype(np.int64))
+        self.order = np.argsort(keys, kind="stable")
+        self.sorted_keys = keys[self.order]
+
+    @staticmethod
+    def _cell_keys(cells: np.ndarray) -> np.ndarray:
+        return cells[:, 0] * (1 << 32) + (cells[:, 1] & 0xFFFFFFFF)
+
+    def find(self, point: Tuple[float, float], branch_number: str) -> Optional[Branch]:
+        """Returns the branch with the given number nearest to the point, if there
+        is one within the search radius."""
+        cell_x, cell_y = np.floor(np.asarray(point) / self.radius).astype(np.int64)
+        neighbour_cells = np.array(
+            [(cell_x + dx, cell_y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)],
+            dtype=np.int64,
+        )
+        neighbour_keys = self._cell_keys(neighbour_cells)
+        starts = np.searchsorted(self.sorted_keys, neighbour_keys, side="left")
+        ends = np.searchsorted(self.sorted_keys, neighbour_keys, side="right")
+        candidates = np.concatenate(
+            [self.order[start:end] for start, end in zip(starts, ends)]
+        )
+        candidates = candidates[self.branch_numbers[candidates] == branch_number]
+        if len(candidates) == 0:
+            return None
+        offsets = self.coords[candidates] - point
+        distances = np.sqrt(offsets[:, 0] ** 2 + offsets[:, 1] ** 2)
+        nearest = np.argmin(distances)
+        if distances[nearest] > self.radius:
+            return None
+        return self.branches[candidates[nearest]]
+
+
+def add_nearby_branches(
+    flows: Sequence[Flow],
+    branches: Sequence[Branch],
+    grid: BranchGrid,
+    location: Optional[Tuple[float, float]] = None,
+) -> List[Branch]:
+    """Adds the nearest branches for the branch numbers of the flows that are
+    missing from the branches of the intersection.
+
+    The branches are searched around the intersection center. If the intersection
+    has no branches at all (e.g. its id does not match any RPH), the location of
+    the intersection is used instead, if known. The found branches usually have
+    another Piste, so the flows are matched to them by branch number only."""
+    if branches:
+        center: Optional[Tuple[float, float]] = calculate_intersection_center_point(
+            branches
+        )
+    else:
+        center = location
+    if center is None:
+        return list(branches)
+    branch_numbers = {branch.haara for branch in branches}
+    missing_numbers = {
+        branch_number for flow in flows for branch_number in flow.direction[:2]
+    } - branch_numbers
+    found_branches = [
+        grid.find(center, branch_number) for branch_number in sorted(missing_numbers)
+    ]
+    return list(branches) + [branch for branch in found_branches if branch]
@@ -0,0 +1,180 @@
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# Distances (in map units) by which the curves are moved away from the straight
+# line between the branches to minimize overlapping
+STRAIGHT_ROAD_OFFSET = 2
+INNER_CURVE_OFFSET = 6
+OUTER_CURVE_OFFSET = 10
+
+# Relative tolerance for treating the three points of a curve as a straight line
+COLLINEAR_TOLERANCE = 1e-9
+
+
+@dataclass
+class Segmentation:
+    """How the curves are converted to line strings.
+
+    Either the number of vertices of each line or the maximum distance (in map
+    units) between the curve and the line is given. If both are given, the vertex
+    count is used."""
+
+    vertex_count: Optional[int] = None
+    tolerance: Optional[float] = None
+
+
+def _lengths(vectors: np.ndarray) -> np.ndarray:
+    return np.sqrt(vectors[:, 0] ** 2 + vectors[:, 1] ** 2)
+
+
+def calculate_curve_points(
+    start_points: np.ndarray,
+    end_points: np.ndarray,
+    center_points: np.ndarray,
+    straight_roads: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Calculates the start, middle and end points of the curves for many flows at once.
+
+    The inputs are arrays of shape (n, 2) for the start and end branch locations and
+    the intersection center points, and a boolean array of shape (n,) telling which
+    flows are straight roads. A single center point (shape (2,)) is broadcast to all
+    flows, so the flows can be either of one intersection or of a whole dataset.
+    Returns the shifted start, middle and end points as (n, 2) arrays.
+
+    If the road is not straight, the middle point is moved towards the intersection
+    center to create a curve that represents a turn in an intersection. Sometimes
+    the intersection center is not in a logical place due to unusual geometry or
+    errors in data. In these cases, we revert creating the curve and make a straight
+    line.
+
+    All points are then moved perpendicular to the line between the branches to
+    minimize overlapping. Straight roads are moved a bit to the right (right hand
+    traffic). For turns, the curve is drawn at different distance from the
+    intersection center depending on the traffic direction, so that the two curves
+    of a branch pair do not overlap. If there is data from multiple days and/or
+    times, this overlapping cannot be avoided as of now."""
+    starts = np.asarray(start_points, dtype=float).reshape(-1, 2)
+    ends = np.asarray(end_points, dtype=float).reshape(-1, 2)
+    centers = np.broadcast_to(np.asarray(center_points, dtype=float), starts.shape)
+    straight = np.broadcast_to(np.asarray(straight_roads, dtype=bool), len(starts))
+
+    # Middle point, moved towards the intersection center for turns
+    straight_middles = (starts + ends) / 2
+    middles = np.where(
+        straight[:, None], straight_middles, (straight_middles + centers) / 2
+    )
+
+    # If the intersection branches/center are oddly placed, we need to make
+    # correction. If this wouldnt be done, some intersections would have large,
+    # very circular curves
+    chord_lengths = _lengths(starts - ends)
+    oddly_placed = (_lengths(middles - ends) > chord_lengths) | (
+        _lengths(middles - starts) > chord_lengths
+    )
+    middles = np.where(oddly_placed[:, None], straight_middles, middles)
+
+    # Perpendicular and normalized vector of a straight line from intersection
+    # branch to another. Flows starting and ending at the same location get nan
+    # vectors and thus nan geometries.
+    directions = ends - starts
+    perpendiculars = np.column_stack((-directions[:, 1], directions[:, 0]))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        unit_vectors = perpendiculars / _lengths(perpendiculars)[:, None]
+
+    # Make sure turns are moved away from the intersection center
+    towards_center = _lengths(starts - centers) > _lengths(
+        starts + unit_vectors - centers
+    )
+    move_vectors = np.where(
+        towards_center[:, None],
+        -OUTER_CURVE_OFFSET * unit_vectors,
+        INNER_CURVE_OFFSET * unit_vectors,
+    )
+    # Invert direction of straight roads for right hand traffic visuals
+    move_vectors = np.where(
+        straight[:, None], -STRAIGHT_ROAD_OFFSET * unit_vectors, move_vectors
+    )
+
+    return starts + move_vectors, middles + move_vectors, ends + move_vectors
+
+
+def segmentize_curves(
+    start_points: np.ndarray,
+    middle_points: np.ndarray,
+    end_points: np.ndarray,
+    segmentation: Segmentation,
+) -> List[np.ndarray]:
+    """Converts many circular arcs to line strings at once.
+
+    The arcs are given by their start, middle and end points as (n, 2) arrays, as
+    returned by calculate_curve_points. Returns a list of (k, 2) vertex arrays,
+    where k is the vertex count of the segmentation, or is calculated for each arc
+    from the tolerance and the arc radius. The lines start and end exactly at the
+    start and end points of the arcs. Arcs whose points are on a straight line
+    (straight roads) are returned as the three points as is."""
+    starts = np.asarray(start_points, dtype=float).reshape(-1, 2)
+    middles = np.asarray(middle_points, dtype=float).reshape(-1, 2)
+    ends = np.asarray(end_points, dtype=float).reshape(-1, 2)
+    if len(starts) == 0:
+        return []
+
+    # Center of the circle through the three points, relative to the start point
+    to_middles = middles - starts
+    to_ends = ends - starts
+    middle_lengths = to_middles[:, 0] ** 2 + to_middles[:, 1] ** 2
+    end_lengths = to_ends[:, 0] ** 2 + to_ends[:, 1] ** 2
+    cross = 2 * (to_middles[:, 0] * to_ends[:, 1] - to_middles[:, 1] * to_ends[:, 0])
+    degenerate = ~(np.abs(cross) > COLLINEAR_TOLERANCE * (middle_lengths + end_lengths))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        relative_centers = (
+            np.column_stack(
+                (
+                    to_ends[:, 1] * middle_lengths - to_middles[:, 1] * end_lengths,
+                    to_middles[:, 0] * end_lengths - to_ends[:, 0] * middle_lengths,
+                )
+            )
+            / cross[:, None]
+        )
+    centers = starts + relative_centers
+    radii = _lengths(relative_centers)
+
+    # The arc goes clockwise from the start point if the middle point is on the
+    # left side of the chord (negative cross) and counterclockwise otherwise
+    start_angles = np.arctan2(-relative_centers[:, 1], -relative_centers[:, 0])
+    end_angles = np.arctan2(ends[:, 1] - centers[:, 1], ends[:, 0] - centers[:, 0])
+    counterclockwise_sweeps = np.mod(end_angles - start_angles, 2 * np.pi)
+    sweeps = np.where(
+        cross > 0, counterclockwise_sweeps, counterclockwise_sweeps - 2 * np.pi
+    )
+
+    if segmentation.vertex_count is not None:
+        counts = np.full(len(starts), max(segmentation.vertex_count, 2))
+    else:
+        # The largest angle of a segment whose distance from the arc is within
+        # the tolerance
+        with np.errstate(invalid="ignore", divide="ignore"):
+            segment_angles = 2 * np.arccos(
+                np.clip(1 - segmentation.tolerance / radii, -1, 1)
+            )
+            counts = np.ceil(np.abs(sweeps) / segment_angles) + 1
+        counts = np.maximum(np.nan_to_num(counts, nan=2, posinf=2), 2).astype(int)
+    counts = np.where(degenerate, 3, counts)
+
+    # All vertices are calculated in one go and then split to lines
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    curve_indexes = np.repeat(np.arange(len(starts)), counts)
+    positions = np.arange(offsets[-1]) - offsets[curve_indexes]
+    fractions = positions / (counts[curve_indexes] - 1)
+    angles = start_angles[curve_indexes] + fractions * sweeps[curve_indexes]
+    vertices = centers[curve_indexes] + radii[curve_indexes, None] * np.column_stack(
+        (np.cos(angles), np.sin(angles))
+    )
+    straight_vertices = np.stack((starts, middles, ends), axis=1)[
+        curve_indexes, np.minimum(positions, 2)
+    ]
+    vertices = np.where(degenerate[curve_indexes, None], straight_vertices, vertices)
+    vertices[offsets[:-1]] = starts
+    vertices[offsets[1:] - 1] = ends
+    return np.split(vertices, offsets[1:-1])
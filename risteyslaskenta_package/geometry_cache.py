@@ -0,0 +1,185 @@
+import hashlib
+import os
+import sqlite3
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from risteyslaskenta_package.intersection import Branch, Flow, IntersectionCurves
+
+# Change this whenever the calculated geometries change, so that old cache
+# entries are not used anymore
+CACHE_VERSION = "2"
+
+# Seconds to wait for another run that is writing to the same cache file
+CACHE_TIMEOUT = 5.0
+
+# The stored curves are committed after this many intersections, so that other
+# runs are not locked out of the cache for long
+COMMIT_INTERVAL = 100
+
+# Matched flag and the start, middle and end point coordinates
+CacheRow = Tuple[Optional[float], ...]
+
+
+def hash_branches(branches: Sequence[Branch], branch_fallback: bool = False) -> str:
+    """Calculates a hash of the branch locations of an intersection.
+
+    The curves of an intersection depend only on its branches, the directions
+    of the flows and whether branch fallback matching is used, so a changed hash
+    means that the cached curves are outdated."""
+    content = repr((CACHE_VERSION, branch_fallback, sorted(branches)))
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class GeometryCache:
+    """On-disk cache of the curve points calculated for the intersections.
+
+    The curves are stored in an SQLite database, keyed by intersection id, flow
+    direction and the hash of the branch locations of the intersection. When
+    an intersection is loaded, entries with another branch hash are ignored and
+    they are replaced when the intersection is stored again. Remember to call
+    close to commit the last stored curves.
+
+    The same cache file can be used by several runs at once. If the cache stays
+    locked by another run for longer than the timeout, the intersections are
+    treated as not cached and their curves are not stored."""
+
+    def __init__(self, path: str, timeout: float = CACHE_TIMEOUT) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self._uncommitted_count = 0
+        try:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS curves (
+                    intersection_id TEXT NOT NULL,
+                    direction TEXT NOT NULL,
+                    branch_hash TEXT NOT NULL,
+                    matched INTEGER NOT NULL,
+                    start_x REAL, start_y REAL,
+                    middle_x REAL, middle_y REAL,
+                    end_x REAL, end_y REAL,
+                    PRIMARY KEY (intersection_id, direction)
+                )
+                """
+            )
+        except sqlite3.OperationalError:
+            # Another run is creating the table
+            pass
+
+    def load(
+        self,
+        intersection_id: str,
+        flows: Sequence[Flow],
+        branches: Sequence[Branch],
+        branch_fallback: bool = False,
+    ) -> Optional[IntersectionCurves]:
+        """Returns the cached curves of the intersection.
+
+        None is returned if the intersection has no branches, its branches have
+        changed, or any of the flow directions is missing from the cache. In these
+        cases the intersection needs to be calculated again."""
+        if not branches:
+            return None
+        branch_hash = hash_branches(branches, branch_fallback)
+        try:
+            cached: Dict[str, CacheRow] = {
+                row[0]: row[1:]
+                for row in self.connection.execute(
+                    """
+                    SELECT direction, matched,
+                        start_x, start_y, middle_x, middle_y, end_x, end_y
+                    FROM curves WHERE intersection_id = ? AND branch_hash = ?
+                    """,
+                    (intersection_id, branch_hash),
+                )
+            }
+        except sqlite3.OperationalError:
+            # The cache is locked by another run
+            return None
+        if any(flow.direction not in cached for flow in flows):
+            return None
+
+        matched_rows = [
+            row for row, flow in enumerate(flows) if cached[flow.direction][0]
+        ]
+        unmatched_rows = [
+            row for row, flow in enumerate(flows) if not cached[flow.direction][0]
+        ]
+        if not matched_rows:
+            empty = np.empty((0, 2))
+            return IntersectionCurves(
+                matched_rows, unmatched_rows, empty, empty, empty, 0, 0
+            )
+        # Coordinates of degenerate curves are nan, which SQLite stores as NULL
+        points = np.array(
+            [cached[flows[row].direction][1:] for row in matched_rows], dtype=float
+        )
+        autot_values = [flows[row].autot for row in matched_rows]
+        return IntersectionCurves(
+            matched_rows,
+            unmatched_rows,
+            points[:, 0:2],
+            points[:, 2:4],
+            points[:, 4:6],
+            max(autot_values),
+            min(autot_values),
+        )
+
+    def store(
+        self,
+        intersection_id: str,
+        flows: Sequence[Flow],
+        branches: Sequence[Branch],
+        curves: Optional[IntersectionCurves],
+        branch_fallback: bool = False,
+    ) -> None:
+        """Stores the calculated curves of the intersection.
+
+        Flows that could not be matched to branches are stored too, so that they
+        don't cause the intersection to be calculated again."""
+        if curves is None:
+            return
+        branch_hash = hash_branches(branches, branch_fallback)
+        rows: Dict[str, CacheRow] = {
+            flows[row].direction: (0,) + (None,) * 6 for row in curves.unmatched_rows
+        }
+        for row, start_point, middle_point, end_point in zip(
+            curves.matched_rows,
+            curves.start_points.tolist(),
+            curves.middle_points.tolist(),
+            curves.end_points.tolist(),
+        ):
+            rows[flows[row].direction] = (1, *start_point, *middle_point, *end_point)
+
+        try:
+            self.connection.execute(
+                "DELETE FROM curves WHERE intersection_id = ? AND branch_hash != ?",
+                (intersection_id, branch_hash),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO curves VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (intersection_id, direction, branch_hash, *row)
+                    for direction, row in rows.items()
+                ],
+            )
+        except sqlite3.OperationalError:
+            # The cache is locked by another run
+            return
+        self._uncommitted_count += 1
+        if self._uncommitted_count >= COMMIT_INTERVAL:
+            self._commit()
+
+    def _commit(self) -> None:
+        try:
+            self.connection.commit()
+        except sqlite3.OperationalError:
+            # Another run is reading the cache, the curves are committed later
+            return
+        self._uncommitted_count = 0
+
+    def close(self) -> None:
+        self._commit()
+        self.connection.close()
@@ -0,0 +1,99 @@
+import heapq
+import json
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, ContextManager, Dict, Iterator, List, Tuple
+
+# Number of slowest intersections listed in the report
+SLOWEST_INTERSECTION_COUNT = 10
+
+
+class StageTimer:
+    """Records the cumulative time and call count of each processing stage.
+
+    The stages are timed with the stage context manager. The time spent on each
+    intersection is recorded with add_intersection, and the slowest ones are
+    kept for the report. Time spent on an intersection before it is finished,
+    e.g. calculating its curves, can be recorded with add_intersection_time and
+    is added to its time. A disabled timer records nothing, so it can be passed
+    to the processing functions when no report is wanted."""
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.stage_seconds: Dict[str, float] = {}
+        self.stage_calls: Dict[str, int] = {}
+        self._slowest_intersections: List[Tuple[float, str]] = []
+        self._unfinished_seconds: Dict[str, float] = {}
+        self._start_time = time.perf_counter()
+
+    def stage(self, name: str) -> ContextManager:
+        if not self.enabled:
+            return nullcontext()
+        return self._timed_stage(name)
+
+    @contextmanager
+    def _timed_stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] = (
+                self.stage_seconds.get(name, 0.0) + time.perf_counter() - start
+            )
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+
+    def add_intersection_time(self, intersection_id: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        self._unfinished_seconds[intersection_id] = (
+            self._unfinished_seconds.get(intersection_id, 0.0) + seconds
+        )
+
+    def add_intersection(self, intersection_id: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        seconds += self._unfinished_seconds.pop(intersection_id, 0.0)
+        item = (seconds, intersection_id)
+        if len(self._slowest_intersections) < SLOWEST_INTERSECTION_COUNT:
+            heapq.heappush(self._slowest_intersections, item)
+        else:
+            heapq.heappushpop(self._slowest_intersections, item)
+
+    def report(self) -> Dict[str, Any]:
+        """Returns the recorded timings as a JSON serializable dict."""
+        return {
+            "total_seconds": time.perf_counter() - self._start_time,
+            "stages": {
+                name: {"seconds": seconds, "calls": self.stage_calls[name]}
+                for name, seconds in self.stage_seconds.items()
+            },
+            "slowest_intersections": [
+                {"id": intersection_id, "seconds": seconds}
+                for seconds, intersection_id in sorted(
+                    self._slowest_intersections, reverse=True
+                )
+            ],
+        }
+
+    def log_report(self, logger: logging.Logger) -> None:
+        report = self.report()
+        logger.info("Total processing time %.2f s", report["total_seconds"])
+        for name, stage in report["stages"].items():
+            logger.info(
+                "Stage %s: %.2f s in %d calls", name, stage["seconds"], stage["calls"]
+            )
+        for intersection in report["slowest_intersections"]:
+            logger.info(
+                "Slow intersection %s: %.3f s",
+                intersection["id"],
+                intersection["seconds"],
+            )
+
+    def write_report(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+
+# Shared timer for when the stages are not timed
+DISABLED_TIMER = StageTimer(enabled=False)
@@ -0,0 +1,332 @@
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from risteyslaskenta_package.geometry import calculate_curve_points
+from risteyslaskenta_package.instrumentation import DISABLED_TIMER, StageTimer
+
+# Largest deviation (in degrees) from opposite directions for a branch pair to
+# be a straight road
+STRAIGHT_ROAD_ANGLE_TOLERANCE = 30
+
+# The processing of a single intersection works on plain coordinate and attribute
+# data instead of QGIS features, so that it can also be run in worker processes.
+
+
+class Branch(NamedTuple):
+    """Location of an intersection branch (a feature of the points layer)."""
+
+    piste: str
+    haara: str
+    x: float
+    y: float
+
+
+class Flow(NamedTuple):
+    """Traffic amount from one intersection branch to another (a feature of the
+    data layer)."""
+
+    data_id: str
+    direction: str
+    autot: int
+
+
+class IntersectionCurves(NamedTuple):
+    """The curve points calculated for the flows of an intersection.
+
+    The flows are referred to by their index in the list of flows of the
+    intersection. The points are (n, 2) arrays in the order of matched_rows."""
+
+    matched_rows: List[int]
+    unmatched_rows: List[int]
+    start_points: np.ndarray
+    middle_points: np.ndarray
+    end_points: np.ndarray
+    autot_max: int
+    autot_min: int
+
+
+def calculate_intersection_center_point(
+    branches: Sequence[Branch],
+) -> Tuple[float, float]:
+    """Calculates the intersection center point based on location of intersection
+    branches.
+
+    Intersection center point is used in creating the curve geometries by shifting the
+    curve middle point towards intersection center. Duplicate branch locations are not
+    counted, so only unique points count."""
+    x_coords = set(branch.x for branch in branches)
+    y_coords = set(branch.y for branch in branches)
+    intersection_center_point = sum(x_coords) / len(x_coords), sum(y_coords) / len(
+        y_coords
+    )
+    return intersection_center_point
+
+
+class BranchPoints:
+    """Branch location points of an intersection keyed by (Piste, Haara).
+
+    Building this once per intersection lets each flow find its start and end
+    branch with dictionary lookups instead of scanning all branches. If there are
+    duplicate branch locations, the first one is used."""
+
+    def __init__(self, branches: Sequence[Branch]) -> None:
+        self.points: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self.branch_number_points: Dict[str, List[Tuple[float, float]]] = {}
+        for branch in branches:
+            key = (branch.piste, branch.haara)
+            if key not in self.points:
+                self.points[key] = (branch.x, branch.y)
+            self.branch_number_points.setdefault(branch.haara, []).append(
+                (branch.x, branch.y)
+            )
+        # Piste is matched to the end of the data feature id, so we need to know
+        # the lengths of the suffixes to look up
+        self.piste_lengths = sorted({len(piste) for piste, _ in self.points})
+
+    def find(self, data_id: str, branch: str) -> Optional[Tuple[float, float]]:
+        for length in self.piste_lengths:
+            point = self.points.get((data_id[-length:], branch))
+            if point is not None:
+                return point
+        return None
+
+    def find_nearest(
+        self, branch: str, center_point: Tuple[float, float]
+    ) -> Optional[Tuple[float, float]]:
+        """Finds the branch location by branch number only, regardless of Piste.
+
+        If the intersection has several branches with the number, the one nearest
+        to the intersection center is used."""
+        points = self.branch_number_points.get(branch)
+        if not points:
+            return None
+        center_x, center_y = center_point
+        return min(
+            points,
+            key=lambda point: (point[0] - center_x) ** 2 + (point[1] - center_y) ** 2,
+        )
+
+
+def find_start_and_end_points(
+    flow: Flow,
+    branch_points: BranchPoints,
+    center_point: Optional[Tuple[float, float]] = None,
+) -> Tuple[Optional[Tuple[float, float]], Optional[Tuple[float, float]]]:
+    """Tries to find matching branch location points for a flow.
+
+    The location points are used as start and end points to draw the visualization
+    curve on map. If no matches are found, None-types are returned and this flow
+    cannot be visualized. This is also the case for flows that start and end at
+    the same branch.
+
+    If the intersection center point is given, branches whose Piste does not match
+    the flow are found by branch number, nearest to the center."""
+    direction = flow.direction
+    if len(direction) < 2 or direction[0] == direction[1]:
+        return None, None
+    start_point = branch_points.find(flow.data_id, direction[0])
+    end_point = branch_points.find(flow.data_id, direction[1])
+    if center_point is not None:
+        start_point = start_point or branch_points.find_nearest(
+            direction[0], center_point
+        )
+        end_point = end_point or branch_points.find_nearest(direction[1], center_point)
+    return start_point, end_point
+
+
+class IntersectionTopology:
+    """Branch layout of an intersection, calculated once per intersection.
+
+    The bearing of each branch number is the direction from the intersection
+    center to the (mean) location of its branches. A branch pair is a straight
+    road if the bearings point in nearly opposite directions and the branches
+    are the most opposite ones for each other. This works for any number of
+    branches, e.g. the through road of a T-intersection is found too."""
+
+    def __init__(
+        self, branches: Sequence[Branch], center_point: Tuple[float, float]
+    ) -> None:
+        self.branch_numbers = sorted({branch.haara for branch in branches})
+        self.branch_count = len(self.branch_numbers)
+        self.indexes = {number: i for i, number in enumerate(self.branch_numbers)}
+        coords = np.array([(branch.x, branch.y) for branch in branches])
+        number_indexes = np.array([self.indexes[branch.haara] for branch in branches])
+        locations = np.zeros((self.branch_count, 2))
+        np.add.at(locations, number_indexes, coords)
+        locations /= np.bincount(number_indexes, minlength=self.branch_count)[:, None]
+        offsets = locations - np.asarray(center_point)
+        self.bearings = np.arctan2(offsets[:, 1], offsets[:, 0])
+
+        # Deviation of each branch pair from opposite directions, in radians
+        angles = np.abs(
+            np.mod(self.bearings[:, None] - self.bearings[None, :] + np.pi, 2 * np.pi)
+            - np.pi
+        )
+        deviations = np.pi - angles
+        np.fill_diagonal(deviations, np.inf)
+        most_opposite = np.argmin(deviations, axis=1)
+        self.straight_roads = (
+            (deviations <= np.radians(STRAIGHT_ROAD_ANGLE_TOLERANCE))
+            & (most_opposite[:, None] == np.arange(self.branch_count)[None, :])
+            & (most_opposite[None, :] == np.arange(self.branch_count)[:, None])
+        )
+
+    def are_straight_roads(self, flows: Sequence[Flow]) -> np.ndarray:
+        """Returns a boolean array telling which of the flows are straight roads.
+
+        The flows must start and end at branches of the intersection."""
+        start_indexes = [self.indexes[flow.direction[0]] for flow in flows]
+        end_indexes = [self.indexes[flow.direction[1]] for flow in flows]
+        return self.straight_roads[start_indexes, end_indexes]
+
+
+def compute_intersection(
+    flows: Sequence[Flow],
+    branches: Sequence[Branch],
+    timer: StageTimer = DISABLED_TIMER,
+    branch_fallback: bool = False,
+) -> Optional[IntersectionCurves]:
+    """Calculates the curves for all flows of an intersection.
+
+    The steps:
+    1. Check if we found any branches
+    2. Find intersection center point
+    3. Find the correct branch locations for each flow
+    4. Calculate intersection max and min values
+    5. Check which branch pairs are straight roads, based on the branch bearings
+    6. Calculate the curve points for all flows at once
+
+    If the intersection has no branches, None is returned. The time spent in the
+    steps is recorded with the given timer. With branch fallback, flows are also
+    matched to branches by branch number only, see find_start_and_end_points."""
+
+    # 1
+    if len(branches) == 0:
+        return None
+
+    # 2
+    with timer.stage("center point"):
+        intersection_center_point = calculate_intersection_center_point(branches)
+
+    # 3
+    with timer.stage("matching"):
+        matched_rows, unmatched_rows, start_coords, end_coords = match_flows(
+            flows,
+            branches,
+            intersection_center_point if branch_fallback else None,
+        )
+
+    return calculate_matched_curves(
+        flows,
+        branches,
+        intersection_center_point,
+        matched_rows,
+        unmatched_rows,
+        start_coords,
+        end_coords,
+        timer,
+    )
+
+
+def match_flows(
+    flows: Sequence[Flow],
+    branches: Sequence[Branch],
+    center_point: Optional[Tuple[float, float]] = None,
+) -> Tuple[List[int], List[int], List[Tuple[float, float]], List[Tuple[float, float]]]:
+    """Finds the branch locations of the flows of an intersection.
+
+    Returns the matched rows, the unmatched rows and the start and end
+    coordinates of the matched rows. If the intersection center point is given,
+    branches are also found by branch number, see find_start_and_end_points."""
+    branch_points = BranchPoints(branches)
+    matched_rows: List[int] = []
+    unmatched_rows: List[int] = []
+    start_coords: List[Tuple[float, float]] = []
+    end_coords: List[Tuple[float, float]] = []
+    for row, flow in enumerate(flows):
+        start_point, end_point = find_start_and_end_points(
+            flow, branch_points, center_point
+        )
+        if start_point and end_point:
+            matched_rows.append(row)
+            start_coords.append(start_point)
+            end_coords.append(end_point)
+        else:
+            unmatched_rows.append(row)
+    return matched_rows, unmatched_rows, start_coords, end_coords
+
+
+def matched_counts(
+    intersection_inputs: Iterable[Tuple[Sequence[Flow], Sequence[Branch]]],
+    branch_fallback: bool = False,
+) -> Iterator[int]:
+    """Yields the traffic counts of the flows that are matched to branch
+    locations, i.e. the flows that get a curve, of the (flows, branches) of each
+    intersection. The curves are not calculated."""
+    for flows, branches in intersection_inputs:
+        if not branches:
+            continue
+        center_point = (
+            calculate_intersection_center_point(branches) if branch_fallback else None
+        )
+        matched_rows, _, _, _ = match_flows(flows, branches, center_point)
+        for row in matched_rows:
+            yield flows[row].autot
+
+
+def calculate_matched_curves(
+    flows: Sequence[Flow],
+    branches: Sequence[Branch],
+    intersection_center_point: Tuple[float, float],
+    matched_rows: List[int],
+    unmatched_rows: List[int],
+    start_coords: Sequence[Tuple[float, float]],
+    end_coords: Sequence[Tuple[float, float]],
+    timer: StageTimer = DISABLED_TIMER,
+    autot_range: Optional[Tuple[int, int]] = None,
+) -> IntersectionCurves:
+    """Calculates the curves of an intersection whose flows have already been
+    matched to branch locations (steps 4-6 of compute_intersection).
+
+    The start and end coordinates are in the order of the matched rows. If the
+    max and min traffic amounts of the matched flows are already known, they can
+    be given as the autot range."""
+    if not matched_rows:
+        empty = np.empty((0, 2))
+        return IntersectionCurves(
+            matched_rows, unmatched_rows, empty, empty, empty, 0, 0
+        )
+
+    # 4
+    with timer.stage("normalization"):
+        if autot_range is None:
+            autot_values = [flows[row].autot for row in matched_rows]
+            autot_range = max(autot_values), min(autot_values)
+        autot_max, autot_min = autot_range
+
+    # 5
+    with timer.stage("topology"):
+        topology = IntersectionTopology(branches, intersection_center_point)
+        straight_roads = topology.are_straight_roads(
+            [flows[row] for row in matched_rows]
+        )
+
+    # 6
+    with timer.stage("geometry"):
+        start_points, middle_points, end_points = calculate_curve_points(
+            np.array(start_coords),
+            np.array(end_coords),
+            np.array(intersection_center_point),
+            straight_roads,
+        )
+
+    return IntersectionCurves(
+        matched_rows,
+        unmatched_rows,
+        start_points,
+        middle_points,
+        end_points,
+        autot_max,
+        autot_min,
+    )
@@ -0,0 +1,185 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+from risteyslaskenta_package.intersection import Branch, Flow
+
+# An intersection with its id, flows, branches and the source rows of the flows,
+# e.g. the ids of the data features
+PreparedIntersection = Tuple[str, List[Flow], List[Branch], List[int]]
+
+# Names of the tables, also used as the file names of the saved tables
+TABLE_NAMES = ("intersections", "flows", "branches")
+
+# Source row of flows that are not read from a layer
+NO_SOURCE_ROW = -1
+
+
+def _string_column(values: Sequence[str]) -> np.ndarray:
+    # Fixed width strings, so that the tables can be memory-mapped
+    width = max((len(value) for value in values), default=0)
+    return np.asarray(values, dtype=f"U{max(width, 1)}")
+
+
+def _table(columns: Dict[str, np.ndarray]) -> np.ndarray:
+    """Combines columns of the same length into a structured array."""
+    length = len(next(iter(columns.values())))
+    table = np.empty(
+        length, dtype=[(name, column.dtype) for name, column in columns.items()]
+    )
+    for name, column in columns.items():
+        table[name] = column
+    return table
+
+
+@dataclass
+class IntersectionTables:
+    """The prepared inputs of intersections as numpy structured arrays.
+
+    - intersections: intersection, flow_count, branch_count
+    - flows: intersection (the data id), from, to, autot, source_row
+    - branches: intersection, piste, haara, x, y
+
+    The flows and branches are in the order of their intersections. Compared to
+    features or lists of named tuples, the tables are compact and fast to send
+    to worker processes. They can be saved to a .npz file or to a directory of
+    .npy files, which are memory-mapped when loaded, so that reruns do not have
+    to read the source layers again."""
+
+    intersections: np.ndarray
+    flows: np.ndarray
+    branches: np.ndarray
+
+    @classmethod
+    def from_intersections(
+        cls, intersections: Iterable[PreparedIntersection]
+    ) -> "IntersectionTables":
+        """Creates the tables of (intersection id, flows, branches, source rows)
+        tuples. If the source rows of an intersection are not given, they are
+        set to NO_SOURCE_ROW."""
+        intersection_ids: List[str] = []
+        flow_counts: List[int] = []
+        branch_counts: List[int] = []
+        flow_columns: Tuple[List, ...] = ([], [], [], [], [])
+        branch_columns: Tuple[List, ...] = ([], [], [], [], [])
+        for intersection, flows, branches, source_rows in intersections:
+            intersection_ids.append(intersection)
+            flow_counts.append(len(flows))
+            branch_counts.append(len(branches))
+            if len(source_rows) != len(flows):
+                source_rows = [NO_SOURCE_ROW] * len(flows)
+            for flow, source_row in zip(flows, source_rows):
+                flow_columns[0].append(flow.data_id)
+                flow_columns[1].append(flow.direction[:1])
+                flow_columns[2].append(flow.direction[1:])
+                flow_columns[3].append(flow.autot)
+                flow_columns[4].append(source_row)
+            for branch in branches:
+                branch_columns[0].append(intersection)
+                branch_columns[1].append(branch.piste)
+                branch_columns[2].append(branch.haara)
+                branch_columns[3].append(branch.x)
+                branch_columns[4].append(branch.y)
+        return cls(
+            _table(
+                {
+                    "intersection": _string_column(intersection_ids),
+                    "flow_count": np.asarray(flow_counts, dtype=np.int64),
+                    "branch_count": np.asarray(branch_counts, dtype=np.int64),
+                }
+            ),
+            _table(
+                {
+                    "intersection": _string_column(flow_columns[0]),
+                    "from": _string_column(flow_columns[1]),
+                    "to": _string_column(flow_columns[2]),
+                    "autot": np.asarray(flow_columns[3], dtype=np.int64),
+                    "source_row": np.asarray(flow_columns[4], dtype=np.int64),
+                }
+            ),
+            _table(
+                {
+                    "intersection": _string_column(branch_columns[0]),
+                    "piste": _string_column(branch_columns[1]),
+                    "haara": _string_column(branch_columns[2]),
+                    "x": np.asarray(branch_columns[3], dtype=float),
+                    "y": np.asarray(branch_columns[4], dtype=float),
+                }
+            ),
+        )
+
+    def __len__(self) -> int:
+        return len(self.intersections)
+
+    def prepared_intersections(self) -> Iterator[PreparedIntersection]:
+        """Yields the (intersection id, flows, branches, source rows) of each
+        intersection, in the order of the tables."""
+        flow_start = branch_start = 0
+        for intersection, flow_count, branch_count in zip(
+            self.intersections["intersection"].tolist(),
+            self.intersections["flow_count"].tolist(),
+            self.intersections["branch_count"].tolist(),
+        ):
+            flows = self.flows[flow_start : flow_start + flow_count]
+            branches = self.branches[branch_start : branch_start + branch_count]
+            flow_start += flow_count
+            branch_start += branch_count
+            yield (
+                intersection,
+                [
+                    Flow(data_id, from_branch + to_branch, autot)
+                    for data_id, from_branch, to_branch, autot in zip(
+                        flows["intersection"].tolist(),
+                        flows["from"].tolist(),
+                        flows["to"].tolist(),
+                        flows["autot"].tolist(),
+                    )
+                ],
+                [
+                    Branch(piste, haara, x, y)
+                    for piste, haara, x, y in zip(
+                        branches["piste"].tolist(),
+                        branches["haara"].tolist(),
+                        branches["x"].tolist(),
+                        branches["y"].tolist(),
+                    )
+                ],
+                flows["source_row"].tolist(),
+            )
+
+    def save(self, path: str) -> None:
+        """Saves the tables to a .npz file, or otherwise to a directory of .npy
+        files that can be memory-mapped."""
+        tables = {name: getattr(self, name) for name in TABLE_NAMES}
+        if path.endswith(".npz"):
+            np.savez(path, **tables)
+            return
+        os.makedirs(path, exist_ok=True)
+        for name, table in tables.items():
+            np.save(os.path.join(path, f"{name}.npy"), table)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        """Tells if tables have been saved to the .npz file or directory. An
+        empty directory, e.g. one just created for the tables, has no tables."""
+        if path.endswith(".npz"):
+            return os.path.isfile(path)
+        return all(
+            os.path.isfile(os.path.join(path, f"{name}.npy")) for name in TABLE_NAMES
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "IntersectionTables":
+        """Loads tables saved with save. The tables of a directory are
+        memory-mapped read-only, so only the parts that are used are read."""
+        if path.endswith(".npz"):
+            with np.load(path) as tables:
+                return cls(*(tables[name] for name in TABLE_NAMES))
+        return cls(
+            *(
+                np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+                for name in TABLE_NAMES
+            )
+        )
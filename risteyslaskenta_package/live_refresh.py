@@ -0,0 +1,394 @@
+import logging
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from qgis.core import (
+    QgsExpression,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsFields,
+    QgsVectorLayer,
+    QgsWkbTypes,
+)
+from qgis.PyQt.QtCore import QObject, QTimer
+
+from risteyslaskenta_package.aggregation import AggregationSettings
+from risteyslaskenta_package.branch_grid import BranchGrid, add_nearby_branches
+from risteyslaskenta_package.geometry import Segmentation
+from risteyslaskenta_package.intersection import compute_intersection
+from risteyslaskenta_package.normalization import (
+    INTERSECTION_NORMALIZATION,
+    Normalization,
+    normalize_counts,
+)
+from risteyslaskenta_package.qgis_plugin_tools.tools.resources import plugin_name
+from risteyslaskenta_package.risteyslaskenta_functions import (
+    aggregate_data_features,
+    branch_from_feature,
+    create_branch_request,
+    create_intersection_result,
+    create_result_attributes,
+    data_location,
+    flow_from_feature,
+    group_branch_features,
+    group_features_by_field,
+)
+
+LOGGER = logging.getLogger(plugin_name())
+
+# Delay (in milliseconds) for collecting the edits of the data layer before the
+# affected intersections are refreshed
+REFRESH_DELAY = 300
+
+
+class IntersectionState(NamedTuple):
+    """What the result layer currently has for an intersection.
+
+    The flow keys are the (id, direction) pairs of all data features of the
+    intersection in reading order. The result (and overview) feature ids are in
+    the order of the matched rows, i.e. the indexes of the data features that
+    could be matched to branches."""
+
+    flow_keys: List[Tuple[str, str]]
+    matched_rows: List[int]
+    result_ids: List[int]
+    overview_ids: List[int]
+
+
+class LiveRefresh(QObject):
+    """Keeps a result memory layer up to date with the edits of the data layer.
+
+    The edits of the data layer, including uncommitted ones, are collected for a
+    moment and then only the intersections they affect are processed again. If
+    only the counts or other attributes of an intersection changed, the flows are
+    matched to the same branches, so the attributes and the normalization of its
+    result features are updated in place and the geometries are kept. Otherwise
+    the result features of the intersection are replaced.
+
+    The branch locations are read again for each refresh, but edits of the
+    points layer do not trigger a refresh. The refresh is parented to the result
+    layer and stops when either layer is removed.
+
+    The normalizations that need the counts of the whole dataset keep using the
+    counts of the original run."""
+
+    def __init__(
+        self,
+        data_layer: QgsVectorLayer,
+        points_layer: QgsVectorLayer,
+        result_layer: QgsVectorLayer,
+        data_request: QgsFeatureRequest,
+        data_fields: QgsFields,
+        read_fields: Optional[QgsFields] = None,
+        aggregation: Optional[AggregationSettings] = None,
+        segmentation: Optional[Segmentation] = None,
+        overview_layer: Optional[QgsVectorLayer] = None,
+        branch_grid: Optional[BranchGrid] = None,
+        normalization: Optional[Normalization] = None,
+    ) -> None:
+        super().__init__(result_layer)
+        self.data_layer = data_layer
+        self.points_layer = points_layer
+        self.result_layer = result_layer
+        self.overview_layer = overview_layer
+        self.data_request = data_request
+        self.data_fields = data_fields
+        self.read_fields = read_fields
+        self.aggregation = aggregation
+        self.segmentation = segmentation
+        self.branch_grid = branch_grid
+        self.normalization = normalization
+        self.points_request = create_branch_request(points_layer.fields())
+        self.points_are_polygons = (
+            points_layer.geometryType() == QgsWkbTypes.PolygonGeometry
+        )
+        self.id_index = data_layer.fields().indexOf("id")
+
+        self._states: Dict[str, IntersectionState] = {}
+        self._data_ids: Dict[int, str] = {}
+        self._dirty_ids: Set[str] = set()
+        self._edited_ids: Set[str] = set()
+        self._read_data_ids()
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(REFRESH_DELAY)
+        self._timer.timeout.connect(self.refresh)
+
+        self._connections = [
+            (data_layer.attributeValueChanged, self._on_attribute_value_changed),
+            (data_layer.featureAdded, self._on_feature_added),
+            (data_layer.featuresDeleted, self._on_features_deleted),
+            (data_layer.afterCommitChanges, self._on_after_commit),
+            (data_layer.afterRollBack, self._on_after_roll_back),
+            (data_layer.willBeDeleted, self.unlink),
+        ]
+        if branch_grid is not None:
+            # The data geometries are used to locate intersections
+            self._connections.append(
+                (data_layer.geometryChanged, self._on_geometry_changed)
+            )
+        for signal, slot in self._connections:
+            signal.connect(slot)
+
+    def unlink(self) -> None:
+        """Stops following the edits of the data layer."""
+        self._timer.stop()
+        for signal, slot in self._connections:
+            signal.disconnect(slot)
+        self._connections = []
+
+    def _read_data_ids(self) -> None:
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.id_index])
+        self._data_ids = {
+            feat.id(): str(feat[self.id_index])
+            for feat in self.data_layer.getFeatures(request)
+        }
+
+    def _mark_dirty(self, intersection_ids: Iterable[Optional[str]]) -> None:
+        for intersection_id in intersection_ids:
+            if intersection_id is not None:
+                self._dirty_ids.add(intersection_id)
+                self._edited_ids.add(intersection_id)
+        if self._dirty_ids:
+            self._timer.start()
+
+    def _on_attribute_value_changed(self, fid: int, index: int, value: object) -> None:
+        intersection_ids = [self._data_ids.get(fid)]
+        if index == self.id_index:
+            self._data_ids[fid] = str(value)
+            intersection_ids.append(self._data_ids[fid])
+        self._mark_dirty(intersection_ids)
+
+    def _on_feature_added(self, fid: int) -> None:
+        self._data_ids[fid] = str(self.data_layer.getFeature(fid)[self.id_index])
+        self._mark_dirty([self._data_ids[fid]])
+
+    def _on_geometry_changed(self, fid: int, _: object) -> None:
+        self._mark_dirty([self._data_ids.get(fid)])
+
+    def _on_features_deleted(self, fids: List[int]) -> None:
+        self._mark_dirty([self._data_ids.pop(fid, None) for fid in fids])
+
+    def _on_after_commit(self) -> None:
+        # The added features get new ids when they are committed
+        self._read_data_ids()
+        self._edited_ids = set()
+
+    def _on_after_roll_back(self) -> None:
+        self._read_data_ids()
+        self._mark_dirty(list(self._edited_ids))
+        self._edited_ids = set()
+
+    def refresh(self) -> None:
+        """Refreshes the intersections affected by the edits so far."""
+        self._timer.stop()
+        intersection_ids, self._dirty_ids = self._dirty_ids, set()
+        if not intersection_ids:
+            return
+        data_index = self._read_data_features(intersection_ids)
+        points_index = self._read_branch_features(intersection_ids)
+        updated_count = 0
+        for intersection_id in sorted(intersection_ids):
+            data_feats = data_index.get(intersection_id, [])
+            if self._update_attributes(intersection_id, data_feats):
+                updated_count += 1
+            else:
+                self._replace_features(
+                    intersection_id, data_feats, points_index.get(intersection_id, [])
+                )
+        LOGGER.info(
+            "Risteyslaskenta: refreshed %d intersections (%d in place)",
+            len(intersection_ids),
+            updated_count,
+        )
+        for layer in (self.result_layer, self.overview_layer):
+            if layer is not None:
+                layer.triggerRepaint()
+
+    def _read_data_features(
+        self, intersection_ids: Set[str]
+    ) -> Dict[str, List[QgsFeature]]:
+        request = QgsFeatureRequest(self.data_request)
+        request.combineFilterExpression(_field_in_expression("id", intersection_ids))
+        data_index = group_features_by_field(
+            self.data_layer, "id", request, self.read_fields
+        )
+        if self.aggregation is not None:
+            data_index = aggregate_data_features(
+                data_index, self.data_fields, self.aggregation
+            )
+        return data_index
+
+    def _read_branch_features(
+        self, intersection_ids: Set[str]
+    ) -> Dict[str, List[QgsFeature]]:
+        request = QgsFeatureRequest(self.points_request)
+        request.setFilterExpression(_field_in_expression("RPH", intersection_ids))
+        return group_branch_features(
+            self.points_layer, intersection_ids, self.points_are_polygons, request
+        )
+
+    def _state(
+        self, intersection_id: str, data_feats: List[QgsFeature]
+    ) -> Optional[IntersectionState]:
+        """Returns the state of the intersection. The state of an intersection
+        that has not been refreshed yet is recovered from the result layer, as
+        the result features are in the order of the matched data features."""
+        state = self._states.get(intersection_id)
+        if state is not None:
+            return state
+        result_feats = self._read_result_features(self.result_layer, intersection_id)
+        overview_ids = [
+            feat.id()
+            for feat in self._read_result_features(self.overview_layer, intersection_id)
+        ]
+        flow_keys = [_flow_key(feat) for feat in data_feats]
+        matched_rows: List[int] = []
+        row = 0
+        for feat in result_feats:
+            while row < len(flow_keys) and flow_keys[row] != _flow_key(feat):
+                row += 1
+            if row == len(flow_keys):
+                return None
+            matched_rows.append(row)
+            row += 1
+        if self.overview_layer is not None and len(overview_ids) != len(result_feats):
+            return None
+        return IntersectionState(
+            flow_keys,
+            matched_rows,
+            [feat.id() for feat in result_feats],
+            overview_ids,
+        )
+
+    def _read_result_features(
+        self, layer: Optional[QgsVectorLayer], intersection_id: str
+    ) -> List[QgsFeature]:
+        if layer is None:
+            return []
+        request = QgsFeatureRequest(
+            QgsExpression(
+                QgsExpression.createFieldEqualityExpression("id", intersection_id)
+            )
+        )
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        return sorted(layer.getFeatures(request), key=lambda feat: feat.id())
+
+    def _update_attributes(
+        self, intersection_id: str, data_feats: List[QgsFeature]
+    ) -> bool:
+        """Updates the attributes of the result features of the intersection in
+        place, if its flows are still the same. Returns False if the features
+        have to be replaced instead."""
+        state = self._state(intersection_id, data_feats)
+        if (
+            state is None
+            or not state.matched_rows
+            or state.flow_keys != [_flow_key(feat) for feat in data_feats]
+        ):
+            return False
+        matched_feats = [data_feats[row] for row in state.matched_rows]
+        autot_values = [int(feat["autot"]) for feat in matched_feats]
+        intersection_stats = max(autot_values), min(autot_values)
+        normalizations = normalize_counts(
+            autot_values,
+            [str(feat["direction"])[0] for feat in matched_feats],
+            normalization=self.normalization,
+        )
+        normalized_values = normalizations.pop(INTERSECTION_NORMALIZATION)
+        attribute_changes = [
+            {
+                index: value
+                for index, value in enumerate(
+                    create_result_attributes(
+                        feat,
+                        intersection_stats,
+                        float(normalized_value),
+                        [float(values[i]) for values in normalizations.values()],
+                    )
+                )
+            }
+            for i, (feat, normalized_value) in enumerate(
+                zip(matched_feats, normalized_values)
+            )
+        ]
+        for layer, fids in (
+            (self.result_layer, state.result_ids),
+            (self.overview_layer, state.overview_ids),
+        ):
+            if layer is not None:
+                layer.dataProvider().changeAttributeValues(
+                    dict(zip(fids, attribute_changes))
+                )
+        self._states[intersection_id] = state
+        return True
+
+    def _replace_features(
+        self,
+        intersection_id: str,
+        data_feats: List[QgsFeature],
+        branch_feats: List[QgsFeature],
+    ) -> None:
+        state = self._states.pop(intersection_id, None)
+        for layer, fids in (
+            (self.result_layer, state.result_ids if state else None),
+            (self.overview_layer, state.overview_ids if state else None),
+        ):
+            if layer is None:
+                continue
+            if fids is None:
+                fids = [
+                    feat.id()
+                    for feat in self._read_result_features(layer, intersection_id)
+                ]
+            layer.dataProvider().deleteFeatures(fids)
+        if not data_feats:
+            return
+
+        flows = [flow_from_feature(feat) for feat in data_feats]
+        branches = [branch_from_feature(feat) for feat in branch_feats]
+        if self.branch_grid is not None:
+            branches = add_nearby_branches(
+                flows, branches, self.branch_grid, data_location(data_feats)
+            )
+        curves = compute_intersection(
+            flows, branches, branch_fallback=self.branch_grid is not None
+        )
+        result = create_intersection_result(
+            data_feats,
+            curves,
+            self.result_layer.fields(),
+            segmentation=self.segmentation,
+            overview=self.overview_layer is not None,
+            normalization=self.normalization,
+        )
+        if curves is None or result is None:
+            return
+        _, result_feats = self.result_layer.dataProvider().addFeatures(result.features)
+        overview_feats: List[QgsFeature] = []
+        if self.overview_layer is not None:
+            _, overview_feats = self.overview_layer.dataProvider().addFeatures(
+                result.overview_features
+            )
+        self._states[intersection_id] = IntersectionState(
+            [_flow_key(feat) for feat in data_feats],
+            curves.matched_rows,
+            [feat.id() for feat in result_feats],
+            [feat.id() for feat in overview_feats],
+        )
+        for layer in (self.result_layer, self.overview_layer):
+            if layer is not None:
+                layer.updateExtents()
+
+
+def _flow_key(feat: QgsFeature) -> Tuple[str, str]:
+    return str(feat["id"]), str(feat["direction"])
+
+
+def _field_in_expression(field_name: str, values: Iterable[str]) -> str:
+    return "{} IN ({})".format(
+        QgsExpression.quotedColumnRef(field_name),
+        ", ".join(QgsExpression.quotedValue(value) for value in sorted(values)),
+    )
@@ -0,0 +1,114 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from risteyslaskenta_package.normalization_modes import (
+    DATASET_NORMALIZATIONS,
+    NORMALIZATION_FIELDS,
+    NORMALIZATION_MODES,
+)
+
+# Normalization of intersection_autot_normalized: the count divided by the
+# largest count of the intersection
+INTERSECTION_NORMALIZATION = "intersection_max"
+
+
+@dataclass
+class Normalization:
+    """Additional normalizations of the traffic counts, written as result fields
+    so that the styling can switch between them without a rerun.
+
+    - global_max: the count divided by the largest count of the whole dataset,
+      comparable across intersections
+    - branch_share: the share of the flow of all traffic entering the
+      intersection from the same branch
+    - quantile_rank: the share of the counts of the whole dataset that are at
+      most the count
+
+    The counts of the whole dataset are given once, sorted, with from_counts."""
+
+    modes: Tuple[str, ...] = ()
+    sorted_counts: np.ndarray = field(default_factory=lambda: np.empty(0))
+
+    @classmethod
+    def from_counts(
+        cls, modes: Sequence[str], counts: Iterable[int] = ()
+    ) -> "Normalization":
+        unknown_modes = set(modes) - set(NORMALIZATION_MODES)
+        if unknown_modes:
+            raise ValueError(f"Unknown normalization: {', '.join(unknown_modes)}")
+        return cls(tuple(modes), np.sort(np.fromiter(counts, dtype=float)))
+
+    @property
+    def needs_dataset_counts(self) -> bool:
+        return any(mode in DATASET_NORMALIZATIONS for mode in self.modes)
+
+    @property
+    def field_names(self) -> List[str]:
+        return [NORMALIZATION_FIELDS[mode] for mode in self.modes]
+
+
+def _divide(numerators: np.ndarray, denominators: np.ndarray) -> np.ndarray:
+    # Zero denominators give zero, like with intersections without traffic
+    return np.divide(
+        numerators,
+        denominators,
+        out=np.zeros(len(numerators)),
+        where=denominators != 0,
+    )
+
+
+def normalize_counts(
+    counts: Sequence[int],
+    start_branches: Sequence[str],
+    intersections: Optional[Sequence[object]] = None,
+    normalization: Optional[Normalization] = None,
+) -> Dict[str, np.ndarray]:
+    """Calculates the intersection normalization and the additional
+    normalizations of the flows at once.
+
+    The flows are given by their counts and start branches. The flows of any
+    number of intersections can be given together with the intersection of each
+    flow; otherwise they are of the same intersection. Returns the normalized
+    values by normalization, including INTERSECTION_NORMALIZATION."""
+    normalization = normalization or Normalization()
+    counts = np.asarray(counts, dtype=float)
+    if len(counts) == 0:
+        return {
+            mode: np.empty(0)
+            for mode in (INTERSECTION_NORMALIZATION,) + normalization.modes
+        }
+    if intersections is None:
+        intersection_indexes = np.zeros(len(counts), dtype=int)
+    else:
+        _, intersection_indexes = np.unique(
+            np.asarray(intersections, dtype=str), return_inverse=True
+        )
+    maxima = np.zeros(intersection_indexes.max() + 1)
+    np.maximum.at(maxima, intersection_indexes, counts)
+    values = {INTERSECTION_NORMALIZATION: _divide(counts, maxima[intersection_indexes])}
+
+    sorted_counts = normalization.sorted_counts
+    for mode in normalization.modes:
+        if mode == "global_max":
+            global_max = sorted_counts[-1] if len(sorted_counts) else 0.0
+            values[mode] = _divide(counts, np.full(len(counts), global_max))
+        elif mode == "branch_share":
+            branch_numbers, branch_codes = np.unique(
+                np.asarray(start_branches, dtype=str), return_inverse=True
+            )
+            _, branch_indexes = np.unique(
+                intersection_indexes * len(branch_numbers) + branch_codes,
+                return_inverse=True,
+            )
+            inbound_counts = np.bincount(branch_indexes, weights=counts)
+            values[mode] = _divide(counts, inbound_counts[branch_indexes])
+        elif mode == "quantile_rank":
+            values[mode] = (
+                np.searchsorted(sorted_counts, counts, side="right")
+                / len(sorted_counts)
+                if len(sorted_counts)
+                else np.zeros(len(counts))
+            )
+    return values
@@ -0,0 +1,15 @@
+# The names of the normalizations are kept apart from the numpy calculations in
+# normalization.py, so that the Processing algorithms can list them without
+# loading numpy when QGIS starts
+
+# Normalizations that can be calculated in addition to the intersection
+# normalization, with the names of their result fields
+NORMALIZATION_FIELDS = {
+    "global_max": "autot_global_normalized",
+    "branch_share": "autot_branch_share",
+    "quantile_rank": "autot_quantile_rank",
+}
+NORMALIZATION_MODES = tuple(NORMALIZATION_FIELDS)
+
+# Normalizations that need the counts of the whole dataset
+DATASET_NORMALIZATIONS = ("global_max", "quantile_rank")
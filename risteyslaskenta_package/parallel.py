@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from risteyslaskenta_package.intersection import (
+    Branch,
+    Flow,
+    IntersectionCurves,
+    compute_intersection,
+)
+from risteyslaskenta_package.intersection_tables import IntersectionTables
+
+# Each worker gets several intersections at a time, this many chunks per worker
+CHUNKS_PER_WORKER = 4
+
+
+def _python_executable() -> str:
+    """Returns the Python interpreter used to start the worker processes.
+
+    Inside QGIS, sys.executable is usually the QGIS application itself, which
+    cannot be used to spawn Python processes."""
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+    for name in ("python.exe", "python3.exe", os.path.join("bin", "python3")):
+        path = os.path.join(sys.exec_prefix, name)
+        if os.path.exists(path):
+            return path
+    return sys.executable
+
+
+def _compute_intersections(
+    tables: IntersectionTables, branch_fallback: bool = False
+) -> List[Optional[IntersectionCurves]]:
+    return [
+        compute_intersection(flows, branches, branch_fallback=branch_fallback)
+        for _, flows, branches, _ in tables.prepared_intersections()
+    ]
+
+
+class IntersectionPool:
+    """Process pool for calculating the curves of intersections.
+
+    The intersections are independent of each other, so they are split across
+    worker processes. The same pool can be used for many batches of
+    intersections, so that the workers are started only once. Remember to close
+    the pool."""
+
+    def __init__(
+        self, workers: Optional[int] = None, branch_fallback: bool = False
+    ) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self.branch_fallback = branch_fallback
+        context = multiprocessing.get_context("spawn")
+        context.set_executable(_python_executable())
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=context
+        )
+
+    def map(
+        self, intersection_inputs: Sequence[Tuple[List[Flow], List[Branch]]]
+    ) -> Iterator[Optional[IntersectionCurves]]:
+        """Calculates a batch of intersections. The results are yielded in the order
+        of the inputs, so the output is identical to calculating the intersections
+        one by one.
+
+        The inputs are sent to the workers as IntersectionTables, which are much
+        faster to pickle than the flows and branches themselves."""
+        chunk_size = max(
+            1, len(intersection_inputs) // (self.workers * CHUNKS_PER_WORKER)
+        )
+        chunks = [
+            IntersectionTables.from_intersections(
+                (str(i), flows, branches, [])
+                for i, (flows, branches) in enumerate(
+                    intersection_inputs[start : start + chunk_size], start
+                )
+            )
+            for start in range(0, len(intersection_inputs), chunk_size)
+        ]
+        return chain.from_iterable(
+            self.executor.map(
+                partial(_compute_intersections, branch_fallback=self.branch_fallback),
+                chunks,
+            )
+        )
+
+    def close(self) -> None:
+        """Waits for the running intersections and cancels the ones that have not
+        been started yet."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -1,6 +1,7 @@
-from typing import Callable, List, Optional
+from typing import TYPE_CHECKING, Callable, List, Optional
 
-from qgis.PyQt.QtCore import QCoreApplication, QTranslator
+from qgis.core import QgsApplication
+from qgis.PyQt.QtCore import QCoreApplication, QTimer, QTranslator
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtWidgets import QAction, QWidget
 from qgis.utils import iface
@@ -12,7 +13,11 @@ from risteyslaskenta_package.qgis_plugin_tools.tools.custom_logging import (
 from risteyslaskenta_package.qgis_plugin_tools.tools.i18n import setup_translation
 from risteyslaskenta_package.qgis_plugin_tools.tools.resources import plugin_name
 
-from .ui.risteyslaskenta_dialog import RisteyslaskentaDialog
+# The processing modules and the dialog, which loads its form, are imported only
+# when they are needed, so that they do not slow down the start of QGIS
+if TYPE_CHECKING:
+    from .processing_provider.provider import RisteyslaskentaProvider
+    from .ui.risteyslaskenta_dialog import RisteyslaskentaDialog
 
 
 class Plugin:
@@ -35,6 +40,9 @@ class Plugin:
 
         self.actions: List[QAction] = []
         self.menu = Plugin.name
+        self.provider: Optional["RisteyslaskentaProvider"] = None
+        self.unloaded = False
+        self.dlg: Optional["RisteyslaskentaDialog"] = None
 
     def add_action(
         self,
@@ -102,8 +110,26 @@ class Plugin:
 
         return action
 
+    def initProcessing(self) -> None:  # noqa N802
+        """Register the Processing provider. This is also called by qgis_process.
+
+        The algorithms import the processing modules only when they are run, so
+        registering the provider is cheap. When called from initGui, the plugin
+        may already have been unloaded by the time this is run."""
+        if self.provider is not None or self.unloaded:
+            return
+        from .processing_provider.provider import RisteyslaskentaProvider
+
+        self.provider = RisteyslaskentaProvider()
+        QgsApplication.processingRegistry().addProvider(self.provider)
+
     def initGui(self) -> None:  # noqa N802
-        """Create the menu entries and toolbar icons inside the QGIS GUI."""
+        """Create the menu entries and toolbar icons inside the QGIS GUI.
+
+        Only the action is created here. The Processing provider is registered
+        once the event loop runs, i.e. after QGIS has started, and the dialog is
+        loaded when the plugin is first run."""
+        QTimer.singleShot(0, self.initProcessing)
         self.add_action(
             "",
             text=Plugin.name,
@@ -121,6 +147,10 @@ class Plugin:
         for action in self.actions:
             iface.removePluginMenu(Plugin.name, action)
             iface.removeToolBarIcon(action)
+        if self.provider is not None:
+            QgsApplication.processingRegistry().removeProvider(self.provider)
+            self.provider = None
+        self.unloaded = True
         teardown_logger(Plugin.name)
 
     def run(self) -> None:
@@ -128,10 +158,11 @@ class Plugin:
 
         # Create the dialog with elements (after translation) and keep reference
         # Only create GUI ONCE in callback, so that it will only load
-        # when the plugin is started
-        self.first_start = True
-        if self.first_start:
-            self.first_start = False
+        # when the plugin is started. The dialog also keeps references to the
+        # running background tasks.
+        if self.dlg is None:
+            from .ui.risteyslaskenta_dialog import RisteyslaskentaDialog
+
             self.dlg = RisteyslaskentaDialog()
 
         # Show the dialog
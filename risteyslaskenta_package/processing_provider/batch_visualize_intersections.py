@@ -0,0 +1,318 @@
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple
+
+from qgis.core import (
+    QgsFields,
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingContext,
+    QgsProcessingException,
+    QgsProcessingFeedback,
+    QgsProcessingMultiStepFeedback,
+    QgsProcessingOutputNumber,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterFileDestination,
+    QgsProcessingParameterMultipleLayers,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterString,
+    QgsVectorLayerFeatureSource,
+    QgsWkbTypes,
+)
+
+# The processing modules, which load numpy, are imported only when the algorithm
+# is run, so that registering the provider is cheap when QGIS starts
+if TYPE_CHECKING:
+    from risteyslaskenta_package.risteyslaskenta_functions import RunSummary
+
+
+class DataSource(NamedTuple):
+    """A traffic dataset, read through a feature source that is thread safe."""
+
+    name: str
+    fields: QgsFields
+    has_geometry: bool
+    source: QgsVectorLayerFeatureSource
+
+
+class BatchVisualizeIntersectionsAlgorithm(QgsProcessingAlgorithm):
+    """Visualizes the traffic of many datasets against the same intersection data.
+
+    The branch locations are read, and polygons converted to centroids, only
+    once for all datasets. Each dataset is written to its own layer of one
+    GeoPackage, together with a table of the combined summary."""
+
+    INPUT_DATA = "INPUT_DATA"
+    INPUT_POINTS = "INPUT_POINTS"
+    WORKERS = "WORKERS"
+    USE_CACHE = "USE_CACHE"
+    SPATIAL_MATCHING = "SPATIAL_MATCHING"
+    FIELDS = "FIELDS"
+    OUTPUT = "OUTPUT"
+    INTERSECTION_COUNT = "INTERSECTION_COUNT"
+    FAILED_COUNT = "FAILED_COUNT"
+    UNMATCHED_COUNT = "UNMATCHED_COUNT"
+
+    def name(self) -> str:
+        return "batchvisualizeintersections"
+
+    def displayName(self) -> str:  # noqa N802
+        return "Visualize intersections of many datasets"
+
+    def shortHelpString(self) -> str:  # noqa N802
+        return (
+            "Creates the curves of several traffic datasets, e.g. the count "
+            "tables of different survey campaigns, against the same intersection "
+            "data. The datasets can be layers or files. The intersection data is "
+            "read only once. Each dataset is written to its own layer of the "
+            "output GeoPackage, named after the dataset, and the numbers of "
+            "intersections, intersections without any location features and "
+            "data features without matching branch locations of each dataset "
+            "and in total are written to the batch_summary table. If fields are "
+            "given, as names separated by commas, only those traffic data "
+            "attributes are copied to the result, in addition to id, direction "
+            "and autot."
+        )
+
+    def createInstance(self) -> "BatchVisualizeIntersectionsAlgorithm":  # noqa N802
+        return BatchVisualizeIntersectionsAlgorithm()
+
+    def initAlgorithm(self, config: Dict[str, Any] = None) -> None:  # noqa N802
+        self.addParameter(
+            QgsProcessingParameterMultipleLayers(
+                self.INPUT_DATA, "Traffic datasets", QgsProcessing.TypeVector
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT_POINTS,
+                "Intersection data",
+                [QgsProcessing.TypeVectorPoint, QgsProcessing.TypeVectorPolygon],
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                "Parallel processes",
+                QgsProcessingParameterNumber.Integer,
+                defaultValue=1,
+                minValue=1,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.USE_CACHE, "Use geometry cache", defaultValue=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.SPATIAL_MATCHING,
+                "Match branches by location when ids do not match",
+                defaultValue=False,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.FIELDS,
+                "Copied traffic data fields, separated by commas",
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.OUTPUT, "Output GeoPackage", "GeoPackage (*.gpkg)"
+            )
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(self.INTERSECTION_COUNT, "Intersections")
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(
+                self.FAILED_COUNT, "Intersections without location features"
+            )
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(
+                self.UNMATCHED_COUNT,
+                "Data features without matching branch locations",
+            )
+        )
+
+    def prepareAlgorithm(  # noqa N802
+        self,
+        parameters: Dict[str, Any],
+        context: QgsProcessingContext,
+        feedback: QgsProcessingFeedback,
+    ) -> bool:
+        # The feature sources are created in the main thread, as the layers may
+        # be project layers that must not be used in the thread of the algorithm
+        self.data_sources: List[DataSource] = [
+            DataSource(
+                layer.name(),
+                layer.fields(),
+                layer.isSpatial(),
+                QgsVectorLayerFeatureSource(layer),
+            )
+            for layer in self.parameterAsLayerList(parameters, self.INPUT_DATA, context)
+        ]
+        return True
+
+    def processAlgorithm(  # noqa N802
+        self,
+        parameters: Dict[str, Any],
+        context: QgsProcessingContext,
+        feedback: QgsProcessingFeedback,
+    ) -> Dict[str, Any]:
+        from risteyslaskenta_package.geometry_cache import GeometryCache
+        from risteyslaskenta_package.risteyslaskenta_functions import (
+            REQUIRED_DATA_FIELDS,
+            FeatureBatchWriter,
+            batch_layer_names,
+            create_branch_grid,
+            create_branch_request,
+            create_data_request,
+            create_output_file_writer,
+            create_result_fields,
+            default_geometry_cache_path,
+            group_branch_features,
+            group_features_by_field,
+            process_intersections,
+            select_data_fields,
+            write_batch_summary,
+        )
+
+        points_source = self.parameterAsSource(parameters, self.INPUT_POINTS, context)
+        if points_source is None:
+            raise QgsProcessingException(
+                self.invalidSourceError(parameters, self.INPUT_POINTS)
+            )
+        for data_source in self.data_sources:
+            missing_fields = [
+                field_name
+                for field_name in REQUIRED_DATA_FIELDS
+                if data_source.fields.indexOf(field_name) < 0
+            ]
+            if missing_fields:
+                raise QgsProcessingException(
+                    "Traffic dataset {} does not have the fields {}".format(
+                        data_source.name, ", ".join(missing_fields)
+                    )
+                )
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        use_cache = self.parameterAsBoolean(parameters, self.USE_CACHE, context)
+        spatial_matching = self.parameterAsBoolean(
+            parameters, self.SPATIAL_MATCHING, context
+        )
+        carried_fields = [
+            field_name.strip()
+            for field_name in self.parameterAsString(
+                parameters, self.FIELDS, context
+            ).split(",")
+            if field_name.strip()
+        ]
+        output_path = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
+        # The first step is reading the intersection data
+        multi_feedback = QgsProcessingMultiStepFeedback(
+            len(self.data_sources) + 1, feedback
+        )
+
+        feedback.pushInfo("Reading intersection data")
+        # All branches are read once, as the datasets can have any intersections
+        points_index = group_branch_features(
+            points_source,
+            None,
+            QgsWkbTypes.geometryType(points_source.wkbType())
+            == QgsWkbTypes.PolygonGeometry,
+            create_branch_request(points_source.fields()),
+        )
+        branch_grid = create_branch_grid(points_index) if spatial_matching else None
+
+        summaries: Dict[str, "RunSummary"] = {}
+        layer_names = batch_layer_names(
+            [data_source.name for data_source in self.data_sources]
+        )
+        cache = GeometryCache(default_geometry_cache_path()) if use_cache else None
+        try:
+            for step, (data_source, layer_name) in enumerate(
+                zip(self.data_sources, layer_names), 1
+            ):
+                if feedback.isCanceled():
+                    break
+                multi_feedback.setCurrentStep(step)
+                feedback.pushInfo(f"Processing {data_source.name} to {layer_name}")
+                # Only the copied attributes are read, and geometries only for
+                # spatial matching
+                read_fields = select_data_fields(
+                    data_source.fields, carried_fields or None
+                )
+                fields = create_result_fields(read_fields)
+                data_index = group_features_by_field(
+                    data_source.source,
+                    "id",
+                    create_data_request(
+                        data_source.fields,
+                        read_fields,
+                        with_geometry=spatial_matching and data_source.has_geometry,
+                    ),
+                    read_fields if carried_fields else None,
+                )
+                writer = create_output_file_writer(
+                    output_path,
+                    fields,
+                    points_source.sourceCrs(),
+                    context.transformContext(),
+                    layer_name,
+                    overwrite_file=step == 1,
+                )
+                summaries[layer_name] = process_intersections(
+                    data_index,
+                    points_index,
+                    fields,
+                    FeatureBatchWriter(writer),
+                    multi_feedback,
+                    workers,
+                    cache,
+                    branch_grid=branch_grid,
+                )
+                # Deleting the file writer finalizes the layer
+                del writer
+        finally:
+            if cache is not None:
+                cache.close()
+        if feedback.isCanceled():
+            return {}
+
+        write_batch_summary(output_path, summaries, context.transformContext())
+        for layer_name, summary in summaries.items():
+            feedback.pushInfo(
+                "{}: {} intersections, {} without any location features, {} data "
+                "features without matching branch locations".format(
+                    layer_name,
+                    summary.intersection_count,
+                    summary.failed_count,
+                    summary.unmatched_count,
+                )
+            )
+        intersection_count = sum(
+            summary.intersection_count for summary in summaries.values()
+        )
+        failed_count = sum(summary.failed_count for summary in summaries.values())
+        unmatched_count = sum(summary.unmatched_count for summary in summaries.values())
+        feedback.pushInfo(
+            "Total number of intersections: {}".format(intersection_count)
+        )
+        feedback.pushInfo(
+            "Number of intersections without any location features: {}".format(
+                failed_count
+            )
+        )
+        feedback.pushInfo(
+            "Number of data features without matching branch locations: {}".format(
+                unmatched_count
+            )
+        )
+        return {
+            self.OUTPUT: output_path,
+            self.INTERSECTION_COUNT: intersection_count,
+            self.FAILED_COUNT: failed_count,
+            self.UNMATCHED_COUNT: unmatched_count,
+        }
@@ -0,0 +1,128 @@
+from typing import Any, Dict
+
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingContext,
+    QgsProcessingException,
+    QgsProcessingFeedback,
+    QgsProcessingParameterFileDestination,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterVectorLayer,
+)
+
+from risteyslaskenta_package.vector_tiles import (
+    THINNING_FIELD,
+    VECTOR_TILE_FULL_DETAIL_ZOOM,
+    VECTOR_TILE_MAX_ZOOM,
+    VECTOR_TILE_MIN_ZOOM,
+    export_vector_tiles,
+)
+
+
+class ExportVectorTilesAlgorithm(QgsProcessingAlgorithm):
+    """Exports visualized intersections as vector tiles for web maps."""
+
+    INPUT = "INPUT"
+    MIN_ZOOM = "MIN_ZOOM"
+    MAX_ZOOM = "MAX_ZOOM"
+    FULL_DETAIL_ZOOM = "FULL_DETAIL_ZOOM"
+    LINE_TOLERANCE = "LINE_TOLERANCE"
+    OUTPUT = "OUTPUT"
+
+    def name(self) -> str:
+        return "exportvectortiles"
+
+    def displayName(self) -> str:  # noqa N802
+        return "Export intersections as vector tiles"
+
+    def shortHelpString(self) -> str:  # noqa N802
+        return (
+            "Writes the curves created by Visualize intersections to an MBTiles "
+            "file of vector tiles, e.g. for serving them to a web map. Curves are "
+            "converted to lines whose distance from the curve is at most the line "
+            "tolerance. Below the full detail zoom, the tiles only have the flows "
+            "that are heavy compared to the other flows of their intersection, "
+            "by intersection_autot_normalized: at the minimum zoom the flows of "
+            "at least 0.8 and towards the full detail zoom gradually all flows."
+        )
+
+    def createInstance(self) -> "ExportVectorTilesAlgorithm":  # noqa N802
+        return ExportVectorTilesAlgorithm()
+
+    def initAlgorithm(self, config: Dict[str, Any] = None) -> None:  # noqa N802
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.INPUT, "Intersections visualized", [QgsProcessing.TypeVectorLine]
+            )
+        )
+        for name, description, default_value in (
+            (self.MIN_ZOOM, "Minimum zoom", VECTOR_TILE_MIN_ZOOM),
+            (self.MAX_ZOOM, "Maximum zoom", VECTOR_TILE_MAX_ZOOM),
+            (
+                self.FULL_DETAIL_ZOOM,
+                "Zoom from which all flows are included",
+                VECTOR_TILE_FULL_DETAIL_ZOOM,
+            ),
+        ):
+            self.addParameter(
+                QgsProcessingParameterNumber(
+                    name,
+                    description,
+                    QgsProcessingParameterNumber.Integer,
+                    defaultValue=default_value,
+                    minValue=0,
+                    maxValue=24,
+                )
+            )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.LINE_TOLERANCE,
+                "Line tolerance",
+                QgsProcessingParameterNumber.Double,
+                defaultValue=0.5,
+                minValue=0.01,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.OUTPUT, "Vector tiles", "MBTiles (*.mbtiles)"
+            )
+        )
+
+    def processAlgorithm(  # noqa N802
+        self,
+        parameters: Dict[str, Any],
+        context: QgsProcessingContext,
+        feedback: QgsProcessingFeedback,
+    ) -> Dict[str, Any]:
+        result_layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        if result_layer is None:
+            raise QgsProcessingException(
+                self.invalidSourceError(parameters, self.INPUT)
+            )
+        if result_layer.fields().indexOf(THINNING_FIELD) < 0:
+            raise QgsProcessingException(
+                f"The layer does not have the field {THINNING_FIELD}"
+            )
+        min_zoom = self.parameterAsInt(parameters, self.MIN_ZOOM, context)
+        max_zoom = self.parameterAsInt(parameters, self.MAX_ZOOM, context)
+        if min_zoom > max_zoom:
+            raise QgsProcessingException(
+                "The minimum zoom must not be larger than the maximum zoom"
+            )
+        output_path = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
+        try:
+            export_vector_tiles(
+                result_layer,
+                output_path,
+                context.transformContext(),
+                min_zoom,
+                max_zoom,
+                self.parameterAsInt(parameters, self.FULL_DETAIL_ZOOM, context),
+                self.parameterAsDouble(parameters, self.LINE_TOLERANCE, context),
+                feedback,
+            )
+        except OSError as e:
+            raise QgsProcessingException(str(e))
+        return {self.OUTPUT: output_path}
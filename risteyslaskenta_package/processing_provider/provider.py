@@ -0,0 +1,28 @@
+from qgis.core import Qgis, QgsProcessingProvider
+
+from risteyslaskenta_package.processing_provider.batch_visualize_intersections import (
+    BatchVisualizeIntersectionsAlgorithm,
+)
+from risteyslaskenta_package.processing_provider.visualize_intersections import (
+    VisualizeIntersectionsAlgorithm,
+)
+
+
+class RisteyslaskentaProvider(QgsProcessingProvider):
+    """Processing provider for running risteyslaskenta without the dialog, e.g.
+    in batch runs with qgis_process."""
+
+    def id(self) -> str:  # noqa N802
+        return "risteyslaskenta"
+
+    def name(self) -> str:
+        return "Risteyslaskenta"
+
+    def loadAlgorithms(self) -> None:  # noqa N802
+        self.addAlgorithm(VisualizeIntersectionsAlgorithm())
+        self.addAlgorithm(BatchVisualizeIntersectionsAlgorithm())
+        # The vector tile writer is available since QGIS 3.14
+        if Qgis.QGIS_VERSION_INT >= 31400:
+            from .export_vector_tiles import ExportVectorTilesAlgorithm
+
+            self.addAlgorithm(ExportVectorTilesAlgorithm())
@@ -0,0 +1,471 @@
+from collections import deque
+from typing import TYPE_CHECKING, Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+from qgis.core import (
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingContext,
+    QgsProcessingException,
+    QgsProcessingFeedback,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterField,
+    QgsProcessingParameterFileDestination,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterString,
+    QgsWkbTypes,
+)
+
+from risteyslaskenta_package.aggregation import AGGREGATION_METHODS, AggregationSettings
+from risteyslaskenta_package.normalization_modes import NORMALIZATION_MODES
+
+# The processing modules, which load numpy, are imported only when the algorithm
+# is run, so that registering the provider is cheap when QGIS starts
+if TYPE_CHECKING:
+    from risteyslaskenta_package.geometry import Segmentation
+
+
+class VisualizeIntersectionsAlgorithm(QgsProcessingAlgorithm):
+    """Visualizes the traffic of intersections as curves between their branches.
+
+    This runs the same pipeline as the plugin dialog. Progress is reported and
+    cancellation is checked through the Processing feedback, so the algorithm can
+    also be run headless with qgis_process."""
+
+    INPUT_DATA = "INPUT_DATA"
+    INPUT_POINTS = "INPUT_POINTS"
+    WORKERS = "WORKERS"
+    USE_CACHE = "USE_CACHE"
+    OUTPUT = "OUTPUT"
+    REPORT = "REPORT"
+    AGGREGATION = "AGGREGATION"
+    PERIOD_FIELD = "PERIOD_FIELD"
+    PERIOD_START = "PERIOD_START"
+    PERIOD_END = "PERIOD_END"
+    OUTPUT_GEOMETRY = "OUTPUT_GEOMETRY"
+    LINE_VERTICES = "LINE_VERTICES"
+    LINE_TOLERANCE = "LINE_TOLERANCE"
+    OVERVIEW = "OVERVIEW"
+    FIELDS = "FIELDS"
+    SPATIAL_MATCHING = "SPATIAL_MATCHING"
+    STREAMING = "STREAMING"
+    NORMALIZATIONS = "NORMALIZATIONS"
+
+    def name(self) -> str:
+        return "visualizeintersections"
+
+    def displayName(self) -> str:  # noqa N802
+        return "Visualize intersections"
+
+    def shortHelpString(self) -> str:  # noqa N802
+        return (
+            "Creates a curve for each row of the traffic data, drawn between the "
+            "intersection branch locations given in the intersection data. The "
+            "traffic data must have the fields id, direction and autot, and the "
+            "intersection data the fields RPH, Piste and Haara. Polygon branch "
+            "locations are converted to centroids. With the geometry cache, the "
+            "curves of intersections whose branch locations have not changed "
+            "since the previous run are not calculated again. If a timing report "
+            "file is given, the time spent in each processing stage is written "
+            "to it as JSON. With aggregation, the rows of each intersection "
+            "direction are combined into one curve, optionally limited to the "
+            "periods between the first and last period. Lines are faster to draw "
+            "than curves; their vertex count is either given or calculated from "
+            "the tolerance. The optional overview has lines with only a few "
+            "vertices, for drawing at small scales. If fields are selected, only "
+            "those traffic data attributes are copied to the result, in addition "
+            "to id, direction and autot; the rest can be joined by id and "
+            "direction. With spatial matching, branches whose ids do not match "
+            "are searched near the intersection by branch number. With streaming, "
+            "the traffic data is read in id order one intersection at a time, so "
+            "data larger than the memory can be processed to a file output. "
+            "The selected additional normalizations are written as fields next "
+            "to intersection_autot_normalized: global_max divides by the largest "
+            "count of the whole data, branch_share by the traffic entering the "
+            "intersection from the same branch and quantile_rank gives the share "
+            "of all counts that are at most the count."
+        )
+
+    def createInstance(self) -> "VisualizeIntersectionsAlgorithm":  # noqa N802
+        return VisualizeIntersectionsAlgorithm()
+
+    def initAlgorithm(self, config: Dict[str, Any] = None) -> None:  # noqa N802
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT_DATA, "Traffic data", [QgsProcessing.TypeVector]
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT_POINTS,
+                "Intersection data",
+                [QgsProcessing.TypeVectorPoint, QgsProcessing.TypeVectorPolygon],
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                "Parallel processes",
+                QgsProcessingParameterNumber.Integer,
+                defaultValue=1,
+                minValue=1,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.USE_CACHE, "Use geometry cache", defaultValue=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT, "Intersections visualized", QgsProcessing.TypeVectorLine
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.REPORT,
+                "Timing report",
+                "JSON files (*.json)",
+                optional=True,
+                createByDefault=False,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.AGGREGATION,
+                "Aggregate periods",
+                ["No aggregation"]
+                + [method.capitalize() for method in AGGREGATION_METHODS],
+                defaultValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.PERIOD_FIELD,
+                "Period field",
+                parentLayerParameterName=self.INPUT_DATA,
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.PERIOD_START, "First period", optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(self.PERIOD_END, "Last period", optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.FIELDS,
+                "Traffic data fields to copy (all if none selected)",
+                parentLayerParameterName=self.INPUT_DATA,
+                allowMultiple=True,
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.SPATIAL_MATCHING,
+                "Match branches by location when ids do not match",
+                defaultValue=False,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.STREAMING,
+                "Stream traffic data in id order (low memory)",
+                defaultValue=False,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.NORMALIZATIONS,
+                "Additional normalizations",
+                list(NORMALIZATION_MODES),
+                allowMultiple=True,
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OUTPUT_GEOMETRY,
+                "Output geometry",
+                ["Curves", "Lines"],
+                defaultValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.LINE_VERTICES,
+                "Line vertices (0 to use the tolerance)",
+                QgsProcessingParameterNumber.Integer,
+                defaultValue=0,
+                minValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.LINE_TOLERANCE,
+                "Line tolerance",
+                QgsProcessingParameterNumber.Double,
+                defaultValue=0.5,
+                minValue=0.01,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OVERVIEW,
+                "Intersections overview",
+                QgsProcessing.TypeVectorLine,
+                optional=True,
+                createByDefault=False,
+            )
+        )
+
+    def processAlgorithm(  # noqa N802
+        self,
+        parameters: Dict[str, Any],
+        context: QgsProcessingContext,
+        feedback: QgsProcessingFeedback,
+    ) -> Dict[str, Any]:
+        from risteyslaskenta_package.geometry_cache import GeometryCache
+        from risteyslaskenta_package.instrumentation import DISABLED_TIMER, StageTimer
+        from risteyslaskenta_package.normalization import Normalization
+        from risteyslaskenta_package.risteyslaskenta_functions import (
+            FeatureBatchWriter,
+            aggregate_data_features,
+            aggregate_data_groups,
+            count_features,
+            count_group_features,
+            create_aggregated_fields,
+            create_branch_grid,
+            create_branch_request,
+            create_data_request,
+            create_result_fields,
+            dataset_counts,
+            default_geometry_cache_path,
+            group_branch_features,
+            group_features_by_field,
+            iterate_feature_groups,
+            process_intersection_groups,
+            result_wkb_type,
+            select_data_fields,
+        )
+
+        data_source = self.parameterAsSource(parameters, self.INPUT_DATA, context)
+        points_source = self.parameterAsSource(parameters, self.INPUT_POINTS, context)
+        if data_source is None:
+            raise QgsProcessingException(
+                self.invalidSourceError(parameters, self.INPUT_DATA)
+            )
+        if points_source is None:
+            raise QgsProcessingException(
+                self.invalidSourceError(parameters, self.INPUT_POINTS)
+            )
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        use_cache = self.parameterAsBoolean(parameters, self.USE_CACHE, context)
+        report_path = self.parameterAsFileOutput(parameters, self.REPORT, context)
+        timer = StageTimer() if report_path else DISABLED_TIMER
+        aggregation = self._aggregation_settings(parameters, context)
+        segmentation = self._segmentation(parameters, context)
+        spatial_matching = self.parameterAsBoolean(
+            parameters, self.SPATIAL_MATCHING, context
+        )
+        streaming = self.parameterAsBoolean(parameters, self.STREAMING, context)
+        normalization_modes = [
+            NORMALIZATION_MODES[index]
+            for index in self.parameterAsEnums(parameters, self.NORMALIZATIONS, context)
+        ]
+        normalization = (
+            Normalization.from_counts(normalization_modes)
+            if normalization_modes
+            else None
+        )
+
+        carried_fields = self.parameterAsFields(parameters, self.FIELDS, context)
+        read_fields = select_data_fields(
+            data_source.fields(), carried_fields or None, aggregation
+        )
+        data_fields = read_fields
+        if aggregation is not None:
+            data_fields = create_aggregated_fields(data_fields)
+        fields = create_result_fields(data_fields, normalization)
+        sink, dest_id = self.parameterAsSink(
+            parameters,
+            self.OUTPUT,
+            context,
+            fields,
+            result_wkb_type(segmentation),
+            points_source.sourceCrs(),
+        )
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+        overview_sink, overview_dest_id = self.parameterAsSink(
+            parameters,
+            self.OVERVIEW,
+            context,
+            fields,
+            QgsWkbTypes.LineString,
+            points_source.sourceCrs(),
+        )
+
+        data_request = create_data_request(
+            data_source.fields(),
+            read_fields,
+            aggregation,
+            spatial_matching and data_source.wkbType() != QgsWkbTypes.NoGeometry,
+        )
+        projected_fields = read_fields if carried_fields else None
+        points_are_polygons = (
+            QgsWkbTypes.geometryType(points_source.wkbType())
+            == QgsWkbTypes.PolygonGeometry
+        )
+        feedback.pushInfo("Reading input layers")
+        with timer.stage("select"):
+            if streaming:
+                # The traffic data is read while processing, so all branches
+                # are read
+                intersection_count = None
+                points_index = group_branch_features(
+                    points_source,
+                    None,
+                    points_are_polygons,
+                    create_branch_request(points_source.fields()),
+                )
+            else:
+                data_index = group_features_by_field(
+                    data_source, "id", data_request, projected_fields
+                )
+                intersection_count = len(data_index)
+                # Polygon branch locations are converted to centroids. With
+                # spatial matching, all branches are needed for searching them
+                # by proximity.
+                points_index = group_branch_features(
+                    points_source,
+                    None if spatial_matching else data_index.keys(),
+                    points_are_polygons,
+                    create_branch_request(points_source.fields()),
+                )
+            branch_grid = create_branch_grid(points_index) if spatial_matching else None
+
+        def stream_data_groups(
+            group_sizes: Optional[Deque[int]] = None,
+        ) -> Iterable[Tuple[str, List[QgsFeature]]]:
+            data_groups = iterate_feature_groups(
+                data_source, "id", data_request, projected_fields
+            )
+            if group_sizes is not None:
+                data_groups = count_group_features(data_groups, group_sizes)
+            if aggregation is not None:
+                data_groups = aggregate_data_groups(
+                    data_groups, data_fields, aggregation
+                )
+            return data_groups
+
+        group_sizes: Optional[Deque[int]] = None
+        feature_count = data_source.featureCount()
+        if streaming:
+            # The progress is reported by the data features read, which are
+            # counted before aggregating them
+            group_sizes = deque()
+            data_groups = stream_data_groups(group_sizes)
+            if data_request.filterType() != QgsFeatureRequest.FilterNone:
+                # Only the data features in the period window are read
+                with timer.stage("select"):
+                    feature_count = count_features(data_source, data_request)
+        else:
+            if aggregation is not None:
+                with timer.stage("aggregation"):
+                    data_index = aggregate_data_features(
+                        data_index, data_fields, aggregation
+                    )
+            data_groups = data_index.items()
+        if normalization is not None and normalization.needs_dataset_counts:
+            feedback.pushInfo("Reading the counts for the normalizations")
+            with timer.stage("normalization"):
+                # The streamed data is read again, as it can only be read once
+                normalization = Normalization.from_counts(
+                    normalization.modes,
+                    dataset_counts(
+                        stream_data_groups() if streaming else data_groups,
+                        points_index,
+                        branch_grid,
+                    ),
+                )
+
+        cache = GeometryCache(default_geometry_cache_path()) if use_cache else None
+        try:
+            summary = process_intersection_groups(
+                data_groups,
+                points_index,
+                fields,
+                FeatureBatchWriter(sink),
+                feedback,
+                workers,
+                cache,
+                timer,
+                segmentation,
+                FeatureBatchWriter(overview_sink)
+                if overview_sink is not None
+                else None,
+                branch_grid,
+                intersection_count,
+                feature_count,
+                normalization,
+                group_sizes,
+            )
+        finally:
+            if cache is not None:
+                cache.close()
+        feedback.pushInfo(
+            "Total number of intersections: {}".format(summary.intersection_count)
+        )
+        feedback.pushInfo(
+            "Number of intersections without any location features: {}".format(
+                summary.failed_count
+            )
+        )
+        feedback.pushInfo(
+            "Number of data features without matching branch locations: {}".format(
+                summary.unmatched_count
+            )
+        )
+        results = {self.OUTPUT: dest_id}
+        if overview_sink is not None:
+            results[self.OVERVIEW] = overview_dest_id
+        if report_path:
+            timer.write_report(report_path)
+            feedback.pushInfo(f"Timing report written to {report_path}")
+            results[self.REPORT] = report_path
+        return results
+
+    def _aggregation_settings(
+        self, parameters: Dict[str, Any], context: QgsProcessingContext
+    ) -> Optional[AggregationSettings]:
+        method_index = self.parameterAsEnum(parameters, self.AGGREGATION, context)
+        if method_index == 0:
+            return None
+        period_fields = self.parameterAsFields(parameters, self.PERIOD_FIELD, context)
+        return AggregationSettings(
+            AGGREGATION_METHODS[method_index - 1],
+            period_fields[0] if period_fields else None,
+            self.parameterAsString(parameters, self.PERIOD_START, context) or None,
+            self.parameterAsString(parameters, self.PERIOD_END, context) or None,
+        )
+
+    def _segmentation(
+        self, parameters: Dict[str, Any], context: QgsProcessingContext
+    ) -> Optional["Segmentation"]:
+        from risteyslaskenta_package.geometry import Segmentation
+
+        if self.parameterAsEnum(parameters, self.OUTPUT_GEOMETRY, context) == 0:
+            return None
+        return Segmentation(
+            self.parameterAsInt(parameters, self.LINE_VERTICES, context) or None,
+            self.parameterAsDouble(parameters, self.LINE_TOLERANCE, context),
+        )
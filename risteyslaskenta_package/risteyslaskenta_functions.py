@@ -1,381 +1,1544 @@
-from math import sqrt
-from typing import List, Tuple
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from itertools import groupby, islice
+from typing import (
+    Any,
+    Collection,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 import numpy as np
-from qgis import processing
 from qgis.core import (
+    QgsAbstractFeatureSource,
+    QgsApplication,
     QgsCircularString,
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransformContext,
+    QgsDataSourceUri,
+    QgsExpression,
     QgsFeature,
+    QgsFeatureRequest,
+    QgsFeatureSink,
+    QgsFeatureSource,
+    QgsFeedback,
     QgsField,
     QgsFields,
     QgsGeometry,
+    QgsLineString,
     QgsPoint,
-    QgsPointXY,
-    QgsProject,
+    QgsProviderRegistry,
     QgsVectorFileWriter,
     QgsVectorLayer,
+    QgsWkbTypes,
 )
-from qgis.core.additions.edit import edit
 from qgis.PyQt.QtCore import QVariant
 
+from risteyslaskenta_package.aggregation import AggregationSettings, aggregate_counts
+from risteyslaskenta_package.branch_grid import (
+    BRANCH_SEARCH_RADIUS,
+    BranchGrid,
+    add_nearby_branches,
+)
+from risteyslaskenta_package.geometry import Segmentation, segmentize_curves
+from risteyslaskenta_package.geometry_cache import GeometryCache
+from risteyslaskenta_package.instrumentation import DISABLED_TIMER, StageTimer
+from risteyslaskenta_package.intersection import (
+    Branch,
+    Flow,
+    IntersectionCurves,
+    compute_intersection,
+    matched_counts,
+)
+from risteyslaskenta_package.intersection_tables import IntersectionTables
+from risteyslaskenta_package.normalization import (
+    INTERSECTION_NORMALIZATION,
+    Normalization,
+    normalize_counts,
+)
+from risteyslaskenta_package.parallel import IntersectionPool
+from risteyslaskenta_package.qgis_plugin_tools.tools.resources import plugin_name
+from risteyslaskenta_package.sql_pushdown import (
+    connect,
+    count_intersections,
+    is_supported,
+    query_counts,
+    query_intersections,
+)
+
+LOGGER = logging.getLogger(plugin_name())
+
+# Default location of the geometry cache, relative to the QGIS profile directory
+GEOMETRY_CACHE_PATH = os.path.join("risteyslaskenta", "geometry_cache.sqlite")
+
+# Counts of the aggregated periods of a flow, as JSON
+PERIOD_COUNTS_FIELD = "autot_periods"
+
+# Data layer fields used in the processing, always carried to the result
+REQUIRED_DATA_FIELDS = ("id", "direction", "autot")
+
+# Branch location layer fields used in the processing
+BRANCH_FIELDS = ("RPH", "Piste", "Haara")
+
+# Name of the result layer in output files that can have many layers (GeoPackage)
+RESULT_FILE_LAYER_NAME = "intersections_visualized"
+
+# Name of the layer of the combined summary in batch output files
+BATCH_SUMMARY_LAYER_NAME = "batch_summary"
+
+# Vertices of each line of the overview layer
+OVERVIEW_VERTEX_COUNT = 5
+
+# Scale (denominator) at which the overview layer replaces the result layer
+OVERVIEW_SCALE = 50000
+
+# Number of intersections whose inputs are read and calculated at a time, which
+# bounds the memory used when the data is streamed
+COMPUTE_CHUNK_SIZE = 1000
 
-def create_result_layer(crs, data_layer_fields: QgsFields) -> QgsVectorLayer:
-    """Create the result layer and add it to QGIS layers.
+# Number of unmatched data features whose id and direction are kept for the log.
+# The rest are only counted, so that the memory use does not grow with the data.
+UNMATCHED_LOG_LIMIT = 100
+
+
+def create_result_fields(
+    data_layer_fields: QgsFields, normalization: Optional[Normalization] = None
+) -> QgsFields:
+    """Define the attributes/data columns of the result features.
+
+    All the data layer fields are copied and the calculated fields are added,
+    including the fields of the additional normalizations, if any."""
+    fields = QgsFields(data_layer_fields)
+    for result_field in [
+        QgsField("autot_numeric", QVariant.Int),
+        QgsField("start_direction", QVariant.String),
+        QgsField("intersection_autot_max", QVariant.Int),
+        QgsField("intersection_autot_min", QVariant.Int),
+        QgsField("intersection_autot_normalized", QVariant.Double),
+    ]:
+        fields.append(result_field)
+    if normalization is not None:
+        for field_name in normalization.field_names:
+            fields.append(QgsField(field_name, QVariant.Double))
+    return fields
+
+
+def result_wkb_type(segmentation: Optional[Segmentation]) -> QgsWkbTypes.Type:
+    """Returns the geometry type of the result features."""
+    if segmentation is not None:
+        return QgsWkbTypes.LineString
+    return QgsWkbTypes.CompoundCurve
+
+
+def create_result_layer(
+    crs,
+    data_layer_fields: QgsFields,
+    wkb_type: QgsWkbTypes.Type = QgsWkbTypes.CompoundCurve,
+    name: str = "Intersections visualized",
+    normalization: Optional[Normalization] = None,
+) -> QgsVectorLayer:
+    """Create the result layer.
 
     The result layer geometry type is Line (CompoundCurve) in QGIS and the
-    individual features added will be QgsCircularStrings. The attributes/data columns
-    are defined here. No data is added at this stage."""
-    result_layer = QgsVectorLayer("CompoundCurve", "temp", "memory")
+    individual features added will be QgsCircularStrings, unless the curves are
+    segmentized to LineStrings. No data is added at this stage and the layer is
+    not added to the project, so it can also be created in a background task."""
+    result_layer = QgsVectorLayer(QgsWkbTypes.displayString(wkb_type), "temp", "memory")
     result_layer.setCrs(crs)
-    result_layer.dataProvider().addAttributes(data_layer_fields)
     result_layer.dataProvider().addAttributes(
-        [
-            QgsField("autot_numeric", QVariant.Int),
-            QgsField("start_direction", QVariant.String),
-            QgsField("intersection_autot_max", QVariant.Int),
-            QgsField("intersection_autot_min", QVariant.Int),
-            QgsField("intersection_autot_normalized", QVariant.Double),
-        ]
+        create_result_fields(data_layer_fields, normalization)
     )
     result_layer.updateFields()
     result_layer.commitChanges()
-    result_layer.setName("Intersections visualized")
-    QgsProject.instance().addMapLayer(result_layer)
+    result_layer.setName(name)
     return result_layer
 
 
-def perpendicular(vector: Tuple[float, float]) -> np.ndarray:
-    """Calculates a vector perpendicular to the given input vector.
-
-    This function is used to calculate the move vector for a curve
-    geometry."""
-    perpendicular_vector = np.empty_like(vector)
-    perpendicular_vector[0] = -vector[1]
-    perpendicular_vector[1] = vector[0]
-    return perpendicular_vector
-
-
-def normalize(array) -> np.ndarray:
-    """Normalize an input array and convert to Numpy array."""
-    array = np.array(array)
-    return array / np.linalg.norm(array)
-
-
-def distance(p1: Tuple[float, float], p2: Tuple[float, float]) -> float:
-    """Calculates distance between points in 2D space. Pythagorean theorem."""
-    x = (p1[0] - p2[0]) ** 2
-    y = (p1[1] - p2[1]) ** 2
-    distance = sqrt(x + y)
-    return distance
-
-
-def convert_polygons_to_centroids(polygon_layer: QgsVectorLayer) -> QgsVectorLayer:
-    """Calls QGIS own algorithm to convert a polygon layer to centroid point layer.
-
-    This is used if intersection branches are represented as polygons initially."""
-    parameters = {"INPUT": polygon_layer, "OUTPUT": "memory:"}
-    result = processing.run("native:centroids", parameters)
-    layer = result["OUTPUT"]
-    print("Converted a polygon layer to a point layer")
-    return layer
-
-
-def calculate_middle_point(
-    start_point: QgsPointXY,
-    end_point: QgsPointXY,
-    intersection_middle_point,
-    straight_road=False,
-) -> QgsPointXY:
-    """Calculates the middle point between start and end points.
-
-    If the road geometry for which this is calculated is determined not
-    to be straight, the middle point is moved towards the intersection center,
-    to create a curve that represents a turn in an intersection.
-
-    Sometimes the interesction center is not in a logical place due to unusual
-    geometry or errors in data. In these cases, we revert creating the curve
-    and make a straight line."""
-    mid_x = (start_point.x() + end_point.x()) / 2
-    mid_y = (start_point.y() + end_point.y()) / 2
-
-    # If the road is determined to be not straight, adjust middle point
-    # to create a curve
-    if not straight_road:
-        mid_x = (mid_x + intersection_middle_point[0]) / 2
-        mid_y = (mid_y + intersection_middle_point[1]) / 2
-    middle_point = QgsPointXY(mid_x, mid_y)
-
-    # If the intersection branches/center are oddly placed, we need to make correction
-    # If this wouldnt be done, some intersections would have large, very circular curves
-
-    if distance(
-        (middle_point.x(), middle_point.y()), (end_point.x(), end_point.y())
-    ) > distance(
-        (start_point.x(), start_point.y()), (end_point.x(), end_point.y())
-    ) or distance(
-        (middle_point.x(), middle_point.y()), (start_point.x(), start_point.y())
-    ) > distance(
-        (start_point.x(), start_point.y()), (end_point.x(), end_point.y())
+def set_overview_scales(
+    result_layer: QgsVectorLayer, overview_layer: QgsVectorLayer
+) -> None:
+    """Shows the overview layer instead of the result layer at small scales."""
+    result_layer.setScaleBasedVisibility(True)
+    result_layer.setMinimumScale(OVERVIEW_SCALE)
+    overview_layer.setScaleBasedVisibility(True)
+    overview_layer.setMaximumScale(OVERVIEW_SCALE)
+
+
+def group_features_by_field(
+    layer: Union[QgsFeatureSource, QgsAbstractFeatureSource],
+    field_name: str,
+    request: Optional[QgsFeatureRequest] = None,
+    fields: Optional[QgsFields] = None,
+) -> Dict[str, List[QgsFeature]]:
+    """Reads the layer once and groups its features by the value of a field.
+
+    Instead of a layer, any feature source can be given, e.g. a Processing feature
+    source or a QgsVectorLayerFeatureSource, which is the thread safe way to read
+    a layer in a background task.
+
+    This is used to build an in-memory index of intersection data features (by
+    intersection "id") and branch location features (by "RPH"), so that each
+    intersection can be processed without selecting features from the layers.
+    Values are converted to strings so that the two layers can be matched
+    regardless of the field types. A request can be given to read only some of
+    the features or attributes. If fields are given, the features are converted
+    to have only those fields, to save memory with wide layers."""
+    index: Dict[str, List[QgsFeature]] = defaultdict(list)
+    for feat in _project_features(
+        layer.getFeatures(request or QgsFeatureRequest()), fields
     ):
-        mid_x = (start_point.x() + end_point.x()) / 2
-        mid_y = (start_point.y() + end_point.y()) / 2
-        middle_point = QgsPointXY(mid_x, mid_y)
+        index[str(feat[field_name])].append(feat)
+    return dict(index)
 
-    return middle_point
 
+def iterate_feature_groups(
+    layer: Union[QgsFeatureSource, QgsAbstractFeatureSource],
+    field_name: str,
+    request: Optional[QgsFeatureRequest] = None,
+    fields: Optional[QgsFields] = None,
+) -> Iterator[Tuple[str, List[QgsFeature]]]:
+    """Reads the features of the layer ordered by a field and yields them in
+    groups by the value of the field, like group_features_by_field.
 
-def calculate_intersection_center_point(
-    location_feats: List[QgsFeature],
-) -> tuple[float, float]:
-    """Calculates the intersection center point based on location of intersection branches.
-
-    Intersection center point is used in creating the curve geometries by shifting the
-    curve middle point towards intersection center. Duplicate branch locations are not
-    counted, so only unique points count."""
-    x_coords = set([feat.geometry().asPoint().x() for feat in location_feats])
-    y_coords = set([feat.geometry().asPoint().y() for feat in location_feats])
-    intersection_center_point = sum(x_coords) / len(x_coords), sum(y_coords) / len(
-        y_coords
+    Only one group is held in memory at a time, so this can be used to stream
+    large data layers. The ordering is pushed to the data provider if it
+    supports it (e.g. an indexed GeoPackage or PostGIS column) and otherwise
+    done by QGIS while reading."""
+    request = QgsFeatureRequest(request or QgsFeatureRequest())
+    request.addOrderBy(QgsExpression.quotedColumnRef(field_name))
+    features = _project_features(layer.getFeatures(request), fields)
+    for value, feats in groupby(features, key=lambda feat: str(feat[field_name])):
+        yield value, list(feats)
+
+
+def count_group_features(
+    data_groups: Iterable[Tuple[str, List[QgsFeature]]], group_sizes: Deque[int]
+) -> Iterator[Tuple[str, List[QgsFeature]]]:
+    """Yields the (intersection id, data features) groups and appends the number
+    of features of each group to group_sizes, so that the features read can be
+    counted after e.g. aggregate_data_groups has combined them."""
+    for intersection, data_feats in data_groups:
+        group_sizes.append(len(data_feats))
+        yield intersection, data_feats
+
+
+def count_features(
+    layer: Union[QgsFeatureSource, QgsAbstractFeatureSource],
+    request: QgsFeatureRequest,
+) -> int:
+    """Counts the features read with the request, e.g. the data features in the
+    period window, by reading them without geometries."""
+    count_request = QgsFeatureRequest(request)
+    count_request.setFlags(QgsFeatureRequest.NoGeometry)
+    return sum(1 for _ in layer.getFeatures(count_request))
+
+
+def _project_features(
+    features: Iterable[QgsFeature], fields: Optional[QgsFields]
+) -> Iterator[QgsFeature]:
+    """Converts the features to have only the given fields, if any."""
+    attribute_indexes: Optional[List[int]] = None
+    for feat in features:
+        if fields is not None:
+            if attribute_indexes is None:
+                attribute_indexes = [
+                    feat.fields().indexOf(name) for name in fields.names()
+                ]
+            projected_feat = QgsFeature(fields, feat.id())
+            projected_feat.setGeometry(feat.geometry())
+            attrs = feat.attributes()
+            projected_feat.setAttributes([attrs[i] for i in attribute_indexes])
+            feat = projected_feat
+        yield feat
+
+
+def select_data_fields(
+    data_layer_fields: QgsFields,
+    field_names: Optional[Collection[str]] = None,
+    aggregation: Optional[AggregationSettings] = None,
+) -> QgsFields:
+    """Returns the data layer fields that are carried to the result features.
+
+    If no field names are given, all fields are carried. Otherwise the fields
+    needed in the processing are carried in addition to the given ones. The
+    other attributes can be joined to the result by id and direction (and the
+    period field, if the rows have periods)."""
+    if field_names is None:
+        return QgsFields(data_layer_fields)
+    names = set(field_names) | set(REQUIRED_DATA_FIELDS)
+    if aggregation is not None and aggregation.period_field:
+        names.add(aggregation.period_field)
+    fields = QgsFields()
+    for data_field in data_layer_fields:
+        if data_field.name() in names:
+            fields.append(data_field)
+    return fields
+
+
+def create_data_request(
+    data_layer_fields: QgsFields,
+    fields: QgsFields,
+    aggregation: Optional[AggregationSettings] = None,
+    with_geometry: bool = False,
+) -> QgsFeatureRequest:
+    """Creates the request for reading the data features.
+
+    Only the attributes of the given fields are read. Geometries are read only if
+    requested, as they are used only to locate intersections in the branch
+    fallback matching. With aggregation, the rows are limited to the period
+    window."""
+    request = (
+        period_filter_request(aggregation)
+        if aggregation is not None
+        else QgsFeatureRequest()
     )
-    return intersection_center_point
-
-
-def find_start_and_end_points(
-    data_feat: QgsFeature, location_feats: List[QgsFeature]
-) -> tuple[QgsPointXY, QgsPointXY]:
-    """Tries to find matching branch location features for an intersection data feature.
-
-    The location point features are used as start and end point features to draw the
-    visualization curve on map. If no matches are found, None-types are returned and
-    this data feature cannot be visualized."""
-    start_point, end_point = None, None
-    for location_feat in location_feats:
-        point_id = location_feat["Piste"]
-        if point_id == data_feat["id"][-len(point_id) :]:
-            if str(location_feat["Haara"]) == data_feat["direction"][0]:
-                start_point = location_feat.geometry().asPoint()
-            elif str(location_feat["Haara"]) == data_feat["direction"][1]:
-                end_point = location_feat.geometry().asPoint()
-        if start_point and end_point:
-            break
-    return start_point, end_point
-
-
-def determine_straight_road(
-    data_feat: QgsFeature, location_feats: List[QgsFeature]
-) -> bool:
-    """Determine if an intersection branch pair is likely a straight road.
-
-    Currently, a road is deemed straight if 2 things apply: The whole intersection
-    has exactly 4 branches, and this branch pair / road has ID's with a difference of 2
-    (e.g. 1 and 3, or 2 and 4)"""
-    nr_of_branches = max([int(feat["Haara"]) for feat in location_feats])
-    if (
-        nr_of_branches == 4
-        and abs(int(data_feat["direction"][0]) - int(data_feat["direction"][1])) == 2
-    ):
-        return True
-    else:
-        return False
-
-
-def calculate_move_vector(
-    start_point: QgsPointXY,
-    intersection_center_point: tuple[float, float],
-    unit_vector: np.ndarray,
-) -> np.ndarray:
-    """Calculate the vector by which a visualized line is moved.
-
-    Moving of the visuals is done to minimize overlapping. For different
-    directions but same branch pair, moved_list is used and move vector
-    is higher for the second curve of the pair. If there is data from multiple
-    days and/or times, this overlapping cannot be avoided as of now."""
-
-    # Move the start and end points away from intersection center
-    # First make sure the direction is away from the intersection center
-    inner = True
-    if distance(
-        (start_point.x(), start_point.y()), intersection_center_point
-    ) > distance(
-        (start_point.x() + unit_vector[0], start_point.y() + unit_vector[1]),
-        intersection_center_point,
-    ):
-        inner = False
-        unit_vector = -unit_vector
-    # Draw curve at different distance from intersection center depending
-    # on the traffic direction
-    if inner:
-        move_vector = 6 * unit_vector
-    else:
-        move_vector = 10 * unit_vector
+    if not with_geometry:
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(fields.names(), data_layer_fields)
+    return request
 
-    return move_vector
 
+def create_branch_request(points_layer_fields: QgsFields) -> QgsFeatureRequest:
+    """Creates the request for reading the branch location features with only the
+    attributes that are used."""
+    request = QgsFeatureRequest()
+    request.setSubsetOfAttributes(list(BRANCH_FIELDS), points_layer_fields)
+    return request
 
-def create_and_add_feature(
-    data_feat: QgsFeature,
-    result_layer: QgsVectorLayer,
-    start_point: QgsPointXY,
-    mid_point: QgsPointXY,
-    end_point: QgsPointXY,
-    move_vector: np.ndarray,
-) -> QgsFeature:
-    """Create the curve feature (CircularString) that represents traffic from one
-    intersection branch to another and add it to the result layer.
 
-    The calculated move vector is utilized here to shift the points before creating
-    the curve geometry. Attribute data is set here as much as possible."""
-    start_point = QgsPointXY(
-        start_point.x() + move_vector[0], start_point.y() + move_vector[1]
+def create_aggregated_fields(data_layer_fields: QgsFields) -> QgsFields:
+    """Define the attributes of the data features after aggregation.
+
+    The data layer fields are copied and a field is added for the counts of the
+    aggregated periods."""
+    fields = QgsFields(data_layer_fields)
+    fields.append(QgsField(PERIOD_COUNTS_FIELD, QVariant.String))
+    return fields
+
+
+def period_filter_request(settings: AggregationSettings) -> QgsFeatureRequest:
+    """Creates a request for the data features in the period window of the
+    aggregation settings.
+
+    The window is compared with a QGIS expression, so the limits are converted to
+    the type of the period field, e.g. to dates."""
+    request = QgsFeatureRequest()
+    if settings.period_field is None:
+        return request
+    column = QgsExpression.quotedColumnRef(settings.period_field)
+    conditions = []
+    if settings.period_start:
+        conditions.append(
+            f"{column} >= {QgsExpression.quotedValue(settings.period_start)}"
+        )
+    if settings.period_end:
+        conditions.append(
+            f"{column} <= {QgsExpression.quotedValue(settings.period_end)}"
+        )
+    if conditions:
+        request.setFilterExpression(" AND ".join(conditions))
+    return request
+
+
+def aggregate_data_features(
+    data_index: Dict[str, List[QgsFeature]],
+    fields: QgsFields,
+    settings: AggregationSettings,
+) -> Dict[str, List[QgsFeature]]:
+    """Combines the data features of each intersection and direction into one.
+
+    The fields must be created with create_aggregated_fields. The attributes of
+    the first feature of each direction are used, with autot replaced by the
+    aggregated count and the period field cleared. The counts of the periods are
+    stored as JSON: an object keyed by period if there is a period field and a
+    list otherwise. Rows of the same period are summed before aggregating the
+    periods."""
+    return dict(aggregate_data_groups(data_index.items(), fields, settings))
+
+
+def aggregate_data_groups(
+    data_groups: Iterable[Tuple[str, List[QgsFeature]]],
+    fields: QgsFields,
+    settings: AggregationSettings,
+) -> Iterator[Tuple[str, List[QgsFeature]]]:
+    """Aggregates the data features of each (intersection id, data features) group
+    as they are read, see aggregate_data_features."""
+    autot_index = fields.indexOf("autot")
+    period_index = (
+        fields.indexOf(settings.period_field) if settings.period_field else -1
     )
-    middle_point = QgsPointXY(
-        mid_point.x() + move_vector[0], mid_point.y() + move_vector[1]
+    for intersection, data_feats in data_groups:
+        direction_feats: Dict[str, List[QgsFeature]] = defaultdict(list)
+        for feat in data_feats:
+            direction_feats[str(feat["direction"])].append(feat)
+
+        aggregated_feats = []
+        for feats in direction_feats.values():
+            counts = [int(feat["autot"]) for feat in feats]
+            if period_index >= 0:
+                summed_counts: Dict[str, int] = defaultdict(int)
+                for feat, count in zip(feats, counts):
+                    summed_counts[str(feat[period_index])] += count
+                period_counts: Union[Dict[str, int], List[int]] = dict(summed_counts)
+                counts = list(summed_counts.values())
+            else:
+                period_counts = counts
+            attrs = feats[0].attributes()
+            attrs[autot_index] = aggregate_counts(counts, settings.method)
+            if period_index >= 0:
+                attrs[period_index] = None
+            aggregated_feat = QgsFeature(fields)
+            aggregated_feat.setGeometry(feats[0].geometry())
+            aggregated_feat.setAttributes(attrs + [json.dumps(period_counts)])
+            aggregated_feats.append(aggregated_feat)
+        yield intersection, aggregated_feats
+
+
+def group_branch_features(
+    layer: Union[QgsFeatureSource, QgsAbstractFeatureSource],
+    intersection_ids: Optional[Collection[str]],
+    polygons: bool = False,
+    request: Optional[QgsFeatureRequest] = None,
+) -> Dict[str, List[QgsFeature]]:
+    """Groups the branch location features of the given intersections by "RPH".
+
+    Features of other intersections are skipped, unless intersection_ids is None.
+    A request can be given to read only some of the attributes, see
+    create_branch_request. If the branch locations are polygons, the geometries
+    of the grouped features are replaced with their centroids, the same way as
+    the QGIS Centroids algorithm does, but only for the intersections that are
+    actually processed."""
+    index: Dict[str, List[QgsFeature]] = defaultdict(list)
+    for feat in layer.getFeatures(request or QgsFeatureRequest()):
+        intersection_id = str(feat["RPH"])
+        if intersection_ids is not None and intersection_id not in intersection_ids:
+            continue
+        if polygons:
+            feat.setGeometry(feat.geometry().centroid())
+        index[intersection_id].append(feat)
+    return dict(index)
+
+
+class CentroidCache:
+    """Branch location centroids of polygon layers, kept between runs.
+
+    The centroids are cached per layer and intersection id, so a repeated run
+    only calculates the centroids of intersections that were not processed
+    before. The layers must be watched (in the main thread) before their
+    centroids are requested. The entries of a layer are dropped whenever its data
+    or its filter changes, including uncommitted edits, or the layer is removed.
+
+    The centroids may be requested from a background task, so the entries are
+    guarded with a lock."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, List[QgsFeature]]] = {}
+        self._watched_layer_ids: Set[str] = set()
+
+    def watch(self, layer: QgsVectorLayer) -> None:
+        layer_id = layer.id()
+        if layer_id in self._watched_layer_ids:
+            return
+        self._watched_layer_ids.add(layer_id)
+        layer.dataChanged.connect(lambda: self.invalidate(layer_id))
+        layer.subsetStringChanged.connect(lambda: self.invalidate(layer_id))
+        layer.willBeDeleted.connect(lambda: self._forget(layer_id))
+
+    def invalidate(self, layer_id: str) -> None:
+        with self._lock:
+            self._entries.pop(layer_id, None)
+
+    def _forget(self, layer_id: str) -> None:
+        self.invalidate(layer_id)
+        self._watched_layer_ids.discard(layer_id)
+
+    def group_features(
+        self,
+        layer_id: str,
+        layer: Union[QgsFeatureSource, QgsAbstractFeatureSource],
+        intersection_ids: Collection[str],
+        request: Optional[QgsFeatureRequest] = None,
+    ) -> Dict[str, List[QgsFeature]]:
+        """Returns the centroid features of the given intersections, grouped by
+        "RPH" like group_branch_features does.
+
+        The layer (or a feature source of it) is read only if some of the
+        intersections are not cached yet."""
+        with self._lock:
+            entry = self._entries.setdefault(layer_id, {})
+            missing_ids = {
+                intersection_id
+                for intersection_id in intersection_ids
+                if intersection_id not in entry
+            }
+        index = (
+            group_branch_features(layer, missing_ids, True, request)
+            if missing_ids
+            else {}
+        )
+        with self._lock:
+            # The layer may have changed while the centroids were calculated
+            if self._entries.get(layer_id) is entry:
+                for intersection_id in missing_ids:
+                    entry[intersection_id] = index.get(intersection_id, [])
+
+        features: Dict[str, List[QgsFeature]] = {}
+        for intersection_id in intersection_ids:
+            feats = index.get(intersection_id) or entry.get(intersection_id)
+            if feats:
+                features[intersection_id] = feats
+        return features
+
+
+# Shared by all runs of the plugin dialog
+CENTROID_CACHE = CentroidCache()
+
+
+def default_geometry_cache_path() -> str:
+    """Returns the path of the geometry cache in the active QGIS profile."""
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), GEOMETRY_CACHE_PATH)
+
+
+def branch_from_feature(location_feat: QgsFeature) -> Branch:
+    """Converts a branch location feature to plain data."""
+    point = location_feat.geometry().asPoint()
+    return Branch(
+        str(location_feat["Piste"]), str(location_feat["Haara"]), point.x(), point.y()
     )
-    end_point = QgsPointXY(
-        end_point.x() + move_vector[0], end_point.y() + move_vector[1]
+
+
+def flow_from_feature(data_feat: QgsFeature) -> Flow:
+    """Converts an intersection data feature to plain data."""
+    return Flow(
+        str(data_feat["id"]), str(data_feat["direction"]), int(data_feat["autot"])
     )
 
-    result_layer.startEditing()
-    feat = QgsFeature(result_layer.fields())
-    circular_ring = QgsCircularString(
-        QgsPoint(start_point), QgsPoint(middle_point), QgsPoint(end_point)
+
+def data_location(data_feats: List[QgsFeature]) -> Optional[Tuple[float, float]]:
+    """Returns the mean location of the data features of an intersection, or None
+    if they have no geometries (which is usually the case).
+
+    The data layer is expected to be in the same CRS as the branch locations."""
+    points = [
+        feat.geometry().centroid().asPoint()
+        for feat in data_feats
+        if feat.hasGeometry() and not feat.geometry().isEmpty()
+    ]
+    if not points:
+        return None
+    return (
+        sum(point.x() for point in points) / len(points),
+        sum(point.y() for point in points) / len(points),
     )
-    geom = QgsGeometry(circular_ring)
-    feat.setGeometry(geom)
-    attrs = data_feat.attributes() + [
+
+
+def create_branch_grid(
+    points_index: Dict[str, List[QgsFeature]], radius: float = BRANCH_SEARCH_RADIUS
+) -> BranchGrid:
+    """Creates a grid index of all the branch locations in the index."""
+    return BranchGrid(
+        [
+            branch_from_feature(feat)
+            for feats in points_index.values()
+            for feat in feats
+        ],
+        radius,
+    )
+
+
+def create_curve_geometry(
+    start_point: Tuple[float, float],
+    middle_point: Tuple[float, float],
+    end_point: Tuple[float, float],
+) -> QgsGeometry:
+    """Create the curve (CircularString) through the points calculated with
+    calculate_curve_points."""
+    return QgsGeometry(
+        QgsCircularString(
+            QgsPoint(*start_point), QgsPoint(*middle_point), QgsPoint(*end_point)
+        )
+    )
+
+
+def create_line_geometry(vertices: np.ndarray) -> QgsGeometry:
+    """Create a LineString from the vertices calculated with segmentize_curves."""
+    return QgsGeometry(QgsLineString(vertices[:, 0].tolist(), vertices[:, 1].tolist()))
+
+
+def create_feature(
+    data_feat: QgsFeature,
+    fields: QgsFields,
+    geometry: QgsGeometry,
+    intersection_stats: Tuple[int, int],
+    normalized_value: float,
+    normalized_values: Sequence[float] = (),
+) -> QgsFeature:
+    """Create the feature that represents traffic from one intersection branch to
+    another.
+
+    The geometry is either the curve or the line created from it. All
+    attributes, including the intersection max and min values and the normalized
+    traffic amount, are set here so the feature can be added to the result layer
+    as is. The values of the additional normalizations, if any, are added last."""
+    feat = QgsFeature(fields)
+    feat.setGeometry(geometry)
+    feat.setAttributes(
+        create_result_attributes(
+            data_feat, intersection_stats, normalized_value, normalized_values
+        )
+    )
+    return feat
+
+
+def create_result_attributes(
+    data_feat: QgsFeature,
+    intersection_stats: Tuple[int, int],
+    normalized_value: float,
+    normalized_values: Sequence[float] = (),
+) -> List[Any]:
+    """Returns the attributes of a result feature, in the order of the fields
+    created with create_result_fields."""
+    intersection_max_value, intersection_min_value = intersection_stats
+    return data_feat.attributes() + [
         int(data_feat["autot"]),
         data_feat["direction"][0],
+        intersection_max_value,
+        intersection_min_value,
+        normalized_value,
+        *normalized_values,
     ]
-    feat.setAttributes(attrs)
-    _ = result_layer.dataProvider().addFeature(feat)
-    result_layer.commitChanges()
-    return feat
 
 
-def process_intersection(
-    points_layer: QgsVectorLayer,
-    data_layer: QgsVectorLayer,
-    result_layer: QgsVectorLayer,
-    intersection_id,
-) -> bool:
-    """The main function that runs through processing and visualizing a whole intersection.
-
-    The steps:
-    1. Select features
-    2. Check if we found any location features
-    3. Find intersection center point
-    4. Initialize some values before loop
-    5. Loop data feats
-        1. Find the correct branch location feats for the data feat
-        2. Check if the branch location pair seems like a straight road
-        3. Calculate middle point for to-be-drawn visual
-        4. Calculate a vector perpendicular to the branch location pair
-        5. Calculate a move vector and move the points accordingly
-        6. Create a curved line feature from the points (the actual visualization)
-    6. Update some intersection attributes
-    """
-
-    # 1
-    data_layer.selectByExpression("id = '{}'".format(intersection_id))
-    data_feats = data_layer.selectedFeatures()
-
-    points_layer.selectByExpression("RPH = '{}'".format(intersection_id))
-    location_feats = points_layer.selectedFeatures()
-
-    # 2
-    if len(location_feats) == 0:
-        return False
-
-    # 3
-    intersection_center_point = calculate_intersection_center_point(location_feats)
-
-    # 4
-    added_features: List[QgsFeature] = []
-    intersection_max_value = 0
-    intersection_min_value = None
-
-    # 5
-    for data_feat in data_feats:
-
-        # 5.1
-        start_point, end_point = find_start_and_end_points(data_feat, location_feats)
-
-        # 5.2
-        straight_road = determine_straight_road(data_feat, location_feats)
-
-        if start_point and end_point:
-            # Update intersection max and min value
-            if int(data_feat["autot"]) > intersection_max_value:
-                intersection_max_value = int(data_feat["autot"])
-            if (
-                intersection_min_value is None
-                or int(data_feat["autot"]) < intersection_min_value
-            ):
-                intersection_min_value = int(data_feat["autot"])
+class FeatureBatchWriter:
+    """Collects result features and writes them to a feature sink in batches.
+
+    The sink can be e.g. the data provider of the result layer. Adding the features
+    with one addFeatures call per batch is much faster than adding and committing
+    them one by one. Remember to call flush after the last features are added."""
+
+    def __init__(self, sink: QgsFeatureSink, batch_size: int = 1000) -> None:
+        self.sink = sink
+        self.batch_size = batch_size
+        self.feature_count = 0
+        self._batch: List[QgsFeature] = []
+
+    def add_features(self, features: List[QgsFeature]) -> None:
+        self._batch.extend(features)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._batch:
+            self.sink.addFeatures(self._batch)
+            self.feature_count += len(self._batch)
+            self._batch = []
+
+
+@dataclass
+class IntersectionResult:
+    """The visualized features of an intersection and the data features that could
+    not be matched to its branch locations. The overview features are created only
+    if requested."""
+
+    features: List[QgsFeature] = field(default_factory=list)
+    unmatched_feats: List[QgsFeature] = field(default_factory=list)
+    overview_features: List[QgsFeature] = field(default_factory=list)
+
+
+# The normalized values of the matched flows of an intersection: the intersection
+# normalization and the additional normalized values of each flow
+NormalizedValues = Tuple[List[float], List[List[float]]]
 
-            # 5.3
-            middle_point = calculate_middle_point(
-                start_point, end_point, intersection_center_point, straight_road
+
+def normalize_intersections(
+    intersections: Sequence[Tuple[List[QgsFeature], Optional[IntersectionCurves]]],
+    normalization: Optional[Normalization] = None,
+) -> List[NormalizedValues]:
+    """Calculates the normalized values of the matched flows of many
+    intersections, given as (data features, curves), with one normalize_counts
+    call. Returns the values of each intersection; intersections without curves
+    have no values."""
+    counts: List[int] = []
+    start_branches: List[str] = []
+    flow_intersections: List[int] = []
+    flow_counts: List[int] = []
+    for i, (data_feats, curves) in enumerate(intersections):
+        matched_rows = curves.matched_rows if curves is not None else []
+        for row in matched_rows:
+            counts.append(int(data_feats[row]["autot"]))
+            start_branches.append(str(data_feats[row]["direction"])[0])
+        flow_intersections.extend([i] * len(matched_rows))
+        flow_counts.append(len(matched_rows))
+    normalizations = normalize_counts(
+        counts, start_branches, flow_intersections, normalization
+    )
+    normalized_values = normalizations.pop(INTERSECTION_NORMALIZATION).tolist()
+    additional_values = (
+        np.column_stack(list(normalizations.values())).tolist()
+        if normalizations
+        else [[] for _ in counts]
+    )
+    values: List[NormalizedValues] = []
+    start = 0
+    for flow_count in flow_counts:
+        values.append(
+            (
+                normalized_values[start : start + flow_count],
+                additional_values[start : start + flow_count],
             )
+        )
+        start += flow_count
+    return values
 
-            # Calculate perpendicular and normalized vector of a straight line
-            # from intersection branch to another
-            # 5.4
-            unit_vector = normalize(
-                perpendicular(
-                    (end_point.x() - start_point.x(), end_point.y() - start_point.y())
+
+def create_intersection_result(
+    data_feats: List[QgsFeature],
+    curves: Optional[IntersectionCurves],
+    fields: QgsFields,
+    timer: StageTimer = DISABLED_TIMER,
+    segmentation: Optional[Segmentation] = None,
+    overview: bool = False,
+    normalization: Optional[Normalization] = None,
+    normalized_values: Optional[NormalizedValues] = None,
+) -> Optional[IntersectionResult]:
+    """Creates curved line features (the actual visualization) from the curves
+    calculated for an intersection.
+
+    The data features must be in the same order as the flows the curves were
+    calculated from. If a segmentation is given, the curves are converted to
+    line strings, which are cheaper to draw. With overview, features with only
+    a few vertices are created as well, for drawing at small scales. The
+    normalized values can be calculated for many intersections at once with
+    normalize_intersections; otherwise they are calculated here."""
+    if curves is None:
+        return None
+    intersection_stats = curves.autot_max, curves.autot_min
+    matched_feats = [data_feats[row] for row in curves.matched_rows]
+    if normalized_values is None:
+        with timer.stage("normalization"):
+            normalized_values = normalize_intersections(
+                [(data_feats, curves)], normalization
+            )[0]
+    intersection_values, additional_values = normalized_values
+    # Creating the geometries and the features of the result is timed apart from
+    # calculating the curves and writing the features
+    with timer.stage("features"):
+        if segmentation is not None:
+            geometries = [
+                create_line_geometry(vertices)
+                for vertices in segmentize_curves(
+                    curves.start_points,
+                    curves.middle_points,
+                    curves.end_points,
+                    segmentation,
                 )
-            )
+            ]
+        else:
+            geometries = [
+                create_curve_geometry(start_point, middle_point, end_point)
+                for start_point, middle_point, end_point in zip(
+                    curves.start_points.tolist(),
+                    curves.middle_points.tolist(),
+                    curves.end_points.tolist(),
+                )
+            ]
+        if overview:
+            overview_geometries = [
+                create_line_geometry(vertices)
+                for vertices in segmentize_curves(
+                    curves.start_points,
+                    curves.middle_points,
+                    curves.end_points,
+                    Segmentation(vertex_count=OVERVIEW_VERTEX_COUNT),
+                )
+            ]
+        else:
+            overview_geometries = []
+        return IntersectionResult(
+            features=[
+                create_feature(
+                    data_feat,
+                    fields,
+                    geometry,
+                    intersection_stats,
+                    normalized_value,
+                    values,
+                )
+                for data_feat, geometry, normalized_value, values in zip(
+                    matched_feats, geometries, intersection_values, additional_values
+                )
+            ],
+            unmatched_feats=[data_feats[row] for row in curves.unmatched_rows],
+            overview_features=[
+                create_feature(
+                    data_feat,
+                    fields,
+                    geometry,
+                    intersection_stats,
+                    normalized_value,
+                    values,
+                )
+                for data_feat, geometry, normalized_value, values in zip(
+                    matched_feats,
+                    overview_geometries,
+                    intersection_values,
+                    additional_values,
+                )
+            ],
+        )
 
-            # 5.5
-            if straight_road:
-                move_vector = (
-                    -2 * unit_vector
-                )  # invert direction for right hand traffic visuals
-            else:
-                move_vector = calculate_move_vector(
-                    start_point,
-                    intersection_center_point,
-                    unit_vector,
+
+def process_intersection(
+    data_feats: List[QgsFeature],
+    location_feats: List[QgsFeature],
+    fields: QgsFields,
+) -> Optional[IntersectionResult]:
+    """The main function that runs through processing and visualizing a whole
+    intersection.
+
+    The data and location features of the intersection are given as lists, usually
+    taken from the indexes built with group_features_by_field. They are converted to
+    plain data for compute_intersection, which does the actual work. The created
+    result features have all their attributes set and are returned, so that the
+    caller can add them to the result layer in batches. Data features without
+    matching branch locations are returned too, so they can be reported. If no
+    location features are found for the intersection, None is returned."""
+    curves = compute_intersection(
+        [flow_from_feature(feat) for feat in data_feats],
+        [branch_from_feature(feat) for feat in location_feats],
+    )
+    return create_intersection_result(data_feats, curves, fields)
+
+
+@dataclass
+class RunSummary:
+    """Counts of a processing run, used to report the results to the user.
+
+    Of the data features without matching branch locations, only the (id,
+    direction) of the first UNMATCHED_LOG_LIMIT are kept."""
+
+    intersection_count: int = 0
+    failed_count: int = 0
+    feature_count: int = 0
+    unmatched_count: int = 0
+    unmatched_ids: List[Tuple[Any, Any]] = field(default_factory=list)
+
+    def add_unmatched(self, data_feats: List[QgsFeature]) -> None:
+        self.unmatched_count += len(data_feats)
+        for feat in data_feats[: UNMATCHED_LOG_LIMIT - len(self.unmatched_ids)]:
+            self.unmatched_ids.append((feat["id"], feat["direction"]))
+
+
+def compute_intersections(
+    intersection_inputs: Iterable[Tuple[str, List[Flow], List[Branch]]],
+    workers: int = 1,
+    cache: Optional[GeometryCache] = None,
+    timer: StageTimer = DISABLED_TIMER,
+    branch_fallback: bool = False,
+) -> Generator[Optional[IntersectionCurves], None, None]:
+    """Calculates the curves of the intersections, given as (intersection id, flows,
+    branches) tuples, and yields them in the same order.
+
+    The inputs are read lazily, COMPUTE_CHUNK_SIZE intersections at a time, so
+    they can be streamed from a generator. With more than one worker, the
+    intersections are calculated in a process pool that is shared by all chunks.
+    If a geometry cache is given, the curves of unchanged intersections are read
+    from it and only the rest are calculated and then stored to the cache. The
+    stages are timed only when the intersections are calculated in this process.
+    If the worker processes fail, e.g. when they cannot be started, the rest of
+    the intersections are calculated in this process. With branch fallback,
+    flows are also matched to branches by branch number.
+
+    The time spent on calculating and caching the curves of each intersection
+    is recorded with the timer, see StageTimer.add_intersection_time. In a
+    process pool, only the time of caching them is recorded."""
+    pool = IntersectionPool(workers, branch_fallback) if workers > 1 else None
+    inputs = iter(intersection_inputs)
+    try:
+        while True:
+            chunk = list(islice(inputs, COMPUTE_CHUNK_SIZE))
+            if not chunk:
+                break
+            with timer.stage("cache"):
+                cached_curves = [
+                    cache.load(*intersection_input, branch_fallback)
+                    if cache is not None
+                    else None
+                    for intersection_input in chunk
+                ]
+            missing_inputs = [
+                (flows, branches)
+                for (_, flows, branches), curves in zip(chunk, cached_curves)
+                if curves is None
+            ]
+            if pool is not None:
+                try:
+                    # The results of the chunk are collected before yielding any,
+                    # so that the chunk can still be calculated in this process
+                    computed_curves = iter(list(pool.map(missing_inputs)))
+                except BrokenProcessPool:
+                    LOGGER.warning(
+                        "Worker processes could not be run, calculating the "
+                        "intersections in one process"
+                    )
+                    pool.close()
+                    pool = None
+            if pool is None:
+                computed_curves = (
+                    compute_intersection(flows, branches, timer, branch_fallback)
+                    for flows, branches in missing_inputs
+                )
+
+            for (intersection_id, flows, branches), curves in zip(chunk, cached_curves):
+                if curves is None:
+                    start_time = time.perf_counter()
+                    curves = next(computed_curves)
+                    if cache is not None:
+                        with timer.stage("cache"):
+                            cache.store(
+                                intersection_id,
+                                flows,
+                                branches,
+                                curves,
+                                branch_fallback,
+                            )
+                    timer.add_intersection_time(
+                        intersection_id, time.perf_counter() - start_time
+                    )
+                yield curves
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def process_intersections(
+    data_index: Dict[str, List[QgsFeature]],
+    points_index: Dict[str, List[QgsFeature]],
+    fields: QgsFields,
+    writer: FeatureBatchWriter,
+    feedback: Optional[QgsFeedback] = None,
+    workers: int = 1,
+    cache: Optional[GeometryCache] = None,
+    timer: StageTimer = DISABLED_TIMER,
+    segmentation: Optional[Segmentation] = None,
+    overview_writer: Optional[FeatureBatchWriter] = None,
+    branch_grid: Optional[BranchGrid] = None,
+    normalization: Optional[Normalization] = None,
+) -> RunSummary:
+    """Processes all intersections of the data index and writes the result features.
+
+    We want to handle one intersection at a time to create visuals that would
+    overlap as little as possible. Intersections without any location features are
+    counted as failed. If a feedback is given, it is used to report progress and
+    the processing stops early if it is canceled.
+
+    The curves are calculated with compute_intersections, optionally in a process
+    pool and using a geometry cache. The features are still created and written
+    here, in the same order as when processing the intersections one by one, so
+    the output is identical. The stages and the time spent on each intersection
+    are recorded with the given timer.
+
+    If a segmentation is given, line strings are written instead of curves. If an
+    overview writer is given, lines with only a few vertices are written to it as
+    well.
+
+    If a branch grid of all branch locations is given, branches that could not be
+    matched by RPH are searched by proximity, and flows are matched to branches
+    by branch number if their Piste does not match. Intersections without any
+    location features are then located by the data feature geometries, if any.
+
+    If a normalization is given, its additional normalized values are written as
+    well. The result fields must have been created with the same normalization."""
+    return process_intersection_groups(
+        data_index.items(),
+        points_index,
+        fields,
+        writer,
+        feedback,
+        workers,
+        cache,
+        timer,
+        segmentation,
+        overview_writer,
+        branch_grid,
+        intersection_count=len(data_index),
+        normalization=normalization,
+    )
+
+
+def create_intersection_input(
+    intersection: str,
+    data_feats: List[QgsFeature],
+    points_index: Dict[str, List[QgsFeature]],
+    branch_grid: Optional[BranchGrid] = None,
+) -> Tuple[List[Flow], List[Branch]]:
+    """Converts the data features and the branch locations of an intersection to
+    plain data for compute_intersection. If a branch grid is given, the
+    branches found by proximity are added, see process_intersections."""
+    flows = [flow_from_feature(feat) for feat in data_feats]
+    branches = [
+        branch_from_feature(feat) for feat in points_index.get(intersection, [])
+    ]
+    if branch_grid is not None:
+        branches = add_nearby_branches(
+            flows, branches, branch_grid, data_location(data_feats)
+        )
+    return flows, branches
+
+
+def create_intersection_tables(
+    data_groups: Iterable[Tuple[str, List[QgsFeature]]],
+    points_index: Dict[str, List[QgsFeature]],
+    branch_grid: Optional[BranchGrid] = None,
+) -> IntersectionTables:
+    """Prepares the inputs of the intersections as IntersectionTables, which can
+    be saved and processed later with process_prepared_intersections. The source
+    rows of the flows are the ids of their data features."""
+    return IntersectionTables.from_intersections(
+        (
+            intersection,
+            *create_intersection_input(
+                intersection, data_feats, points_index, branch_grid
+            ),
+            [feat.id() for feat in data_feats],
+        )
+        for intersection, data_feats in data_groups
+    )
+
+
+def process_prepared_intersections(
+    tables: IntersectionTables,
+    data_fields: QgsFields,
+    fields: QgsFields,
+    writer: FeatureBatchWriter,
+    feedback: Optional[QgsFeedback] = None,
+    workers: int = 1,
+    cache: Optional[GeometryCache] = None,
+    timer: StageTimer = DISABLED_TIMER,
+    segmentation: Optional[Segmentation] = None,
+    overview_writer: Optional[FeatureBatchWriter] = None,
+    branch_fallback: bool = False,
+    normalization: Optional[Normalization] = None,
+) -> RunSummary:
+    """Processes the intersections of prepared inputs, see process_intersections,
+    without reading the source layers.
+
+    The data features are created from the flows, so only the id, direction and
+    autot fields of the data fields are set. Their feature ids are the source
+    rows of the flows. The branches found by proximity are already in the
+    tables, but flows are matched to branches by branch number only with branch
+    fallback."""
+    id_index, direction_index, autot_index = (
+        data_fields.indexOf(name) for name in REQUIRED_DATA_FIELDS
+    )
+    pending_intersections: Deque[Tuple[str, List[Flow], List[int]]] = deque()
+
+    def create_intersection_inputs() -> Iterator[Tuple[str, List[Flow], List[Branch]]]:
+        for (
+            intersection,
+            flows,
+            branches,
+            source_rows,
+        ) in tables.prepared_intersections():
+            if feedback is not None and feedback.isCanceled():
+                return
+            pending_intersections.append((intersection, flows, source_rows))
+            yield intersection, flows, branches
+
+    def compute_prepared_intersections() -> Generator[
+        Tuple[str, List[QgsFeature], Optional[IntersectionCurves]], None, None
+    ]:
+        all_curves = compute_intersections(
+            create_intersection_inputs(), workers, cache, timer, branch_fallback
+        )
+        try:
+            for curves in all_curves:
+                intersection, flows, source_rows = pending_intersections.popleft()
+                data_feats = []
+                for flow, source_row in zip(flows, source_rows):
+                    feat = QgsFeature(data_fields, source_row)
+                    feat.setAttribute(id_index, flow.data_id)
+                    feat.setAttribute(direction_index, flow.direction)
+                    feat.setAttribute(autot_index, flow.autot)
+                    data_feats.append(feat)
+                yield intersection, data_feats, curves
+        finally:
+            all_curves.close()
+
+    return write_intersection_results(
+        compute_prepared_intersections(),
+        fields,
+        writer,
+        feedback,
+        timer,
+        segmentation,
+        overview_writer,
+        len(tables),
+        normalization=normalization,
+    )
+
+
+def process_intersection_groups(
+    data_groups: Iterable[Tuple[str, List[QgsFeature]]],
+    points_index: Dict[str, List[QgsFeature]],
+    fields: QgsFields,
+    writer: FeatureBatchWriter,
+    feedback: Optional[QgsFeedback] = None,
+    workers: int = 1,
+    cache: Optional[GeometryCache] = None,
+    timer: StageTimer = DISABLED_TIMER,
+    segmentation: Optional[Segmentation] = None,
+    overview_writer: Optional[FeatureBatchWriter] = None,
+    branch_grid: Optional[BranchGrid] = None,
+    intersection_count: Optional[int] = None,
+    feature_count: Optional[int] = None,
+    normalization: Optional[Normalization] = None,
+    group_sizes: Optional[Deque[int]] = None,
+) -> RunSummary:
+    """Processes the intersections given as (intersection id, data features) groups,
+    see process_intersections.
+
+    The groups are read lazily, so they can be streamed from the data layer with
+    iterate_feature_groups. Only the intersections of the chunk being calculated
+    are then held in memory, apart from the branch locations and the result
+    features of a memory layer. The progress is reported by intersections if
+    their count is known and otherwise by data features, if their count is
+    known. If the groups have been aggregated, the sizes of the groups as read
+    must be given to count the data features, see count_group_features."""
+    pending_groups: Deque[Tuple[str, List[QgsFeature]]] = deque()
+
+    def create_intersection_inputs() -> Iterator[Tuple[str, List[Flow], List[Branch]]]:
+        for intersection, data_feats in data_groups:
+            if feedback is not None and feedback.isCanceled():
+                return
+            with timer.stage("select"):
+                flows, branches = create_intersection_input(
+                    intersection, data_feats, points_index, branch_grid
                 )
+            pending_groups.append((intersection, data_feats))
+            yield intersection, flows, branches
 
-            # 5.6
-            feat = create_and_add_feature(
-                data_feat,
-                result_layer,
-                start_point,
-                middle_point,
-                end_point,
-                move_vector,
+    def compute_intersection_groups() -> Generator[
+        Tuple[str, List[QgsFeature], Optional[IntersectionCurves]], None, None
+    ]:
+        all_curves = compute_intersections(
+            create_intersection_inputs(), workers, cache, timer, branch_grid is not None
+        )
+        try:
+            for curves in all_curves:
+                intersection, data_feats = pending_groups.popleft()
+                yield intersection, data_feats, curves
+        finally:
+            all_curves.close()
+
+    return write_intersection_results(
+        compute_intersection_groups(),
+        fields,
+        writer,
+        feedback,
+        timer,
+        segmentation,
+        overview_writer,
+        intersection_count,
+        feature_count,
+        normalization,
+        group_sizes,
+    )
+
+
+def write_intersection_results(
+    intersections: Generator[
+        Tuple[str, List[QgsFeature], Optional[IntersectionCurves]], None, None
+    ],
+    fields: QgsFields,
+    writer: FeatureBatchWriter,
+    feedback: Optional[QgsFeedback] = None,
+    timer: StageTimer = DISABLED_TIMER,
+    segmentation: Optional[Segmentation] = None,
+    overview_writer: Optional[FeatureBatchWriter] = None,
+    intersection_count: Optional[int] = None,
+    feature_count: Optional[int] = None,
+    normalization: Optional[Normalization] = None,
+    group_sizes: Optional[Deque[int]] = None,
+) -> RunSummary:
+    """Creates and writes the result features of the (intersection id, data
+    features, curves) of each intersection, see process_intersection_groups.
+
+    The intersections are read COMPUTE_CHUNK_SIZE at a time, and the normalized
+    values of each chunk are calculated at once, see normalize_intersections.
+    The time recorded for each intersection is the time of creating and writing
+    its features, in addition to the time recorded while calculating its curves.
+    A chunk is cut short and the generator is closed when the processing is
+    canceled."""
+    summary = RunSummary()
+    processed_feature_count = 0
+
+    def read_chunk() -> List[
+        Tuple[str, List[QgsFeature], Optional[IntersectionCurves]]
+    ]:
+        # The curves may be calculated while the chunk is read
+        chunk = []
+        for item in intersections:
+            chunk.append(item)
+            if len(chunk) >= COMPUTE_CHUNK_SIZE or (
+                feedback is not None and feedback.isCanceled()
+            ):
+                break
+        return chunk
+
+    try:
+        while feedback is None or not feedback.isCanceled():
+            chunk = read_chunk()
+            if not chunk:
+                break
+            with timer.stage("normalization"):
+                chunk_values = normalize_intersections(
+                    [(data_feats, curves) for _, data_feats, curves in chunk],
+                    normalization,
+                )
+            intersection_start_time = time.perf_counter()
+            for (intersection, data_feats, curves), normalized_values in zip(
+                chunk, chunk_values
+            ):
+                if feedback is not None and feedback.isCanceled():
+                    break
+                result = create_intersection_result(
+                    data_feats,
+                    curves,
+                    fields,
+                    timer,
+                    segmentation,
+                    overview_writer is not None,
+                    normalization,
+                    normalized_values,
+                )
+                if result is None:
+                    summary.failed_count += 1
+                else:
+                    with timer.stage("insert"):
+                        writer.add_features(result.features)
+                        if overview_writer is not None:
+                            overview_writer.add_features(result.overview_features)
+                    summary.add_unmatched(result.unmatched_feats)
+                summary.intersection_count += 1
+                processed_feature_count += (
+                    group_sizes.popleft()
+                    if group_sizes is not None
+                    else len(data_feats)
+                )
+                if feedback is not None:
+                    if intersection_count:
+                        feedback.setProgress(
+                            summary.intersection_count / intersection_count * 100
+                        )
+                    elif feature_count and feature_count > 0:
+                        feedback.setProgress(
+                            processed_feature_count / feature_count * 100
+                        )
+                intersection_end_time = time.perf_counter()
+                timer.add_intersection(
+                    intersection, intersection_end_time - intersection_start_time
+                )
+                intersection_start_time = intersection_end_time
+    finally:
+        intersections.close()
+    with timer.stage("insert"):
+        writer.flush()
+        if overview_writer is not None:
+            overview_writer.flush()
+    summary.feature_count = writer.feature_count
+    return summary
+
+
+class DatabaseTables(NamedTuple):
+    """The database files and tables of the data and points layers."""
+
+    data_path: str
+    data_table: str
+    points_path: str
+    points_table: str
+
+
+def database_table(layer: QgsVectorLayer) -> Optional[Tuple[str, str]]:
+    """Returns the database path and table name of a GeoPackage or SpatiaLite
+    layer that can be read directly with SQLite.
+
+    None is returned for other layers and for layers that have a filter, unsaved
+    edits or fields that are not in the table (e.g. virtual or joined fields),
+    as those are only seen through QGIS."""
+    if layer.subsetString() or layer.isModified():
+        return None
+    fields = layer.fields()
+    if any(
+        fields.fieldOrigin(i) != QgsFields.OriginProvider for i in range(fields.count())
+    ):
+        return None
+    provider = layer.dataProvider().name()
+    if provider == "spatialite":
+        uri = QgsDataSourceUri(layer.source())
+        return uri.database(), uri.table()
+    if provider == "ogr" and layer.storageType() in ("GPKG", "SQLite"):
+        parts = QgsProviderRegistry.instance().decodeUri(provider, layer.source())
+        if parts.get("path") and parts.get("layerName"):
+            return parts["path"], parts["layerName"]
+    return None
+
+
+def database_tables(
+    data_layer: QgsVectorLayer, points_layer: QgsVectorLayer
+) -> Optional[DatabaseTables]:
+    """Returns the database tables of the layers, if both of them can be read
+    directly with SQLite and the branch locations are points.
+
+    None is also returned if the SQLite library is too old for the queries,
+    see sql_pushdown.is_supported."""
+    if not is_supported():
+        return None
+    data_table = database_table(data_layer)
+    points_table = database_table(points_layer)
+    if (
+        data_table is None
+        or points_table is None
+        or points_layer.geometryType() != QgsWkbTypes.PointGeometry
+    ):
+        return None
+    return DatabaseTables(*data_table, *points_table)
+
+
+def process_database_intersections(
+    tables: DatabaseTables,
+    data_fields: QgsFields,
+    fields: QgsFields,
+    writer: FeatureBatchWriter,
+    feedback: Optional[QgsFeedback] = None,
+    timer: StageTimer = DISABLED_TIMER,
+    segmentation: Optional[Segmentation] = None,
+    overview_writer: Optional[FeatureBatchWriter] = None,
+    intersection_count: Optional[int] = None,
+    normalization: Optional[Normalization] = None,
+) -> RunSummary:
+    """Processes all intersections of a GeoPackage or SpatiaLite data table with
+    SQL push-down.
+
+    The grouping by intersection, the matching of the flows to their branch
+    locations and the intersection max and min values are calculated by SQLite
+    in one query, see query_intersections, and the data features are created from
+    the queried rows. The intersections are processed in id order. Aggregation,
+    spatial matching, polygon branch locations and the geometry cache are not
+    supported. The intersections are counted, if their count is not given."""
+    connection = connect(tables.data_path, tables.points_path)
+
+    def query_intersection_features() -> Generator[
+        Tuple[str, List[QgsFeature], Optional[IntersectionCurves]], None, None
+    ]:
+        start_time = time.perf_counter()
+        for intersection, data_rows, curves in query_intersections(
+            connection,
+            tables.data_table,
+            tables.points_table,
+            data_fields.names(),
+            timer=timer,
+        ):
+            data_feats = []
+            for fid, *attrs in data_rows:
+                feat = QgsFeature(data_fields, fid)
+                feat.setAttributes(attrs)
+                data_feats.append(feat)
+            timer.add_intersection_time(intersection, time.perf_counter() - start_time)
+            yield intersection, data_feats, curves
+            start_time = time.perf_counter()
+
+    try:
+        return write_intersection_results(
+            query_intersection_features(),
+            fields,
+            writer,
+            feedback,
+            timer,
+            segmentation,
+            overview_writer,
+            intersection_count
+            if intersection_count is not None
+            else count_intersections(connection, tables.data_table),
+            normalization=normalization,
+        )
+    finally:
+        connection.close()
+
+
+def count_database_intersections(tables: DatabaseTables) -> int:
+    connection = connect(tables.data_path, tables.points_path)
+    try:
+        return count_intersections(connection, tables.data_table)
+    finally:
+        connection.close()
+
+
+def database_counts(tables: DatabaseTables) -> np.ndarray:
+    connection = connect(tables.data_path, tables.points_path)
+    try:
+        return query_counts(connection, tables.data_table, tables.points_table)
+    finally:
+        connection.close()
+
+
+def dataset_counts(
+    data_groups: Iterable[Tuple[str, List[QgsFeature]]],
+    points_index: Dict[str, List[QgsFeature]],
+    branch_grid: Optional[BranchGrid] = None,
+) -> Iterator[int]:
+    """Yields the traffic counts of the data features of the groups that are
+    matched to branch locations, for the normalizations that need the counts of
+    the whole dataset. Unmatched features do not get a curve, so they are not
+    counted, like in query_counts. The branches are found like in
+    process_intersection_groups."""
+    return matched_counts(
+        (
+            create_intersection_input(
+                intersection, data_feats, points_index, branch_grid
             )
-            added_features.append(feat)
-
-    # 6
-    with edit(result_layer):
-        for feat in added_features:
-            normalized_value = int(feat["autot"]) / intersection_max_value
-            feat["intersection_autot_max"] = intersection_max_value
-            feat["intersection_autot_min"] = intersection_min_value
-            feat["intersection_autot_normalized"] = normalized_value
-            result_layer.updateFeature(feat)
-
-    return True
-
-
-def write_output_to_file(layer: QgsVectorLayer, output_path: str) -> None:
-    """Writes the selected layer to a specified file"""
-    writer_options = QgsVectorFileWriter.SaveVectorOptions()
-    writer_options.actionOnExistingFile = QgsVectorFileWriter.AppendToLayerAddFields
-    # PyQGIS documentation doesnt tell what the last 2 str error outputs
-    # should be used for
-    error, explanation = QgsVectorFileWriter.writeAsVectorFormatV2(
-        layer,
+            for intersection, data_feats in data_groups
+        ),
+        branch_grid is not None,
+    )
+
+
+def create_output_file_writer(
+    output_path: str,
+    fields: QgsFields,
+    crs: QgsCoordinateReferenceSystem,
+    transform_context: QgsCoordinateTransformContext,
+    layer_name: str = RESULT_FILE_LAYER_NAME,
+    wkb_type: QgsWkbTypes.Type = QgsWkbTypes.CompoundCurve,
+    overwrite_file: bool = True,
+) -> QgsVectorFileWriter:
+    """Creates a feature sink that writes the result features directly to a file.
+
+    The file format is deduced from the file extension, e.g. GeoPackage (.gpkg) or
+    FlatGeobuf (.fgb). Using this instead of the result memory layer keeps the
+    memory use bounded, as the features are written to disk batch by batch. An
+    existing file is overwritten, unless overwrite_file is False, in which case
+    the layer is added to the existing GeoPackage (or an existing layer with the
+    same name is overwritten). The file is finalized when the writer is
+    deleted."""
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = QgsVectorFileWriter.driverForExtension(
+        os.path.splitext(output_path)[1]
+    )
+    options.layerName = layer_name
+    options.fileEncoding = "UTF-8"
+    if not overwrite_file:
+        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
+    writer = QgsVectorFileWriter.create(
         output_path,
-        QgsProject.instance().transformContext(),
-        writer_options,
+        fields,
+        wkb_type,
+        crs,
+        transform_context,
+        options,
     )
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise OSError(
+            f"Error creating output file {output_path}: {writer.errorMessage()}"
+        )
+    return writer
+
 
-    if error:
-        print(
-            f"Error writing output to file, error code {error}, details: {explanation}"
+def output_file_layer_uri(
+    output_path: str, layer_name: str = RESULT_FILE_LAYER_NAME
+) -> str:
+    """Returns the OGR data source uri of the layer written by the file writer."""
+    if (
+        QgsVectorFileWriter.driverForExtension(os.path.splitext(output_path)[1])
+        == "GPKG"
+    ):
+        return f"{output_path}|layername={layer_name}"
+    return output_path
+
+
+def batch_layer_names(dataset_names: Sequence[str]) -> List[str]:
+    """Returns unique output layer names for the datasets of a batch run, e.g.
+    "Laskenta 2021.csv" becomes "laskenta_2021"."""
+    layer_names: List[str] = []
+    for dataset_name in dataset_names:
+        base_name = (
+            re.sub(r"\W+", "_", os.path.splitext(dataset_name)[0].lower()).strip("_")
+            or RESULT_FILE_LAYER_NAME
         )
+        layer_name = base_name
+        number = 2
+        while layer_name in layer_names or layer_name == BATCH_SUMMARY_LAYER_NAME:
+            layer_name = f"{base_name}_{number}"
+            number += 1
+        layer_names.append(layer_name)
+    return layer_names
+
+
+def write_batch_summary(
+    output_path: str,
+    summaries: Dict[str, RunSummary],
+    transform_context: QgsCoordinateTransformContext,
+) -> None:
+    """Writes the summaries of the datasets of a batch run, by output layer
+    name, and their totals as a table to the output GeoPackage."""
+    fields = QgsFields()
+    fields.append(QgsField("layer_name", QVariant.String))
+    for count_field in (
+        "intersection_count",
+        "failed_count",
+        "unmatched_count",
+        "feature_count",
+    ):
+        fields.append(QgsField(count_field, QVariant.Int))
+    rows: List[List[Any]] = [
+        [
+            layer_name,
+            summary.intersection_count,
+            summary.failed_count,
+            summary.unmatched_count,
+            summary.feature_count,
+        ]
+        for layer_name, summary in summaries.items()
+    ]
+    totals: List[Any] = [sum(row[i] for row in rows) for i in range(1, 5)]
+    rows.append(["total", *totals])
+    writer = create_output_file_writer(
+        output_path,
+        fields,
+        QgsCoordinateReferenceSystem(),
+        transform_context,
+        BATCH_SUMMARY_LAYER_NAME,
+        QgsWkbTypes.NoGeometry,
+        overwrite_file=False,
+    )
+    summary_feats = []
+    for row in rows:
+        feat = QgsFeature(fields)
+        feat.setAttributes(row)
+        summary_feats.append(feat)
+    writer.addFeatures(summary_feats)
+    del writer
+
+
+def overview_output_path(output_path: str) -> str:
+    """Returns the path of the overview file written next to the output file."""
+    root, extension = os.path.splitext(output_path)
+    return f"{root}_overview{extension}"
@@ -0,0 +1,612 @@
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from qgis.core import (
+    Qgis,
+    QgsApplication,
+    QgsCoordinateReferenceSystem,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsFeedback,
+    QgsProject,
+    QgsTask,
+    QgsVectorLayer,
+    QgsVectorLayerFeatureSource,
+    QgsWkbTypes,
+)
+from qgis.utils import iface
+
+from risteyslaskenta_package.aggregation import AggregationSettings
+from risteyslaskenta_package.branch_grid import BranchGrid
+from risteyslaskenta_package.geometry import Segmentation
+from risteyslaskenta_package.geometry_cache import GeometryCache
+from risteyslaskenta_package.instrumentation import DISABLED_TIMER, StageTimer
+from risteyslaskenta_package.intersection import matched_counts
+from risteyslaskenta_package.intersection_tables import IntersectionTables
+from risteyslaskenta_package.live_refresh import LiveRefresh
+from risteyslaskenta_package.normalization import Normalization
+from risteyslaskenta_package.qgis_plugin_tools.tools.resources import plugin_name
+from risteyslaskenta_package.risteyslaskenta_functions import (
+    CENTROID_CACHE,
+    FeatureBatchWriter,
+    RunSummary,
+    aggregate_data_features,
+    aggregate_data_groups,
+    count_database_intersections,
+    count_features,
+    count_group_features,
+    create_aggregated_fields,
+    create_branch_grid,
+    create_branch_request,
+    create_data_request,
+    create_intersection_tables,
+    create_output_file_writer,
+    create_result_fields,
+    create_result_layer,
+    database_counts,
+    database_tables,
+    dataset_counts,
+    group_branch_features,
+    group_features_by_field,
+    iterate_feature_groups,
+    output_file_layer_uri,
+    overview_output_path,
+    process_database_intersections,
+    process_intersection_groups,
+    process_prepared_intersections,
+    result_wkb_type,
+    select_data_fields,
+    set_overview_scales,
+)
+
+LOGGER = logging.getLogger(plugin_name())
+
+# Minimum interval (in seconds) between progress log messages
+PROGRESS_LOG_INTERVAL = 5
+
+
+class RisteyslaskentaTask(QgsTask):
+    """Runs the processing of all intersections in the QGIS Task Manager.
+
+    The input layers are read through feature sources created in the main thread,
+    so the task can safely run in the background. With more than one worker, the
+    intersections are calculated in a process pool. The result layer is created in
+    the task and added to the project in finished, which is run in the main thread.
+
+    If an output path is given, the result features are streamed to that file
+    instead of a memory layer, and the file is added to the project when done.
+    Polygon branch locations are converted to centroids, which are cached between
+    runs until the layer changes. If aggregation settings are given, the data rows
+    of each intersection and direction are combined into one before the curves
+    are calculated.
+
+    If a geometry cache path is given, the curves of unchanged intersections are
+    read from the cache instead of calculating them again. If a report path is
+    given, the processing stages are timed and the timings are logged and written
+    to that path as JSON.
+
+    If a segmentation is given, the curves are written as line strings. With
+    overview, a second layer of simple lines is created and shown instead of the
+    result layer at small scales. For file output, the overview is written next
+    to the output file.
+
+    If carried fields are given, only those data layer attributes (and the ones
+    needed in the processing) are copied to the result features. With spatial
+    matching, branches that cannot be matched by their ids are searched by
+    proximity and branch number.
+
+    With streaming, the data layer is read in id order one intersection at a
+    time instead of reading it all first, and only the branch locations are held
+    in memory. Use it with an output path to process data that does not fit in
+    memory. The progress is then reported by data features.
+
+    If linked, the result memory layer is kept up to date with the edits of the
+    data layer after the run, see LiveRefresh. Linking is not available for file
+    output, with streaming or with existing prepared inputs.
+
+    With SQL push-down, GeoPackage and SpatiaLite layers are read directly with
+    SQLite, which does the grouping, the branch matching and the intersection
+    max and min values, see process_database_intersections. Layers and options
+    that it does not support are read with QGIS as usual.
+
+    If normalizations are given, their values are written as additional result
+    fields, see Normalization. The counts of the whole dataset are read before
+    processing if the normalizations need them, with streaming in a separate
+    pass over the data layer.
+
+    If a prepared inputs path is given and it exists, the prepared inputs saved
+    there by a previous run are processed instead of reading the layers, see
+    IntersectionTables. The result then only has the id, direction and autot
+    data fields. Otherwise the prepared inputs are saved to the path after
+    reading the layers. Paths ending in .npz are saved as one file and other
+    paths as a directory of memory-mapped files.
+    """
+
+    def __init__(
+        self,
+        data_layer: QgsVectorLayer,
+        points_layer: QgsVectorLayer,
+        workers: int = 1,
+        output_path: Optional[str] = None,
+        geometry_cache_path: Optional[str] = None,
+        report_path: Optional[str] = None,
+        aggregation: Optional[AggregationSettings] = None,
+        segmentation: Optional[Segmentation] = None,
+        overview: bool = False,
+        carried_fields: Optional[List[str]] = None,
+        spatial_matching: bool = False,
+        streaming: bool = False,
+        linked: bool = False,
+        sql_pushdown: bool = False,
+        normalizations: Optional[List[str]] = None,
+        prepared_inputs_path: Optional[str] = None,
+    ) -> None:
+        super().__init__("Risteyslaskenta", QgsTask.CanCancel)
+        self.workers = workers
+        self.output_path = output_path
+        self.geometry_cache_path = geometry_cache_path
+        self.report_path = report_path
+        self.timer = StageTimer() if report_path else DISABLED_TIMER
+        self.aggregation = aggregation
+        self.segmentation = segmentation
+        self.overview = overview
+        self.transform_context = QgsProject.instance().transformContext()
+        self.data_source = QgsVectorLayerFeatureSource(data_layer)
+        self.points_source = QgsVectorLayerFeatureSource(points_layer)
+        self.points_layer_id = points_layer.id()
+        self.points_are_polygons = (
+            points_layer.geometryType() == QgsWkbTypes.PolygonGeometry
+        )
+        if self.points_are_polygons:
+            CENTROID_CACHE.watch(points_layer)
+        # Only the used attributes of the layers are read
+        self.read_fields = select_data_fields(
+            data_layer.fields(), carried_fields, aggregation
+        )
+        self.project_data_fields = carried_fields is not None
+        self.spatial_matching = spatial_matching
+        self.streaming = streaming
+        self.data_feature_count = data_layer.featureCount()
+        # The sizes of the streamed data groups as read, for the progress
+        self.group_sizes: Optional[Deque[int]] = None
+        # An empty path means that the prepared inputs are not used
+        self.prepared_inputs_path = prepared_inputs_path or ""
+        self.load_prepared_inputs = bool(self.prepared_inputs_path) and (
+            IntersectionTables.exists(self.prepared_inputs_path)
+        )
+        self.linked = (
+            linked
+            and not output_path
+            and not streaming
+            and not self.load_prepared_inputs
+        )
+        # The layers are needed for linking the result layer in the main thread
+        self.data_layer = data_layer if self.linked else None
+        self.points_layer = points_layer if self.linked else None
+        self.branch_grid: Optional[BranchGrid] = None
+        self.database_tables = (
+            database_tables(data_layer, points_layer)
+            if sql_pushdown
+            and aggregation is None
+            and not spatial_matching
+            and not streaming
+            and not prepared_inputs_path
+            else None
+        )
+        if sql_pushdown and self.database_tables is None:
+            LOGGER.info(
+                "Risteyslaskenta: SQL push-down is not available for these layers, "
+                "options or SQLite version, reading the layers with QGIS"
+            )
+        self.data_request = create_data_request(
+            data_layer.fields(),
+            self.read_fields,
+            aggregation,
+            spatial_matching and data_layer.isSpatial(),
+        )
+        self.points_request = create_branch_request(points_layer.fields())
+        self.data_fields = self.read_fields
+        if self.load_prepared_inputs:
+            # Only the flows are saved in the prepared inputs
+            self.data_fields = select_data_fields(data_layer.fields(), ())
+        elif aggregation is not None:
+            self.data_fields = create_aggregated_fields(self.data_fields)
+        self.prepared_tables: Optional[IntersectionTables] = None
+        self.normalization = (
+            Normalization.from_counts(normalizations) if normalizations else None
+        )
+        self.crs = QgsCoordinateReferenceSystem()
+        self.crs.createFromProj(points_layer.crs().toProj())
+
+        self.result_layer: Optional[QgsVectorLayer] = None
+        self.overview_layer: Optional[QgsVectorLayer] = None
+        self.summary: Optional[RunSummary] = None
+        self.exception: Optional[Exception] = None
+
+        self.feedback = QgsFeedback()
+        self.feedback.progressChanged.connect(self._on_progress_changed)
+        self._progress_total = 0
+        self._progress_unit = "intersections"
+        self._start_time = 0.0
+        self._last_log_time = 0.0
+
+    def run(self) -> bool:
+        cache = None
+        data_groups: Iterable[Tuple[str, List[QgsFeature]]] = ()
+        points_index: Dict[str, List[QgsFeature]] = {}
+        intersection_count: Optional[int] = None
+        try:
+            if self.load_prepared_inputs:
+                with self.timer.stage("select"):
+                    self.prepared_tables = IntersectionTables.load(
+                        self.prepared_inputs_path
+                    )
+                self._progress_total = len(self.prepared_tables)
+            elif self.database_tables is not None:
+                # The layers are queried while processing
+                with self.timer.stage("select"):
+                    intersection_count = count_database_intersections(
+                        self.database_tables
+                    )
+                self._progress_total = intersection_count
+            else:
+                data_groups, points_index, intersection_count = self._read_layers()
+                if self.prepared_inputs_path:
+                    with self.timer.stage("prepare"):
+                        self._save_prepared_inputs(data_groups, points_index)
+            if (
+                self.normalization is not None
+                and self.normalization.needs_dataset_counts
+            ):
+                with self.timer.stage("normalization"):
+                    self.normalization = Normalization.from_counts(
+                        self.normalization.modes,
+                        self._read_dataset_counts(data_groups, points_index),
+                    )
+            self._start_time = self._last_log_time = time.monotonic()
+
+            wkb_type = result_wkb_type(self.segmentation)
+            overview_sink = None
+            if self.output_path:
+                fields = create_result_fields(self.data_fields, self.normalization)
+                sink = create_output_file_writer(
+                    self.output_path,
+                    fields,
+                    self.crs,
+                    self.transform_context,
+                    wkb_type=wkb_type,
+                )
+                if self.overview:
+                    overview_sink = create_output_file_writer(
+                        overview_output_path(self.output_path),
+                        fields,
+                        self.crs,
+                        self.transform_context,
+                        wkb_type=QgsWkbTypes.LineString,
+                    )
+            else:
+                self.result_layer = create_result_layer(
+                    self.crs,
+                    self.data_fields,
+                    wkb_type,
+                    normalization=self.normalization,
+                )
+                fields = self.result_layer.fields()
+                sink = self.result_layer.dataProvider()
+                if self.overview:
+                    self.overview_layer = create_result_layer(
+                        self.crs,
+                        self.data_fields,
+                        QgsWkbTypes.LineString,
+                        "Intersections overview",
+                        self.normalization,
+                    )
+                    overview_sink = self.overview_layer.dataProvider()
+            writer = FeatureBatchWriter(sink)
+            overview_writer = (
+                FeatureBatchWriter(overview_sink) if overview_sink is not None else None
+            )
+            if self.geometry_cache_path:
+                # The cache connection must be opened in the task thread
+                cache = GeometryCache(self.geometry_cache_path)
+            if self.prepared_tables is not None:
+                self.summary = process_prepared_intersections(
+                    self.prepared_tables,
+                    self.data_fields,
+                    fields,
+                    writer,
+                    self.feedback,
+                    self.workers,
+                    cache,
+                    self.timer,
+                    self.segmentation,
+                    overview_writer,
+                    self.spatial_matching,
+                    self.normalization,
+                )
+            elif self.database_tables is not None:
+                self.summary = process_database_intersections(
+                    self.database_tables,
+                    self.data_fields,
+                    fields,
+                    writer,
+                    self.feedback,
+                    self.timer,
+                    self.segmentation,
+                    overview_writer,
+                    intersection_count,
+                    self.normalization,
+                )
+            else:
+                self.summary = process_intersection_groups(
+                    data_groups,
+                    points_index,
+                    fields,
+                    writer,
+                    self.feedback,
+                    self.workers,
+                    cache,
+                    self.timer,
+                    self.segmentation,
+                    overview_writer,
+                    self.branch_grid,
+                    intersection_count,
+                    self.data_feature_count,
+                    self.normalization,
+                    self.group_sizes,
+                )
+
+            if self.output_path:
+                # Deleting the file writers finalizes the files
+                del writer, sink, overview_writer, overview_sink
+            else:
+                # The layers have to live in the main thread to be added to the
+                # project
+                for layer in (self.result_layer, self.overview_layer):
+                    if layer is not None:
+                        layer.updateExtents()
+                        layer.moveToThread(QgsApplication.instance().thread())
+        except Exception as e:
+            self.exception = e
+            return False
+        finally:
+            if cache is not None:
+                cache.close()
+        return not self.isCanceled()
+
+    def _read_layers(
+        self,
+    ) -> Tuple[
+        Iterable[Tuple[str, List[QgsFeature]]],
+        Dict[str, List[QgsFeature]],
+        Optional[int],
+    ]:
+        """Reads the data and the branch locations of the intersections."""
+        data_fields = self.read_fields if self.project_data_fields else None
+        with self.timer.stage("select"):
+            if self.streaming:
+                # The data is read lazily while processing, so all branches
+                # are read
+                data_index = None
+                points_index = group_branch_features(
+                    self.points_source,
+                    None,
+                    self.points_are_polygons,
+                    self.points_request,
+                )
+                if self.data_request.filterType() != QgsFeatureRequest.FilterNone:
+                    # Only the data features in the period window are read
+                    self.data_feature_count = count_features(
+                        self.data_source, self.data_request
+                    )
+            else:
+                # Both layers are read only once and grouped by intersection
+                data_index = group_features_by_field(
+                    self.data_source, "id", self.data_request, data_fields
+                )
+                if self.spatial_matching:
+                    # All branches are needed for searching them by proximity
+                    points_index = group_branch_features(
+                        self.points_source,
+                        None,
+                        self.points_are_polygons,
+                        self.points_request,
+                    )
+                elif self.points_are_polygons:
+                    points_index = CENTROID_CACHE.group_features(
+                        self.points_layer_id,
+                        self.points_source,
+                        data_index.keys(),
+                        self.points_request,
+                    )
+                else:
+                    points_index = group_features_by_field(
+                        self.points_source, "RPH", self.points_request
+                    )
+            if self.spatial_matching:
+                self.branch_grid = create_branch_grid(points_index)
+        if data_index is None:
+            self.group_sizes = deque()
+            data_groups = self._iterate_data_groups(self.group_sizes)
+            intersection_count = None
+            self._progress_total = self.data_feature_count
+            self._progress_unit = "data features"
+        else:
+            if self.aggregation is not None:
+                with self.timer.stage("aggregation"):
+                    data_index = aggregate_data_features(
+                        data_index, self.data_fields, self.aggregation
+                    )
+            data_groups = data_index.items()
+            intersection_count = len(data_index)
+            self._progress_total = intersection_count
+        return data_groups, points_index, intersection_count
+
+    def _iterate_data_groups(
+        self, group_sizes: Optional[Deque[int]] = None
+    ) -> Iterable[Tuple[str, List[QgsFeature]]]:
+        """Reads the data layer lazily in id order, for streaming. The sizes of
+        the groups as read are appended to group_sizes, if given."""
+        data_groups = iterate_feature_groups(
+            self.data_source,
+            "id",
+            self.data_request,
+            self.read_fields if self.project_data_fields else None,
+        )
+        if group_sizes is not None:
+            data_groups = count_group_features(data_groups, group_sizes)
+        if self.aggregation is not None:
+            data_groups = aggregate_data_groups(
+                data_groups, self.data_fields, self.aggregation
+            )
+        return data_groups
+
+    def _read_dataset_counts(
+        self,
+        data_groups: Iterable[Tuple[str, List[QgsFeature]]],
+        points_index: Dict[str, List[QgsFeature]],
+    ) -> np.ndarray:
+        """Returns the counts of the matched flows of the whole dataset for the
+        normalization. The streamed data groups can only be read once, so the
+        data layer is read again for them."""
+        if self.prepared_tables is not None:
+            return matched_counts(
+                (
+                    (flows, branches)
+                    for _, flows, branches, _ in (
+                        self.prepared_tables.prepared_intersections()
+                    )
+                ),
+                self.spatial_matching,
+            )
+        if self.database_tables is not None:
+            return database_counts(self.database_tables)
+        if self.streaming:
+            return dataset_counts(
+                self._iterate_data_groups(), points_index, self.branch_grid
+            )
+        return dataset_counts(data_groups, points_index, self.branch_grid)
+
+    def _save_prepared_inputs(
+        self,
+        data_groups: Iterable[Tuple[str, List[QgsFeature]]],
+        points_index: Dict[str, List[QgsFeature]],
+    ) -> None:
+        """Saves the prepared inputs for later runs. The streamed data groups can
+        only be read once, so the data layer is read again for them."""
+        create_intersection_tables(
+            self._iterate_data_groups() if self.streaming else data_groups,
+            points_index,
+            self.branch_grid,
+        ).save(self.prepared_inputs_path)
+
+    def cancel(self) -> None:
+        self.feedback.cancel()
+        super().cancel()
+
+    def _on_progress_changed(self, progress: float) -> None:
+        self.setProgress(progress)
+        now = time.monotonic()
+        if progress <= 0 or now - self._last_log_time < PROGRESS_LOG_INTERVAL:
+            return
+        self._last_log_time = now
+        elapsed = now - self._start_time
+        processed = self._progress_total * progress / 100
+        LOGGER.info(
+            "Risteyslaskenta: %d/%d %s processed (%.1f/s), about %.0f s remaining",
+            processed,
+            self._progress_total,
+            self._progress_unit,
+            processed / elapsed,
+            elapsed * (100 - progress) / progress,
+        )
+
+    def finished(self, result: bool) -> None:
+        if self.exception is not None:
+            LOGGER.error("Risteyslaskenta processing failed", exc_info=self.exception)
+            iface.messageBar().pushMessage(
+                "Error",
+                f"Risteyslaskenta processing failed: {self.exception}",
+                level=Qgis.Critical,
+            )
+            return
+        if not result:
+            iface.messageBar().pushMessage(
+                "Warning", "Risteyslaskenta processing was canceled", level=Qgis.Warning
+            )
+            return
+
+        summary = self.summary
+        if summary is None:
+            return
+        if self.output_path:
+            self.result_layer = QgsVectorLayer(
+                output_file_layer_uri(self.output_path),
+                "Intersections visualized",
+                "ogr",
+            )
+            if self.overview:
+                self.overview_layer = QgsVectorLayer(
+                    output_file_layer_uri(overview_output_path(self.output_path)),
+                    "Intersections overview",
+                    "ogr",
+                )
+        if self.overview_layer is not None:
+            set_overview_scales(self.result_layer, self.overview_layer)
+            QgsProject.instance().addMapLayer(self.overview_layer)
+        if self.linked:
+            # The refresh is owned by the result layer
+            LiveRefresh(
+                self.data_layer,
+                self.points_layer,
+                self.result_layer,
+                self.data_request,
+                self.data_fields,
+                self.read_fields if self.project_data_fields else None,
+                self.aggregation,
+                self.segmentation,
+                self.overview_layer,
+                self.branch_grid,
+                self.normalization,
+            )
+        QgsProject.instance().addMapLayer(self.result_layer)
+        LOGGER.info("Total number of intersections: %d", summary.intersection_count)
+        LOGGER.info(
+            "Number of intersections without any location features: %d",
+            summary.failed_count,
+        )
+        LOGGER.info(
+            "Number of data features without matching branch locations: %d",
+            summary.unmatched_count,
+        )
+        for data_id, direction in summary.unmatched_ids:
+            LOGGER.info("Unmatched: id %s, direction %s", data_id, direction)
+        if summary.unmatched_count > len(summary.unmatched_ids):
+            LOGGER.info(
+                "Unmatched: %d more data features",
+                summary.unmatched_count - len(summary.unmatched_ids),
+            )
+        if self.report_path:
+            self.timer.log_report(LOGGER)
+            self.timer.write_report(self.report_path)
+
+        if summary.failed_count == summary.intersection_count:
+            iface.messageBar().pushMessage(
+                "Warning",
+                "Risteyslaskenta processing failed (no location features found for "
+                "any intersection).",
+                level=Qgis.Warning,
+            )
+        else:
+            iface.messageBar().pushMessage(
+                "Success",
+                "Risteyslaskenta processing completed succesfully. Features found "
+                f"for {summary.intersection_count - summary.failed_count}/"
+                f"{summary.intersection_count} given intersections, "
+                f"{summary.unmatched_count} data features could not be matched "
+                "to branch locations",
+                level=Qgis.Success,
+            )
@@ -0,0 +1,314 @@
+import math
+import sqlite3
+import struct
+from itertools import groupby
+from pathlib import Path
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from risteyslaskenta_package.instrumentation import DISABLED_TIMER, StageTimer
+from risteyslaskenta_package.intersection import (
+    Branch,
+    Flow,
+    IntersectionCurves,
+    calculate_intersection_center_point,
+    calculate_matched_curves,
+)
+
+# Reading GeoPackage or SpatiaLite layers directly with SQLite lets the database
+# do the grouping of the data by intersection, the matching of the flows to
+# their branches and the intersection max and min values, so Python only needs
+# to calculate the curves.
+
+# Name of the attached database of the branch locations, if they are in another
+# file than the data
+POINTS_SCHEMA = "points"
+
+# Size of the GeoPackage geometry header envelope by the envelope indicator
+GPKG_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+# Data feature id and attributes, in the order of the queried columns
+DataRow = Tuple[Any, ...]
+
+# First SQLite version with the window functions of flow_query. Some QGIS
+# builds bundle an older one.
+WINDOW_FUNCTIONS_VERSION = (3, 25, 0)
+
+
+def quote_identifier(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def is_supported() -> bool:
+    """Returns whether the SQLite library of Python can run the queries."""
+    return sqlite3.sqlite_version_info >= WINDOW_FUNCTIONS_VERSION
+
+
+def connect(data_path: str, points_path: str) -> sqlite3.Connection:
+    """Opens the databases of the data and the branch locations read-only. The
+    database of the branch locations is attached as POINTS_SCHEMA, even if it is
+    the same file."""
+    connection = sqlite3.connect(
+        f"{Path(data_path).resolve().as_uri()}?mode=ro", uri=True
+    )
+    connection.execute(
+        "ATTACH DATABASE ? AS {}".format(POINTS_SCHEMA),
+        (f"{Path(points_path).resolve().as_uri()}?mode=ro",),
+    )
+    return connection
+
+
+def geometry_column(
+    connection: sqlite3.Connection, table: str, schema: str = POINTS_SCHEMA
+) -> str:
+    """Returns the name of the geometry column of a GeoPackage or SpatiaLite
+    table."""
+    for query in (
+        "SELECT column_name FROM {}.gpkg_geometry_columns WHERE table_name = ?",
+        "SELECT f_geometry_column FROM {}.geometry_columns "
+        "WHERE lower(f_table_name) = lower(?)",
+    ):
+        try:
+            row = connection.execute(query.format(schema), (table,)).fetchone()
+        except sqlite3.OperationalError:
+            # Not this kind of database
+            continue
+        if row:
+            return row[0]
+    raise ValueError(f"No geometry column found for table {table}")
+
+
+def point_from_blob(blob: Optional[bytes]) -> Optional[Tuple[float, float]]:
+    """Reads the coordinates of a point stored in a GeoPackage or SpatiaLite
+    geometry column. None is returned for missing and empty points."""
+    if blob is None:
+        return None
+    blob = bytes(blob)
+    if blob[:2] == b"GP":
+        flags = blob[3]
+        if flags & 0x10:
+            return None
+        # The point is stored as WKB after the header
+        offset = 8 + GPKG_ENVELOPE_SIZES[(flags >> 1) & 0x07]
+        byte_order = "<" if blob[offset] == 1 else ">"
+        (geometry_type,) = struct.unpack_from(byte_order + "I", blob, offset + 1)
+        offset += 5
+    elif len(blob) >= 59 and blob[0] == 0x00 and blob[38] == 0x7C:
+        byte_order = "<" if blob[1] == 1 else ">"
+        (geometry_type,) = struct.unpack_from(byte_order + "I", blob, 39)
+        offset = 43
+    else:
+        raise ValueError("Unknown geometry format")
+    if (geometry_type & 0xFFFF) % 1000 != 1:
+        raise ValueError("The branch locations must be points")
+    x, y = struct.unpack_from(byte_order + "2d", blob, offset)
+    if math.isnan(x) or math.isnan(y):
+        return None
+    return x, y
+
+
+def count_intersections(connection: sqlite3.Connection, data_table: str) -> int:
+    return connection.execute(
+        'SELECT COUNT(DISTINCT CAST("id" AS TEXT)) FROM {}'.format(
+            quote_identifier(data_table)
+        )
+    ).fetchone()[0]
+
+
+def create_branch_locations(
+    connection: sqlite3.Connection,
+    points_table: str,
+    points_schema: str = POINTS_SCHEMA,
+) -> None:
+    """Copies the branch locations to a temporary table indexed by intersection
+    and branch number, so that the flows can be matched to them quickly. The
+    values are converted to text, like when reading the layers with QGIS."""
+    points_geometry = geometry_column(connection, points_table, points_schema)
+    connection.execute("DROP TABLE IF EXISTS temp.branch_locations")
+    connection.execute(
+        f"""
+        CREATE TEMPORARY TABLE branch_locations AS
+        SELECT
+            rowid AS branch_row,
+            CAST("RPH" AS TEXT) AS intersection_id,
+            CAST("Piste" AS TEXT) AS piste,
+            CAST("Haara" AS TEXT) AS haara,
+            {quote_identifier(points_geometry)} AS location
+        FROM {points_schema}.{quote_identifier(points_table)}
+        """
+    )
+    connection.execute(
+        "CREATE INDEX temp.branch_locations_index "
+        "ON branch_locations (intersection_id, haara)"
+    )
+
+
+def _branch_location_query(position: int) -> str:
+    # The same rules as in BranchPoints.find: the Piste is matched to the end of
+    # the data id and the shortest matching Piste is used
+    haara = f'substr(CAST(d."direction" AS TEXT), {position}, 1)'
+    return f"""(
+        SELECT b.location FROM temp.branch_locations AS b
+        WHERE b.intersection_id = CAST(d."id" AS TEXT) AND b.haara = {haara}
+            AND b.piste = substr(CAST(d."id" AS TEXT), -length(b.piste))
+        ORDER BY length(b.piste), b.branch_row
+        LIMIT 1
+    )"""
+
+
+def flow_query(data_table: str, attribute_columns: Sequence[str]) -> str:
+    """Creates the query of the data rows ordered by intersection.
+
+    Each row has the intersection id, the data feature id and attributes, the
+    flow, the start and end branch locations and the max and min traffic
+    amounts of the matched flows of the intersection. The branch locations
+    must have been created with create_branch_locations."""
+    attributes = "".join(
+        f", d.{quote_identifier(column)}" for column in attribute_columns
+    )
+    return f"""
+        WITH flows AS (
+            SELECT
+                CAST(d."id" AS TEXT) AS flow_intersection,
+                d.rowid AS flow_fid{attributes},
+                CAST(d."direction" AS TEXT) AS flow_direction,
+                CAST(d."autot" AS INTEGER) AS flow_autot,
+                {_branch_location_query(1)} AS start_location,
+                {_branch_location_query(2)} AS end_location
+            FROM {quote_identifier(data_table)} AS d
+        ), matched_flows AS (
+            SELECT *,
+                start_location IS NOT NULL AND end_location IS NOT NULL
+                AND length(flow_direction) >= 2
+                AND substr(flow_direction, 1, 1) != substr(flow_direction, 2, 1)
+                AS matched
+            FROM flows
+        )
+        SELECT *,
+            MAX(CASE WHEN matched THEN flow_autot END) OVER intersection,
+            MIN(CASE WHEN matched THEN flow_autot END) OVER intersection
+        FROM matched_flows
+        WINDOW intersection AS (PARTITION BY flow_intersection)
+        ORDER BY flow_intersection, flow_fid
+    """
+
+
+def branch_query(data_table: str) -> str:
+    """Creates the query of the branch locations of the intersections of the data,
+    ordered by intersection."""
+    return f"""
+        SELECT intersection_id, piste, haara, location
+        FROM temp.branch_locations
+        WHERE intersection_id IN (
+            SELECT CAST("id" AS TEXT) FROM {quote_identifier(data_table)}
+        )
+        ORDER BY intersection_id, branch_row
+    """
+
+
+def query_counts(
+    connection: sqlite3.Connection,
+    data_table: str,
+    points_table: str,
+    points_schema: str = POINTS_SCHEMA,
+) -> np.ndarray:
+    """Returns the traffic counts of the data rows that are matched to branch
+    locations, i.e. the rows that get a curve, for the normalizations that need
+    the counts of the whole dataset. The rows are matched like in flow_query."""
+    create_branch_locations(connection, points_table, points_schema)
+    return np.fromiter(
+        (
+            autot
+            for (autot,) in connection.execute(
+                "SELECT flow_autot FROM ({}) WHERE matched".format(
+                    flow_query(data_table, [])
+                )
+            )
+        ),
+        dtype=float,
+    )
+
+
+def query_intersections(
+    connection: sqlite3.Connection,
+    data_table: str,
+    points_table: str,
+    attribute_columns: Sequence[str],
+    points_schema: str = POINTS_SCHEMA,
+    timer: StageTimer = DISABLED_TIMER,
+) -> Iterator[Tuple[str, List[DataRow], Optional[IntersectionCurves]]]:
+    """Yields the data rows and the calculated curves of each intersection, in
+    intersection id order.
+
+    The data rows have the data feature id followed by the attribute columns.
+    The curves are None if the intersection has no branch locations, like in
+    compute_intersection."""
+    with timer.stage("select"):
+        create_branch_locations(connection, points_table, points_schema)
+    attribute_count = len(attribute_columns)
+    flow_rows = connection.execute(flow_query(data_table, attribute_columns))
+    # A separate cursor, as both queries are read at the same time
+    branch_groups = groupby(
+        connection.cursor().execute(branch_query(data_table)),
+        key=lambda row: row[0],
+    )
+    branch_group = next(branch_groups, None)
+    for intersection_id, row_group in groupby(flow_rows, key=lambda row: row[0]):
+        with timer.stage("matching"):
+            rows = list(row_group)
+            # Both queries are in intersection id order
+            while branch_group is not None and branch_group[0] < intersection_id:
+                branch_group = next(branch_groups, None)
+            branches: List[Branch] = []
+            if branch_group is not None and branch_group[0] == intersection_id:
+                for _, piste, haara, location in branch_group[1]:
+                    point = point_from_blob(location)
+                    if point is not None:
+                        branches.append(Branch(piste, haara, *point))
+                branch_group = next(branch_groups, None)
+
+            data_rows = [row[1 : 2 + attribute_count] for row in rows]
+            flows: List[Flow] = []
+            matched_rows: List[int] = []
+            unmatched_rows: List[int] = []
+            start_coords: List[Tuple[float, float]] = []
+            end_coords: List[Tuple[float, float]] = []
+            sql_matched_count = 0
+            for i, row in enumerate(rows):
+                direction, autot, start_location, end_location, matched = row[
+                    2 + attribute_count : 7 + attribute_count
+                ]
+                flows.append(Flow(intersection_id, direction, autot))
+                sql_matched_count += bool(matched)
+                start_point = point_from_blob(start_location) if matched else None
+                end_point = point_from_blob(end_location) if matched else None
+                if start_point and end_point:
+                    matched_rows.append(i)
+                    start_coords.append(start_point)
+                    end_coords.append(end_point)
+                else:
+                    unmatched_rows.append(i)
+        if not branches:
+            yield intersection_id, data_rows, None
+            continue
+        with timer.stage("center point"):
+            center_point = calculate_intersection_center_point(branches)
+        # The range is not valid if some of the matched locations are empty
+        autot_range: Optional[Tuple[int, int]] = (
+            (rows[0][-2], rows[0][-1])
+            if sql_matched_count == len(matched_rows)
+            else None
+        )
+        curves = calculate_matched_curves(
+            flows,
+            branches,
+            center_point,
+            matched_rows,
+            unmatched_rows,
+            start_coords,
+            end_coords,
+            timer,
+            autot_range,
+        )
+        yield intersection_id, data_rows, curves
@@ -1,13 +1,29 @@
-from qgis.core import QgsCoordinateReferenceSystem, QgsWkbTypes, Qgis
-from qgis.PyQt.QtWidgets import QDialogButtonBox, QWidget, QDialog, QProgressBar, QComboBox
+import os
+from typing import Set
+
+from qgis.core import QgsApplication
+from qgis.gui import QgsCheckableComboBox, QgsFieldComboBox, QgsFileWidget
+from qgis.PyQt.QtWidgets import (
+    QCheckBox,
+    QComboBox,
+    QDialog,
+    QDialogButtonBox,
+    QDoubleSpinBox,
+    QLineEdit,
+    QProgressBar,
+    QSpinBox,
+    QWidget,
+)
 from qgis.utils import iface
 
+from risteyslaskenta_package.aggregation import AGGREGATION_METHODS, AggregationSettings
+from risteyslaskenta_package.geometry import Segmentation
+from risteyslaskenta_package.intersection_tables import IntersectionTables
+from risteyslaskenta_package.normalization import NORMALIZATION_MODES
 from risteyslaskenta_package.risteyslaskenta_functions import (
-    convert_polygons_to_centroids,
-    create_result_layer,
-    process_intersection,
+    default_geometry_cache_path,
 )
-
+from risteyslaskenta_package.risteyslaskenta_task import RisteyslaskentaTask
 
 from ..qgis_plugin_tools.tools.resources import load_ui  # type: ignore
 
@@ -23,11 +39,70 @@ class RisteyslaskentaDialog(QDialog, FORM_CLASS):  # type: ignore
         self.intersection_combobox: QComboBox
         self.button_box: QDialogButtonBox
         self.progress_bar: QProgressBar
+        self.workers_spinbox: QSpinBox
+        self.output_file_widget: QgsFileWidget
+        self.cache_checkbox: QCheckBox
+        self.report_file_widget: QgsFileWidget
+        self.aggregation_combobox: QComboBox
+        self.period_field_combobox: QgsFieldComboBox
+        self.period_start_edit: QLineEdit
+        self.period_end_edit: QLineEdit
+        self.geometry_combobox: QComboBox
+        self.vertex_count_spinbox: QSpinBox
+        self.tolerance_spinbox: QDoubleSpinBox
+        self.overview_checkbox: QCheckBox
+        self.fields_combobox: QgsCheckableComboBox
+        self.spatial_matching_checkbox: QCheckBox
+        self.streaming_checkbox: QCheckBox
+        self.linked_checkbox: QCheckBox
+        self.sql_pushdown_checkbox: QCheckBox
+        self.normalization_combobox: QgsCheckableComboBox
+        self.prepared_inputs_file_widget: QgsFileWidget
+        self.prepared_inputs_directory_checkbox: QCheckBox
+        # References to the running tasks, as the task manager does not keep
+        # them alive on the Python side
+        self.tasks: Set[RisteyslaskentaTask] = set()
+
+        # Leaving the output file empty creates a temporary memory layer
+        self.output_file_widget.setStorageMode(QgsFileWidget.SaveFile)
+        self.output_file_widget.setFilter("GeoPackage (*.gpkg);;FlatGeobuf (*.fgb)")
+        # Processing stages are timed only when a report file is given
+        self.report_file_widget.setStorageMode(QgsFileWidget.SaveFile)
+        self.report_file_widget.setFilter("JSON (*.json)")
+        # Existing prepared inputs are used instead of reading the layers
+        self._set_prepared_inputs_storage(False)
+        self.prepared_inputs_file_widget.setConfirmOverwrite(False)
+        self.prepared_inputs_directory_checkbox.toggled.connect(
+            self._set_prepared_inputs_storage
+        )
+
+        self.workers_spinbox.setMaximum(os.cpu_count() or 1)
+
+        # Without aggregation, each data row is drawn as its own curve
+        self.aggregation_combobox.addItem("No aggregation", None)
+        for method in AGGREGATION_METHODS:
+            self.aggregation_combobox.addItem(method.capitalize(), method)
+        self.period_field_combobox.setAllowEmptyFieldName(True)
+        self.period_field_combobox.setLayer(self.traffic_combobox.currentLayer())
+        self.traffic_combobox.layerChanged.connect(self.period_field_combobox.setLayer)
+
+        # All fields are copied to the result by default
+        self._populate_fields_combobox(self.traffic_combobox.currentLayer())
+        self.traffic_combobox.layerChanged.connect(self._populate_fields_combobox)
+
+        # Only intersection_autot_normalized is calculated by default
+        self.normalization_combobox.addItems(list(NORMALIZATION_MODES))
+
+        # Only temporary result layers can be kept linked to the traffic data
+        self.output_file_widget.fileChanged.connect(self._update_linked_checkbox)
+        self.streaming_checkbox.toggled.connect(self._update_linked_checkbox)
+        self.prepared_inputs_file_widget.fileChanged.connect(
+            self._update_linked_checkbox
+        )
 
         self.button_box.button(QDialogButtonBox.Ok).setText("Run")
         self.button_box.accepted.connect(self._on_run_clicked)
 
-
     def _on_run_clicked(self):
         # Reset progress bar
         self.progress_bar.setValue(0)
@@ -36,52 +111,91 @@ class RisteyslaskentaDialog(QDialog, FORM_CLASS):  # type: ignore
         data_layer = self.traffic_combobox.currentLayer()
         points_layer = self.intersection_combobox.currentLayer()
 
-        # Convert input data if needed
-        if points_layer.geometryType() == QgsWkbTypes.PolygonGeometry:
-            points_layer = convert_polygons_to_centroids(points_layer)
-
-        # Crs from data layer
-        crs = QgsCoordinateReferenceSystem()
-        crs.createFromProj(points_layer.crs().toProj())
-        result_layer = create_result_layer(crs, data_layer.fields())
-
-        # Iterate each intersection
-        # We want to handle one intersection at a time to create visuals that
-        # would overlap as little as possible
-        # We count the number of all intersections and "failed" intersections
-        # for additional info and print it
-        index = data_layer.fields().indexOf("id")
-        intersections = data_layer.uniqueValues(index)
-        failed_sum = 0
-        intersection_count = len(intersections)
-        for i, intersection in enumerate(intersections):
-            if not process_intersection(
-                points_layer, data_layer, result_layer, intersection
-            ):
-                failed_sum += 1
-            progress = int(i / intersection_count * 100)
-            self.progress_bar.setValue(progress)
-        print("Total number of intersections: {}".format(intersection_count))
-        print(
-            "Number of intersections without any location features: {}".format(
-                failed_sum
-            )
+        # The processing is run as a background task so that QGIS can be used
+        # while it runs. The task adds the result layer to the project when done.
+        # A reference to the task is kept until it has finished, also when the
+        # plugin is run again meanwhile.
+        task = RisteyslaskentaTask(
+            data_layer,
+            points_layer,
+            self.workers_spinbox.value(),
+            self.output_file_widget.filePath() or None,
+            default_geometry_cache_path() if self.cache_checkbox.isChecked() else None,
+            self.report_file_widget.filePath() or None,
+            self._aggregation_settings(),
+            self._segmentation(),
+            self.overview_checkbox.isChecked(),
+            self._carried_fields(),
+            self.spatial_matching_checkbox.isChecked(),
+            self.streaming_checkbox.isChecked(),
+            self.linked_checkbox.isChecked() and self._can_link(),
+            self.sql_pushdown_checkbox.isChecked(),
+            self.normalization_combobox.checkedItems() or None,
+            self.prepared_inputs_file_widget.filePath() or None,
         )
-        self.progress_bar.setValue(100)
+        task.progressChanged.connect(
+            lambda progress: self.progress_bar.setValue(int(progress))
+        )
+        task.taskCompleted.connect(lambda: self.tasks.discard(task))
+        task.taskTerminated.connect(lambda: self.tasks.discard(task))
+        self.tasks.add(task)
+        QgsApplication.taskManager().addTask(task)
 
-        result_layer.commitChanges()
-        iface.vectorLayerTools().stopEditing(result_layer)
+        self.accept()
 
-        if failed_sum == intersection_count:
-            iface.messageBar().pushMessage(
-                "Warning", f"Risteyslaskenta processing failed (no location features found for any intersection). ",
-                level=Qgis.Warning
-            )
-        else:
-            iface.messageBar().pushMessage(
-                "Success",
-                f"Risteyslaskenta processing completed succesfully. Features found for {intersection_count-failed_sum}/{intersection_count} given intersections",
-                level=Qgis.Success
+    def _aggregation_settings(self):
+        method = self.aggregation_combobox.currentData()
+        if method is None:
+            return None
+        return AggregationSettings(
+            method,
+            self.period_field_combobox.currentField() or None,
+            self.period_start_edit.text() or None,
+            self.period_end_edit.text() or None,
+        )
+
+    def _segmentation(self):
+        if self.geometry_combobox.currentText() != "Lines":
+            return None
+        return Segmentation(
+            self.vertex_count_spinbox.value() or None, self.tolerance_spinbox.value()
+        )
+
+    def _can_link(self):
+        # The result layer is refreshed from the traffic data grouped in memory,
+        # which is not done with streaming or existing prepared inputs
+        prepared_inputs_path = self.prepared_inputs_file_widget.filePath()
+        return (
+            not self.output_file_widget.filePath()
+            and not self.streaming_checkbox.isChecked()
+            and not (
+                prepared_inputs_path and IntersectionTables.exists(prepared_inputs_path)
             )
+        )
 
-        self.accept()
+    def _set_prepared_inputs_storage(self, directory):
+        # The tables are saved to a directory of memory-mapped files or to a
+        # NumPy archive, see IntersectionTables.save
+        if directory:
+            self.prepared_inputs_file_widget.setStorageMode(QgsFileWidget.GetDirectory)
+            self.prepared_inputs_file_widget.setFilter("")
+        else:
+            self.prepared_inputs_file_widget.setStorageMode(QgsFileWidget.SaveFile)
+            self.prepared_inputs_file_widget.setFilter("NumPy archive (*.npz)")
+        self._update_linked_checkbox()
+
+    def _update_linked_checkbox(self):
+        self.linked_checkbox.setEnabled(self._can_link())
+
+    def _populate_fields_combobox(self, layer):
+        self.fields_combobox.clear()
+        if layer is None:
+            return
+        self.fields_combobox.addItems(layer.fields().names())
+        self.fields_combobox.selectAllOptions()
+
+    def _carried_fields(self):
+        checked_fields = self.fields_combobox.checkedItems()
+        if len(checked_fields) == self.fields_combobox.count():
+            return None
+        return checked_fields
@@ -0,0 +1,143 @@
+import os
+from typing import List, Optional, Tuple
+
+from qgis.core import (
+    QgsAbstractGeometry,
+    QgsCoordinateTransformContext,
+    QgsDataSourceUri,
+    QgsExpression,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsFeedback,
+    QgsGeometry,
+    QgsVectorLayer,
+    QgsVectorTileWriter,
+    QgsWkbTypes,
+)
+
+# Name of the layer in the vector tiles
+VECTOR_TILE_LAYER_NAME = "intersections"
+
+# Default zoom levels of the vector tiles. All flows are included from the full
+# detail zoom on; below it, only the flows that are heavy compared to the other
+# flows of their intersection.
+VECTOR_TILE_MIN_ZOOM = 10
+VECTOR_TILE_MAX_ZOOM = 16
+VECTOR_TILE_FULL_DETAIL_ZOOM = 14
+
+# Smallest intersection_autot_normalized of the flows in the minimum zoom tiles
+THINNING_MAX_THRESHOLD = 0.8
+
+# Field that the thinning is based on
+THINNING_FIELD = "intersection_autot_normalized"
+
+
+def thinning_thresholds(
+    min_zoom: int,
+    max_zoom: int,
+    full_detail_zoom: int,
+    max_threshold: float = THINNING_MAX_THRESHOLD,
+) -> List[Tuple[int, int, float]]:
+    """Returns the (first zoom, last zoom, threshold) ranges of the thinning.
+
+    The tiles of a zoom only have the flows whose intersection_autot_normalized
+    is at least the threshold. The threshold decreases linearly from the max
+    threshold at the minimum zoom to zero at the full detail zoom."""
+    thresholds = [
+        (
+            zoom,
+            zoom,
+            round(
+                max_threshold
+                * (full_detail_zoom - zoom)
+                / (full_detail_zoom - min_zoom),
+                3,
+            ),
+        )
+        for zoom in range(min_zoom, min(full_detail_zoom, max_zoom + 1))
+    ]
+    if full_detail_zoom <= max_zoom:
+        thresholds.append((max(full_detail_zoom, min_zoom), max_zoom, 0.0))
+    return thresholds
+
+
+def densify_to_lines(result_layer: QgsVectorLayer, tolerance: float) -> QgsVectorLayer:
+    """Returns the result features with their curves converted to line strings,
+    whose maximum distance from the curves is the tolerance, as a memory layer.
+    A layer that has no curves is returned as is."""
+    # Imported here, so that the export algorithm can be registered without
+    # loading the processing modules
+    from risteyslaskenta_package.risteyslaskenta_functions import FeatureBatchWriter
+
+    if not QgsWkbTypes.isCurvedType(result_layer.wkbType()):
+        return result_layer
+    line_layer = QgsVectorLayer(
+        QgsWkbTypes.displayString(QgsWkbTypes.LineString), "lines", "memory"
+    )
+    line_layer.setCrs(result_layer.crs())
+    line_layer.dataProvider().addAttributes(result_layer.fields().toList())
+    line_layer.updateFields()
+    writer = FeatureBatchWriter(line_layer.dataProvider())
+    for feat in result_layer.getFeatures(QgsFeatureRequest()):
+        line_feat = QgsFeature(line_layer.fields(), feat.id())
+        line_feat.setAttributes(feat.attributes())
+        if feat.hasGeometry():
+            line_feat.setGeometry(
+                QgsGeometry(
+                    feat.geometry()
+                    .constGet()
+                    .segmentize(tolerance, QgsAbstractGeometry.MaximumDifference)
+                )
+            )
+        writer.add_features([line_feat])
+    writer.flush()
+    return line_layer
+
+
+def export_vector_tiles(
+    result_layer: QgsVectorLayer,
+    output_path: str,
+    transform_context: QgsCoordinateTransformContext,
+    min_zoom: int = VECTOR_TILE_MIN_ZOOM,
+    max_zoom: int = VECTOR_TILE_MAX_ZOOM,
+    full_detail_zoom: int = VECTOR_TILE_FULL_DETAIL_ZOOM,
+    tolerance: float = 0.5,
+    feedback: Optional[QgsFeedback] = None,
+) -> None:
+    """Writes the result features to an MBTiles file of vector tiles.
+
+    Curves are converted to lines first, see densify_to_lines. The tiles below
+    the full detail zoom are thinned by intersection_autot_normalized, see
+    thinning_thresholds, so that the tiles of small scales stay small and only
+    have the heaviest flows. An existing file is overwritten."""
+    line_layer = densify_to_lines(result_layer, tolerance)
+    tile_layers = []
+    for first_zoom, last_zoom, threshold in thinning_thresholds(
+        min_zoom, max_zoom, full_detail_zoom
+    ):
+        tile_layer = QgsVectorTileWriter.Layer(line_layer)
+        tile_layer.setLayerName(VECTOR_TILE_LAYER_NAME)
+        tile_layer.setMinZoom(first_zoom)
+        tile_layer.setMaxZoom(last_zoom)
+        if threshold > 0:
+            tile_layer.setFilterExpression(
+                f"{QgsExpression.quotedColumnRef(THINNING_FIELD)} >= {threshold}"
+            )
+        tile_layers.append(tile_layer)
+
+    if os.path.exists(output_path):
+        # The tiles are not written to an existing MBTiles file
+        os.remove(output_path)
+    uri = QgsDataSourceUri()
+    uri.setParam("type", "mbtiles")
+    uri.setParam("url", output_path)
+    writer = QgsVectorTileWriter()
+    writer.setDestinationUri(uri.encodedUri().data().decode())
+    writer.setMinZoom(min_zoom)
+    writer.setMaxZoom(max_zoom)
+    writer.setTransformContext(transform_context)
+    writer.setLayers(tile_layers)
+    if not writer.writeTiles(feedback) and not (feedback and feedback.isCanceled()):
+        raise OSError(
+            f"Error writing vector tiles to {output_path}: {writer.errorMessage()}"
+        )
@@ -0,0 +1,47 @@
+# type: ignore
+# flake8: noqa ANN201
+import json
+import time
+from contextlib import contextmanager
+
+import pytest
+
+
+class BenchmarkResults:
+    """Collects the timings of the benchmarks.
+
+    Each result has the benchmark name, the data size, the elapsed time and the
+    throughput in flows per second."""
+
+    def __init__(self):
+        self.results = []
+
+    @contextmanager
+    def measure(self, name, flow_count, **extra):
+        start = time.perf_counter()
+        yield
+        self.record(name, flow_count, time.perf_counter() - start, **extra)
+
+    def record(self, name, flow_count, elapsed, **extra):
+        result = {
+            "name": name,
+            "flows": flow_count,
+            "seconds": elapsed,
+            "flows_per_second": flow_count / elapsed if elapsed else None,
+            **extra,
+        }
+        self.results.append(result)
+        print(
+            f"{name}: {flow_count} flows in {elapsed:.3f} s "
+            f"({result['flows_per_second'] or 0:.0f} flows/s)"
+        )
+
+
+@pytest.fixture(scope="session")
+def benchmark_results(request):
+    results = BenchmarkResults()
+    yield results
+    path = request.config.getoption("--benchmark-json")
+    if path:
+        with open(path, "w") as f:
+            json.dump(results.results, f, indent=2)
@@ -0,0 +1,119 @@
+# type: ignore
+# flake8: noqa ANN201
+"""
+Generator for synthetic intersection data of any size, used by the benchmarks.
+
+The intersections are placed on a grid. Each intersection has 3-6 branches around
+its center and flows between its branches, optionally for many count periods.
+The data can be created both as plain data and as QGIS memory layers that have
+the same fields as the real data.
+"""
+import math
+import random
+from typing import Dict, List, Optional, Tuple
+
+from qgis.core import QgsFeature, QgsField, QgsGeometry, QgsPointXY, QgsVectorLayer
+from qgis.PyQt.QtCore import QVariant
+
+from risteyslaskenta_package.intersection import Branch, Flow
+
+GRID_SPACING = 500
+CRS = "EPSG:3067"
+
+
+def generate_intersections(
+    intersection_count: int,
+    min_branches: int = 3,
+    max_branches: int = 6,
+    direction_pairs: Optional[int] = None,
+    periods: int = 1,
+    seed: int = 0,
+) -> Tuple[Dict[str, List[Branch]], Dict[str, List[Tuple[Flow, str]]]]:
+    """Generates the branches and flows of the intersections.
+
+    :param direction_pairs: Number of direction pairs with traffic per
+        intersection. By default, all pairs of different branches have traffic.
+    :param periods: Number of count periods, i.e. rows per direction pair.
+    :returns: The branches and the (flow, period) pairs by intersection id.
+    """
+    rng = random.Random(seed)
+    columns = math.ceil(math.sqrt(intersection_count))
+    branches_by_id: Dict[str, List[Branch]] = {}
+    flows_by_id: Dict[str, List[Tuple[Flow, str]]] = {}
+    for i in range(intersection_count):
+        intersection_id = f"{i + 1:06d}"
+        piste = intersection_id[-2:]
+        center_x = (i % columns) * GRID_SPACING
+        center_y = (i // columns) * GRID_SPACING
+        branch_count = rng.randint(min_branches, max_branches)
+
+        branches = []
+        for haara in range(1, branch_count + 1):
+            bearing = 2 * math.pi * (haara - 1) / branch_count + rng.uniform(-0.2, 0.2)
+            radius = rng.uniform(20, 40)
+            branches.append(
+                Branch(
+                    piste,
+                    str(haara),
+                    center_x + radius * math.sin(bearing),
+                    center_y + radius * math.cos(bearing),
+                )
+            )
+        branches_by_id[intersection_id] = branches
+
+        pairs = [
+            f"{start}{end}"
+            for start in range(1, branch_count + 1)
+            for end in range(1, branch_count + 1)
+            if start != end
+        ]
+        if direction_pairs is not None:
+            pairs = rng.sample(pairs, min(direction_pairs, len(pairs)))
+        flows_by_id[intersection_id] = [
+            (Flow(intersection_id, direction, rng.randint(0, 1000)), f"P{period}")
+            for direction in pairs
+            for period in range(periods)
+        ]
+    return branches_by_id, flows_by_id
+
+
+def create_points_layer(branches_by_id: Dict[str, List[Branch]]) -> QgsVectorLayer:
+    layer = QgsVectorLayer(f"Point?crs={CRS}", "points", "memory")
+    layer.dataProvider().addAttributes(
+        [
+            QgsField("RPH", QVariant.String),
+            QgsField("Piste", QVariant.String),
+            QgsField("Haara", QVariant.Int),
+        ]
+    )
+    layer.updateFields()
+    features = []
+    for intersection_id, branches in branches_by_id.items():
+        for branch in branches:
+            feat = QgsFeature(layer.fields())
+            feat.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(branch.x, branch.y)))
+            feat.setAttributes([intersection_id, branch.piste, int(branch.haara)])
+            features.append(feat)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+def create_data_layer(flows_by_id: Dict[str, List[Tuple[Flow, str]]]) -> QgsVectorLayer:
+    layer = QgsVectorLayer("NoGeometry", "data", "memory")
+    layer.dataProvider().addAttributes(
+        [
+            QgsField("id", QVariant.String),
+            QgsField("direction", QVariant.String),
+            QgsField("autot", QVariant.Int),
+            QgsField("period", QVariant.String),
+        ]
+    )
+    layer.updateFields()
+    features = []
+    for flows in flows_by_id.values():
+        for flow, period in flows:
+            feat = QgsFeature(layer.fields())
+            feat.setAttributes([flow.data_id, flow.direction, flow.autot, period])
+            features.append(feat)
+    layer.dataProvider().addFeatures(features)
+    return layer
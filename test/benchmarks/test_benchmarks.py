@@ -0,0 +1,203 @@
+# type: ignore
+# flake8: noqa ANN201
+"""
+Benchmarks of the processing stages with synthetic data.
+
+Run with `pytest test/benchmarks --benchmark -s`, and add
+`--benchmark-json results.json` to save the results for comparison.
+"""
+import numpy as np
+import pytest
+from qgis.core import QgsCoordinateReferenceSystem
+
+from risteyslaskenta_package.geometry import (
+    Segmentation,
+    calculate_curve_points,
+    segmentize_curves,
+)
+from risteyslaskenta_package.intersection import (
+    BranchPoints,
+    calculate_intersection_center_point,
+    compute_intersection,
+    find_start_and_end_points,
+)
+from risteyslaskenta_package.normalization import (
+    NORMALIZATION_MODES,
+    Normalization,
+    normalize_counts,
+)
+from risteyslaskenta_package.risteyslaskenta_functions import (
+    COMPUTE_CHUNK_SIZE,
+    FeatureBatchWriter,
+    branch_from_feature,
+    create_intersection_result,
+    create_result_layer,
+    flow_from_feature,
+    group_features_by_field,
+    process_intersections,
+)
+
+from .synthetic_data import (
+    CRS,
+    create_data_layer,
+    create_points_layer,
+    generate_intersections,
+)
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.fixture(scope="module", params=[100, 1000], ids=lambda count: f"{count}")
+def generated_data(request):
+    return generate_intersections(request.param, periods=4)
+
+
+@pytest.fixture(scope="module")
+def synthetic_data(generated_data):
+    branches_by_id, flows_by_id = generated_data
+    flows_by_id = {
+        intersection_id: [flow for flow, _ in flows]
+        for intersection_id, flows in flows_by_id.items()
+    }
+    flow_count = sum(len(flows) for flows in flows_by_id.values())
+    return branches_by_id, flows_by_id, flow_count
+
+
+@pytest.fixture(scope="module")
+def synthetic_layers(generated_data):
+    branches_by_id, flows_by_id = generated_data
+    return create_data_layer(flows_by_id), create_points_layer(branches_by_id)
+
+
+def _matched_points(branches, flows):
+    branch_points = BranchPoints(branches)
+    matches = [find_start_and_end_points(flow, branch_points) for flow in flows]
+    return (
+        np.array([start for start, end in matches if start and end]),
+        np.array([end for start, end in matches if start and end]),
+    )
+
+
+def test_benchmark_matching(synthetic_data, benchmark_results):
+    branches_by_id, flows_by_id, flow_count = synthetic_data
+    with benchmark_results.measure("matching", flow_count):
+        for intersection_id, flows in flows_by_id.items():
+            branch_points = BranchPoints(branches_by_id[intersection_id])
+            for flow in flows:
+                find_start_and_end_points(flow, branch_points)
+
+
+def test_benchmark_geometry(synthetic_data, benchmark_results):
+    branches_by_id, flows_by_id, flow_count = synthetic_data
+    inputs = []
+    for intersection_id, flows in flows_by_id.items():
+        branches = branches_by_id[intersection_id]
+        start_points, end_points = _matched_points(branches, flows)
+        center_point = np.array(calculate_intersection_center_point(branches))
+        straight_roads = np.zeros(len(start_points), dtype=bool)
+        inputs.append((start_points, end_points, center_point, straight_roads))
+
+    with benchmark_results.measure("geometry per intersection", flow_count):
+        for start_points, end_points, center_point, straight_roads in inputs:
+            calculate_curve_points(
+                start_points, end_points, center_point, straight_roads
+            )
+
+    all_inputs = [
+        np.concatenate(arrays)
+        for arrays in zip(
+            *(
+                (starts, ends, np.broadcast_to(center, starts.shape), straight)
+                for starts, ends, center, straight in inputs
+            )
+        )
+    ]
+    with benchmark_results.measure("geometry whole dataset", flow_count):
+        curve_points = calculate_curve_points(*all_inputs)
+
+    with benchmark_results.measure("segmentize whole dataset", flow_count):
+        segmentize_curves(*curve_points, Segmentation(tolerance=0.5))
+
+
+def test_benchmark_normalization(synthetic_data, benchmark_results):
+    _, flows_by_id, flow_count = synthetic_data
+    all_flows = list(flows_by_id.values())
+    with benchmark_results.measure("normalization", flow_count):
+        # The same calculation as in write_intersection_results, one chunk of
+        # intersections at a time
+        for start in range(0, len(all_flows), COMPUTE_CHUNK_SIZE):
+            flows = [
+                flow
+                for intersection_flows in all_flows[start : start + COMPUTE_CHUNK_SIZE]
+                for flow in intersection_flows
+            ]
+            normalize_counts(
+                [flow.autot for flow in flows],
+                [flow.direction[0] for flow in flows],
+                [flow.data_id for flow in flows],
+            )
+
+
+def test_benchmark_all_normalizations(synthetic_data, benchmark_results):
+    _, flows_by_id, flow_count = synthetic_data
+    flows = [flow for flows in flows_by_id.values() for flow in flows]
+    counts = [flow.autot for flow in flows]
+    start_branches = [flow.direction[0] for flow in flows]
+    intersections = [flow.data_id for flow in flows]
+    with benchmark_results.measure("all normalizations", flow_count):
+        # All intersections of the dataset at once
+        normalize_counts(
+            counts,
+            start_branches,
+            intersections,
+            Normalization.from_counts(NORMALIZATION_MODES, counts),
+        )
+
+
+def test_benchmark_feature_writes(synthetic_layers, benchmark_results):
+    data_layer, points_layer = synthetic_layers
+    data_index = group_features_by_field(data_layer, "id")
+    points_index = group_features_by_field(points_layer, "RPH")
+    inputs = []
+    for intersection_id, data_feats in data_index.items():
+        curves = compute_intersection(
+            [flow_from_feature(feat) for feat in data_feats],
+            [branch_from_feature(feat) for feat in points_index[intersection_id]],
+        )
+        inputs.append((data_feats, curves))
+    result_layer = create_result_layer(
+        QgsCoordinateReferenceSystem(CRS), data_layer.fields()
+    )
+    writer = FeatureBatchWriter(result_layer.dataProvider())
+
+    with benchmark_results.measure("feature writes", data_layer.featureCount()):
+        for data_feats, curves in inputs:
+            result = create_intersection_result(
+                data_feats, curves, result_layer.fields()
+            )
+            writer.add_features(result.features)
+        writer.flush()
+
+    assert result_layer.featureCount() == writer.feature_count
+
+
+def test_benchmark_end_to_end(synthetic_layers, benchmark_results):
+    data_layer, points_layer = synthetic_layers
+    result_layer = create_result_layer(
+        QgsCoordinateReferenceSystem(CRS), data_layer.fields()
+    )
+    flow_count = data_layer.featureCount()
+
+    with benchmark_results.measure("end to end", flow_count):
+        with benchmark_results.measure("read and index", flow_count):
+            data_index = group_features_by_field(data_layer, "id")
+            points_index = group_features_by_field(points_layer, "RPH")
+        summary = process_intersections(
+            data_index,
+            points_index,
+            result_layer.fields(),
+            FeatureBatchWriter(result_layer.dataProvider()),
+        )
+
+    assert summary.failed_count == 0
+    assert summary.feature_count == flow_count
@@ -0,0 +1,54 @@
+# type: ignore
+# flake8: noqa ANN201
+"""
+Benchmarks of the import cost of the plugin modules, i.e. what loading the plugin
+adds to the start of QGIS and what is left for the first run.
+"""
+import subprocess
+import sys
+
+import pytest
+
+pytestmark = pytest.mark.benchmark
+
+# Each import is timed in a new interpreter this many times, the fastest is kept
+IMPORT_REPEATS = 5
+
+# QGIS itself is imported before starting the timer, as it is loaded anyway
+IMPORT_TIMING = """
+import sys
+import time
+
+import qgis.core, qgis.gui, qgis.utils
+
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, "numpy" in sys.modules)
+"""
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        # Loaded when QGIS starts
+        "risteyslaskenta_package.plugin",
+        # Loaded after QGIS has started
+        "risteyslaskenta_package.processing_provider.provider",
+        # Loaded on the first run
+        "risteyslaskenta_package.ui.risteyslaskenta_dialog",
+    ],
+    ids=["plugin", "processing provider", "dialog"],
+)
+def test_benchmark_import(module, benchmark_results):
+    timings = []
+    for _ in range(IMPORT_REPEATS):
+        elapsed, numpy_loaded = subprocess.run(
+            [sys.executable, "-c", IMPORT_TIMING.format(module=module)],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.split()
+        timings.append(float(elapsed))
+    benchmark_results.record(
+        f"import {module}", 0, min(timings), numpy_loaded=numpy_loaded == "True"
+    )
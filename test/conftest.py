@@ -13,3 +13,28 @@ pytest-qgis (https://pypi.org/project/pytest-qgis) contains the following helpfu
   This should be used with tests that add stuff to QgsProject.
 
 """
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark", action="store_true", help="run the benchmarks in test/benchmarks"
+    )
+    parser.addoption(
+        "--benchmark-json", metavar="PATH", help="write the benchmark results as JSON"
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: performance benchmark, only run with --benchmark"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip_benchmark = pytest.mark.skip(reason="benchmarks are run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
@@ -0,0 +1,13 @@
+import pytest
+
+from risteyslaskenta_package.aggregation import aggregate_counts
+
+
+@pytest.mark.parametrize("method, expected", [("sum", 36), ("mean", 12), ("max", 20)])
+def test_aggregate_counts(method, expected):
+    assert aggregate_counts([10, 6, 20], method) == expected
+
+
+def test_aggregate_counts_with_unknown_method():
+    with pytest.raises(ValueError):
+        aggregate_counts([10], "median")
@@ -0,0 +1,30 @@
+from risteyslaskenta_package.branch_grid import BranchGrid, add_nearby_branches
+from risteyslaskenta_package.intersection import Branch, Flow
+
+BRANCHES = [
+    Branch("1", "1", 0.0, 10.0),
+    Branch("1", "2", 10.0, 0.0),
+    Branch("9", "3", 0.0, -10.0),
+    Branch("8", "3", 0.0, -150.0),
+    Branch("7", "4", 1000.0, 0.0),
+]
+
+
+def test_branch_grid_finds_nearest_branch_by_number():
+    grid = BranchGrid(BRANCHES, radius=100.0)
+    assert grid.find((0.0, 0.0), "3") == BRANCHES[2]
+    assert grid.find((0.0, -140.0), "3") == BRANCHES[3]
+    assert grid.find((0.0, 0.0), "4") is None
+    assert grid.find((0.0, 0.0), "5") is None
+
+
+def test_add_nearby_branches():
+    grid = BranchGrid(BRANCHES, radius=100.0)
+    flows = [Flow("A1", "13", 10), Flow("A1", "14", 10)]
+    assert add_nearby_branches(flows, BRANCHES[:2], grid) == BRANCHES[:3]
+    # Intersections without any branches need a location
+    assert add_nearby_branches(flows, [], grid) == []
+    assert add_nearby_branches(flows, [], grid, (0.0, 0.0)) == [
+        BRANCHES[0],
+        BRANCHES[2],
+    ]
@@ -0,0 +1,58 @@
+from qgis.core import QgsFeature, QgsField, QgsGeometry, QgsVectorLayer
+from qgis.PyQt.QtCore import QVariant
+
+from risteyslaskenta_package.risteyslaskenta_functions import CentroidCache
+
+
+def create_polygon_layer() -> QgsVectorLayer:
+    layer = QgsVectorLayer("Polygon?crs=EPSG:3067", "branches", "memory")
+    layer.dataProvider().addAttributes(
+        [
+            QgsField("RPH", QVariant.String),
+            QgsField("Piste", QVariant.String),
+            QgsField("Haara", QVariant.Int),
+        ]
+    )
+    layer.updateFields()
+    feats = []
+    for intersection_id, x in (("1", 0), ("2", 100)):
+        feat = QgsFeature(layer.fields())
+        feat.setGeometry(
+            QgsGeometry.fromWkt(f"POLYGON(({x} 0, {x + 2} 0, {x + 2} 2, {x} 2, {x} 0))")
+        )
+        feat.setAttributes([intersection_id, "1", 1])
+        feats.append(feat)
+    layer.dataProvider().addFeatures(feats)
+    return layer
+
+
+def test_centroid_cache_is_invalidated_when_layer_changes():
+    layer = create_polygon_layer()
+    cache = CentroidCache()
+    cache.watch(layer)
+
+    index = cache.group_features(layer.id(), layer, ["1", "3"])
+    assert list(index) == ["1"]
+    assert index["1"][0].geometry().asPoint().x() == 1
+
+    layer.startEditing()
+    layer.changeGeometry(
+        index["1"][0].id(), QgsGeometry.fromWkt("POLYGON((10 0, 14 0, 14 4, 10 0))")
+    )
+    index = cache.group_features(layer.id(), layer, ["1", "2"])
+    assert index["1"][0].geometry().asPoint().x() > 10
+    assert index["2"][0].geometry().asPoint().x() == 101
+    layer.rollBack()
+
+
+def test_centroid_cache_is_invalidated_when_layer_filter_changes():
+    layer = create_polygon_layer()
+    cache = CentroidCache()
+    cache.watch(layer)
+
+    index = cache.group_features(layer.id(), layer, ["1", "2"])
+    assert sorted(index) == ["1", "2"]
+
+    layer.setSubsetString("\"RPH\" = '2'")
+    index = cache.group_features(layer.id(), layer, ["1", "2"])
+    assert list(index) == ["2"]
@@ -0,0 +1,92 @@
+import numpy as np
+
+from risteyslaskenta_package.geometry import (
+    Segmentation,
+    calculate_curve_points,
+    segmentize_curves,
+)
+
+
+def test_calculate_curve_points_turn_towards_center():
+    starts, middles, ends = calculate_curve_points(
+        np.array([(0.0, 0.0)]), np.array([(10.0, 0.0)]), np.array((5.0, 5.0)), [False]
+    )
+    np.testing.assert_allclose(starts, [(0, -10)])
+    np.testing.assert_allclose(middles, [(5, -7.5)])
+    np.testing.assert_allclose(ends, [(10, -10)])
+
+
+def test_calculate_curve_points_turn_away_from_center():
+    _, middles, _ = calculate_curve_points(
+        np.array([(0.0, 0.0)]), np.array([(10.0, 0.0)]), np.array((5.0, -5.0)), [False]
+    )
+    np.testing.assert_allclose(middles, [(5, 3.5)])
+
+
+def test_calculate_curve_points_straight_road():
+    starts, middles, ends = calculate_curve_points(
+        np.array([(0.0, 0.0)]), np.array([(10.0, 0.0)]), np.array((5.0, 5.0)), [True]
+    )
+    np.testing.assert_allclose(starts, [(0, -2)])
+    np.testing.assert_allclose(middles, [(5, -2)])
+    np.testing.assert_allclose(ends, [(10, -2)])
+
+
+def test_calculate_curve_points_reverts_to_straight_middle_point():
+    _, middles, _ = calculate_curve_points(
+        np.array([(0.0, 0.0)]), np.array([(2.0, 0.0)]), np.array((0.0, 20.0)), [False]
+    )
+    np.testing.assert_allclose(middles, [(1, -10)])
+
+
+def test_calculate_curve_points_many_flows():
+    starts, middles, ends = calculate_curve_points(
+        np.array([(0.0, 0.0), (0.0, 0.0)]),
+        np.array([(10.0, 0.0), (10.0, 0.0)]),
+        np.array([(5.0, 5.0), (5.0, -5.0)]),
+        np.array([False, True]),
+    )
+    np.testing.assert_allclose(middles, [(5, -7.5), (5, -2)])
+    assert starts.shape == ends.shape == (2, 2)
+
+
+def test_segmentize_curves_with_vertex_count():
+    lines = segmentize_curves(
+        np.array([(0.0, 0.0), (0.0, 0.0)]),
+        np.array([(1.0, 1.0), (1.0, 0.0)]),
+        np.array([(2.0, 0.0), (2.0, 0.0)]),
+        Segmentation(vertex_count=5),
+    )
+    assert len(lines) == 2
+    # The arc passes through the middle point, on a circle of radius 1
+    np.testing.assert_allclose(
+        lines[0],
+        [
+            (0, 0),
+            (1 - 0.5**0.5, 0.5**0.5),
+            (1, 1),
+            (1 + 0.5**0.5, 0.5**0.5),
+            (2, 0),
+        ],
+        atol=1e-12,
+    )
+    # Straight roads are kept as the three points
+    np.testing.assert_allclose(lines[1], [(0, 0), (1, 0), (2, 0)])
+
+
+def test_segmentize_curves_with_tolerance():
+    (coarse,) = segmentize_curves(
+        np.array([(0.0, 0.0)]),
+        np.array([(1.0, -1.0)]),
+        np.array([(2.0, 0.0)]),
+        Segmentation(tolerance=0.1),
+    )
+    (fine,) = segmentize_curves(
+        np.array([(0.0, 0.0)]),
+        np.array([(1.0, -1.0)]),
+        np.array([(2.0, 0.0)]),
+        Segmentation(tolerance=0.001),
+    )
+    assert len(coarse) < len(fine)
+    np.testing.assert_allclose(np.hypot(fine[:, 0] - 1, fine[:, 1]), 1)
+    assert (fine[1:-1, 1] < 0).all()
@@ -0,0 +1,67 @@
+import numpy as np
+
+from risteyslaskenta_package.geometry_cache import COMMIT_INTERVAL, GeometryCache
+from risteyslaskenta_package.intersection import Branch, Flow, compute_intersection
+
+BRANCHES = [
+    Branch("1", "1", 0.0, 10.0),
+    Branch("1", "2", 10.0, 0.0),
+    Branch("1", "3", 0.0, -10.0),
+]
+FLOWS = [Flow("A1", "12", 10), Flow("A1", "13", 30), Flow("A1", "14", 5)]
+
+
+def test_geometry_cache_returns_stored_curves(tmp_path):
+    cache = GeometryCache(str(tmp_path / "cache.sqlite"))
+    assert cache.load("A1", FLOWS, BRANCHES) is None
+
+    curves = compute_intersection(FLOWS, BRANCHES)
+    cache.store("A1", FLOWS, BRANCHES, curves)
+    cached_curves = cache.load("A1", FLOWS, BRANCHES)
+
+    assert cached_curves.matched_rows == curves.matched_rows
+    assert cached_curves.unmatched_rows == curves.unmatched_rows
+    np.testing.assert_array_equal(cached_curves.middle_points, curves.middle_points)
+    assert cached_curves.autot_max == curves.autot_max
+    cache.close()
+
+
+def test_geometry_cache_is_invalidated_when_branches_move(tmp_path):
+    cache = GeometryCache(str(tmp_path / "cache.sqlite"))
+    cache.store("A1", FLOWS, BRANCHES, compute_intersection(FLOWS, BRANCHES))
+    moved_branches = [BRANCHES[0]._replace(x=1.0), *BRANCHES[1:]]
+
+    assert cache.load("A1", FLOWS, moved_branches) is None
+    assert cache.load("A1", [*FLOWS, Flow("A1", "21", 1)], BRANCHES) is None
+    cache.close()
+
+
+def test_geometry_cache_commits_in_batches(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = GeometryCache(path)
+    other_cache = GeometryCache(path)
+    curves = compute_intersection(FLOWS, BRANCHES)
+    for i in range(COMMIT_INTERVAL):
+        cache.store(str(i), FLOWS, BRANCHES, curves)
+
+    assert other_cache.load("0", FLOWS, BRANCHES) is not None
+    cache.close()
+    other_cache.close()
+
+
+def test_locked_geometry_cache_is_a_cache_miss(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = GeometryCache(path)
+    other_cache = GeometryCache(path, timeout=0.1)
+    curves = compute_intersection(FLOWS, BRANCHES)
+    cache.store("A1", FLOWS, BRANCHES, curves)
+    # The uncommitted curves of the first cache keep the other one from writing
+    other_cache.store("A2", FLOWS, BRANCHES, curves)
+    assert other_cache.load("A1", FLOWS, BRANCHES) is None
+    other_cache.close()
+
+    cache.close()
+    other_cache = GeometryCache(path)
+    assert other_cache.load("A1", FLOWS, BRANCHES) is not None
+    assert other_cache.load("A2", FLOWS, BRANCHES) is None
+    other_cache.close()
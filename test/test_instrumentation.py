@@ -0,0 +1,49 @@
+import json
+
+from risteyslaskenta_package.instrumentation import (
+    DISABLED_TIMER,
+    SLOWEST_INTERSECTION_COUNT,
+    StageTimer,
+)
+
+
+def test_stage_timer_report(tmp_path):
+    timer = StageTimer()
+    for _ in range(3):
+        with timer.stage("matching"):
+            pass
+    for i in range(SLOWEST_INTERSECTION_COUNT + 5):
+        timer.add_intersection(str(i), float(i))
+
+    report_path = tmp_path / "report.json"
+    timer.write_report(str(report_path))
+    report = json.loads(report_path.read_text())
+
+    assert report["stages"]["matching"]["calls"] == 3
+    assert [item["id"] for item in report["slowest_intersections"]] == [
+        str(i) for i in range(SLOWEST_INTERSECTION_COUNT + 4, 4, -1)
+    ]
+
+
+def test_stage_timer_adds_unfinished_intersection_time():
+    timer = StageTimer()
+    timer.add_intersection_time("1", 2.0)
+    timer.add_intersection_time("2", 0.5)
+    timer.add_intersection("1", 1.0)
+    timer.add_intersection("2", 1.0)
+
+    assert timer.report()["slowest_intersections"] == [
+        {"id": "1", "seconds": 3.0},
+        {"id": "2", "seconds": 1.5},
+    ]
+
+
+def test_disabled_timer_records_nothing():
+    with DISABLED_TIMER.stage("matching"):
+        pass
+    DISABLED_TIMER.add_intersection_time("1", 1.0)
+    DISABLED_TIMER.add_intersection("1", 1.0)
+
+    report = DISABLED_TIMER.report()
+    assert report["stages"] == {}
+    assert report["slowest_intersections"] == []
@@ -0,0 +1,61 @@
+from risteyslaskenta_package.intersection import (
+    Branch,
+    Flow,
+    IntersectionTopology,
+    compute_intersection,
+)
+
+BRANCHES = [
+    Branch("1", "1", 0.0, 10.0),
+    Branch("1", "2", 10.0, 0.0),
+    Branch("1", "3", 0.0, -10.0),
+    Branch("1", "4", -10.0, 0.0),
+]
+
+
+def test_compute_intersection_without_branches():
+    assert compute_intersection([Flow("A1", "12", 10)], []) is None
+
+
+def test_compute_intersection_matches_flows():
+    flows = [
+        Flow("A1", "12", 10),
+        Flow("A1", "13", 30),
+        Flow("A2", "12", 5),
+        Flow("A1", "11", 5),
+        Flow("A1", "15", 5),
+    ]
+    curves = compute_intersection(flows, BRANCHES)
+    assert curves.matched_rows == [0, 1]
+    assert curves.unmatched_rows == [2, 3, 4]
+    assert (curves.autot_max, curves.autot_min) == (30, 10)
+    assert curves.start_points.shape == (2, 2)
+
+
+def test_compute_intersection_with_branch_fallback():
+    flows = [Flow("A2", "12", 5), Flow("A1", "15", 5)]
+    curves = compute_intersection(flows, BRANCHES, branch_fallback=True)
+    assert curves.matched_rows == [0]
+    assert curves.unmatched_rows == [1]
+
+
+def test_intersection_topology_straight_roads():
+    # T-intersection, the through road is 1-3
+    branches = [
+        Branch("1", "1", -10.0, 0.0),
+        Branch("1", "2", 0.0, -10.0),
+        Branch("1", "3", 10.0, 1.0),
+    ]
+    topology = IntersectionTopology(branches, (0.0, 0.0))
+    assert topology.branch_count == 3
+    straight_roads = topology.are_straight_roads(
+        [Flow("A1", "13", 1), Flow("A1", "31", 1), Flow("A1", "12", 1)]
+    )
+    assert straight_roads.tolist() == [True, True, False]
+
+
+def test_intersection_topology_five_branches():
+    branches = BRANCHES + [Branch("1", "5", 7.0, 7.0)]
+    topology = IntersectionTopology(branches, (0.0, 0.0))
+    assert topology.straight_roads[0, 2] and topology.straight_roads[1, 3]
+    assert not topology.straight_roads[4].any()
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from risteyslaskenta_package.intersection import Branch, Flow
+from risteyslaskenta_package.intersection_tables import (
+    NO_SOURCE_ROW,
+    IntersectionTables,
+)
+
+INTERSECTIONS = [
+    (
+        "A1",
+        [Flow("A1", "12", 10), Flow("A1", "1", 3), Flow("A1", "123", 0)],
+        [Branch("1", "1", 0.0, 10.0), Branch("1", "2", 10.5, -2.25)],
+        [5, 6, 7],
+    ),
+    # No branch locations
+    ("Ä2", [Flow("Ä2", "21", 7)], [], [8]),
+    # No source rows
+    ("B3", [Flow("B3", "34", 1)], [Branch("3", "3", 1.0, 1.0)], []),
+]
+
+
+def test_tables_round_trip():
+    tables = IntersectionTables.from_intersections(INTERSECTIONS)
+    assert len(tables) == 3
+    assert tables.flows["autot"].tolist() == [10, 3, 0, 7, 1]
+    assert tables.branches["intersection"].tolist() == ["A1", "A1", "B3"]
+
+    prepared = list(tables.prepared_intersections())
+    assert prepared[:2] == INTERSECTIONS[:2]
+    assert prepared[2] == INTERSECTIONS[2][:3] + ([NO_SOURCE_ROW],)
+
+
+@pytest.mark.parametrize("file_name", ["inputs.npz", "inputs"])
+def test_saved_tables_are_loaded(tmp_path, file_name):
+    path = str(tmp_path / file_name)
+    assert not IntersectionTables.exists(path)
+    IntersectionTables.from_intersections(INTERSECTIONS).save(path)
+    assert IntersectionTables.exists(path)
+    tables = IntersectionTables.load(path)
+    if file_name == "inputs":
+        assert isinstance(tables.flows, np.memmap)
+    assert list(tables.prepared_intersections())[:2] == INTERSECTIONS[:2]
+
+
+def test_empty_tables():
+    tables = IntersectionTables.from_intersections([])
+    assert len(tables) == 0
+    assert list(tables.prepared_intersections()) == []
@@ -0,0 +1,118 @@
+from qgis.core import (
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsField,
+    QgsGeometry,
+    QgsVectorLayer,
+)
+from qgis.PyQt.QtCore import QVariant
+
+from risteyslaskenta_package.live_refresh import LiveRefresh
+from risteyslaskenta_package.risteyslaskenta_functions import (
+    FeatureBatchWriter,
+    create_data_request,
+    create_result_layer,
+    group_features_by_field,
+    process_intersections,
+)
+
+
+def create_layers():
+    data_layer = QgsVectorLayer("NoGeometry", "data", "memory")
+    data_layer.dataProvider().addAttributes(
+        [
+            QgsField("id", QVariant.String),
+            QgsField("direction", QVariant.String),
+            QgsField("autot", QVariant.Int),
+        ]
+    )
+    data_layer.updateFields()
+    data_feats = []
+    for direction, autot in (("12", 10), ("13", 20)):
+        feat = QgsFeature(data_layer.fields())
+        feat.setAttributes(["1", direction, autot])
+        data_feats.append(feat)
+    data_layer.dataProvider().addFeatures(data_feats)
+
+    points_layer = QgsVectorLayer("Point?crs=EPSG:3067", "branches", "memory")
+    points_layer.dataProvider().addAttributes(
+        [
+            QgsField("RPH", QVariant.String),
+            QgsField("Piste", QVariant.String),
+            QgsField("Haara", QVariant.String),
+        ]
+    )
+    points_layer.updateFields()
+    points_feats = []
+    for haara, x, y in (("1", -10, 0), ("2", 0, 10), ("3", 10, 0), ("4", 0, -10)):
+        feat = QgsFeature(points_layer.fields())
+        feat.setGeometry(QgsGeometry.fromWkt(f"POINT({x} {y})"))
+        feat.setAttributes(["1", "1", haara])
+        points_feats.append(feat)
+    points_layer.dataProvider().addFeatures(points_feats)
+    return data_layer, points_layer
+
+
+def create_linked_result():
+    data_layer, points_layer = create_layers()
+    result_layer = create_result_layer(points_layer.crs(), data_layer.fields())
+    process_intersections(
+        group_features_by_field(data_layer, "id"),
+        group_features_by_field(points_layer, "RPH"),
+        result_layer.fields(),
+        FeatureBatchWriter(result_layer.dataProvider()),
+    )
+    refresh = LiveRefresh(
+        data_layer,
+        points_layer,
+        result_layer,
+        create_data_request(data_layer.fields(), data_layer.fields()),
+        data_layer.fields(),
+    )
+    return data_layer, result_layer, refresh
+
+
+def result_values(result_layer):
+    return {
+        feat["direction"]: (feat["autot"], feat["intersection_autot_normalized"])
+        for feat in result_layer.getFeatures()
+    }
+
+
+def test_changed_counts_are_updated_in_place():
+    data_layer, result_layer, refresh = create_linked_result()
+    geometries = {
+        feat.id(): feat.geometry().asWkt() for feat in result_layer.getFeatures()
+    }
+
+    data_layer.startEditing()
+    fid = next(
+        data_layer.getFeatures(QgsFeatureRequest().setFilterExpression("autot = 10"))
+    ).id()
+    data_layer.changeAttributeValue(fid, data_layer.fields().indexOf("autot"), 40)
+    refresh.refresh()
+
+    assert result_values(result_layer) == {"12": (40, 1.0), "13": (20, 0.5)}
+    assert {
+        feat.id(): feat.geometry().asWkt() for feat in result_layer.getFeatures()
+    } == geometries
+    data_layer.rollBack()
+
+
+def test_added_flow_replaces_intersection_features():
+    data_layer, result_layer, refresh = create_linked_result()
+
+    data_layer.startEditing()
+    feat = QgsFeature(data_layer.fields())
+    feat.setAttributes(["1", "24", 80])
+    data_layer.addFeature(feat)
+    refresh.refresh()
+
+    assert result_values(result_layer) == {
+        "12": (10, 0.125),
+        "13": (20, 0.25),
+        "24": (80, 1.0),
+    }
+    data_layer.rollBack()
+    refresh.refresh()
+    assert result_values(result_layer) == {"12": (10, 0.5), "13": (20, 1.0)}
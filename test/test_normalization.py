@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from risteyslaskenta_package.normalization import (
+    INTERSECTION_NORMALIZATION,
+    Normalization,
+    normalize_counts,
+)
+
+
+def test_normalize_counts_of_many_intersections():
+    normalization = Normalization.from_counts(
+        ["global_max", "branch_share", "quantile_rank"], [10, 30, 20, 40]
+    )
+    values = normalize_counts(
+        [10, 30, 20, 40], ["1", "1", "1", "2"], ["A", "A", "B", "B"], normalization
+    )
+    np.testing.assert_allclose(
+        values[INTERSECTION_NORMALIZATION], [1 / 3, 1.0, 0.5, 1.0]
+    )
+    np.testing.assert_allclose(values["global_max"], [0.25, 0.75, 0.5, 1.0])
+    np.testing.assert_allclose(values["branch_share"], [0.25, 0.75, 1.0, 1.0])
+    np.testing.assert_allclose(values["quantile_rank"], [0.25, 0.75, 0.5, 1.0])
+
+
+def test_normalize_counts_without_traffic():
+    values = normalize_counts([0, 0], ["1", "2"])
+    np.testing.assert_array_equal(values[INTERSECTION_NORMALIZATION], [0.0, 0.0])
+
+
+def test_unknown_normalization():
+    with pytest.raises(ValueError):
+        Normalization.from_counts(["median"])
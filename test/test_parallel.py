@@ -0,0 +1,77 @@
+import math
+import random
+import subprocess
+import sys
+
+import numpy as np
+
+from risteyslaskenta_package.intersection import Branch, Flow, compute_intersection
+from risteyslaskenta_package.parallel import IntersectionPool
+
+
+def _generate_inputs(count, seed=0):
+    rng = random.Random(seed)
+    inputs = []
+    for i in range(count):
+        branch_count = rng.randint(3, 5)
+        branches = [
+            Branch(
+                "1",
+                str(haara),
+                i * 100 + 30 * math.sin(2 * math.pi * haara / branch_count),
+                30 * math.cos(2 * math.pi * haara / branch_count),
+            )
+            for haara in range(1, branch_count + 1)
+        ]
+        flows = [
+            Flow(str(i), f"{start}{end}", rng.randint(0, 100))
+            for start in range(1, branch_count + 2)
+            for end in range(1, branch_count + 1)
+            if start != end
+        ]
+        # Some intersections have no branch locations
+        inputs.append((flows, branches if i % 7 else []))
+    return inputs
+
+
+def test_pool_matches_serial_calculation():
+    inputs = _generate_inputs(50)
+    expected = [compute_intersection(flows, branches) for flows, branches in inputs]
+    pool = IntersectionPool(2)
+    try:
+        results = list(pool.map(inputs))
+    finally:
+        pool.close()
+
+    assert len(results) == len(expected)
+    for result, expected_curves in zip(results, expected):
+        if expected_curves is None:
+            assert result is None
+            continue
+        assert result.matched_rows == expected_curves.matched_rows
+        assert result.unmatched_rows == expected_curves.unmatched_rows
+        assert (result.autot_max, result.autot_min) == (
+            expected_curves.autot_max,
+            expected_curves.autot_min,
+        )
+        np.testing.assert_array_equal(result.start_points, expected_curves.start_points)
+        np.testing.assert_array_equal(
+            result.middle_points, expected_curves.middle_points
+        )
+        np.testing.assert_array_equal(result.end_points, expected_curves.end_points)
+
+
+def test_worker_modules_do_not_import_qgis():
+    # The workers only import the package and the modules of the calculation
+    imported = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, risteyslaskenta_package.parallel; "
+            "print(any(name.startswith('qgis') for name in sys.modules))",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.strip()
+    assert imported == "False"
@@ -1,5 +1,49 @@
+import subprocess
+import sys
+
 from risteyslaskenta_package.qgis_plugin_tools.tools.resources import plugin_name
 
 
 def test_plugin_name():
     assert plugin_name() == "risteyslaskenta"
+
+
+def test_plugin_import_does_not_load_processing_modules():
+    # A new interpreter, as the tests have already imported the modules
+    loaded_modules = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, risteyslaskenta_package.plugin; print(*sys.modules)",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.split()
+    for module in (
+        "risteyslaskenta_package.risteyslaskenta_functions",
+        "risteyslaskenta_package.processing_provider.provider",
+        "risteyslaskenta_package.ui.risteyslaskenta_dialog",
+    ):
+        assert module not in loaded_modules
+
+
+def test_provider_import_does_not_load_processing_modules():
+    # The algorithms import the processing modules only when they are run
+    loaded_modules = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, risteyslaskenta_package.processing_provider.provider; "
+            "print(*sys.modules)",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.split()
+    for module in (
+        "numpy",
+        "risteyslaskenta_package.risteyslaskenta_functions",
+        "risteyslaskenta_package.normalization",
+    ):
+        assert module not in loaded_modules
@@ -0,0 +1,321 @@
+import json
+from collections import defaultdict, deque
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from qgis.core import (
+    QgsFeature,
+    QgsFeedback,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsPointXY,
+    QgsVectorLayer,
+)
+from qgis.PyQt.QtCore import QVariant
+
+from risteyslaskenta_package import risteyslaskenta_functions
+from risteyslaskenta_package.aggregation import AggregationSettings
+from risteyslaskenta_package.instrumentation import StageTimer
+from risteyslaskenta_package.intersection import Branch, Flow, compute_intersection
+from risteyslaskenta_package.normalization import Normalization
+from risteyslaskenta_package.risteyslaskenta_functions import (
+    PERIOD_COUNTS_FIELD,
+    UNMATCHED_LOG_LIMIT,
+    FeatureBatchWriter,
+    RunSummary,
+    aggregate_data_groups,
+    batch_layer_names,
+    branch_from_feature,
+    compute_intersections,
+    create_aggregated_fields,
+    create_data_request,
+    create_result_fields,
+    dataset_counts,
+    flow_from_feature,
+    group_features_by_field,
+    iterate_feature_groups,
+    normalize_intersections,
+    process_intersection_groups,
+    select_data_fields,
+)
+from risteyslaskenta_package.sql_pushdown import connect, query_counts
+
+from .test_sql_pushdown import BRANCHES, DATA_ROWS, create_database
+
+
+def test_group_features_by_field_with_selected_fields():
+    layer = QgsVectorLayer("NoGeometry", "data", "memory")
+    layer.dataProvider().addAttributes(
+        [
+            QgsField("id", QVariant.String),
+            QgsField("comment", QVariant.String),
+            QgsField("direction", QVariant.String),
+            QgsField("autot", QVariant.Int),
+            QgsField("period", QVariant.String),
+        ]
+    )
+    layer.updateFields()
+    feat = QgsFeature(layer.fields())
+    feat.setAttributes(["1", "wide", "12", 5, "2021-05-01"])
+    layer.dataProvider().addFeatures([feat])
+
+    fields = select_data_fields(layer.fields(), ["period"])
+    assert fields.names() == ["id", "direction", "autot", "period"]
+
+    index = group_features_by_field(
+        layer, "id", create_data_request(layer.fields(), fields), fields
+    )
+    assert index["1"][0].attributes() == ["1", "12", 5, "2021-05-01"]
+
+
+def test_iterate_feature_groups_orders_features_by_field():
+    layer = QgsVectorLayer("NoGeometry", "data", "memory")
+    layer.dataProvider().addAttributes(
+        [QgsField("id", QVariant.String), QgsField("direction", QVariant.String)]
+    )
+    layer.updateFields()
+    feats = []
+    for intersection_id, direction in (("2", "12"), ("1", "13"), ("2", "21")):
+        feat = QgsFeature(layer.fields())
+        feat.setAttributes([intersection_id, direction])
+        feats.append(feat)
+    layer.dataProvider().addFeatures(feats)
+
+    groups = [
+        (intersection_id, [feat["direction"] for feat in group_feats])
+        for intersection_id, group_feats in iterate_feature_groups(layer, "id")
+    ]
+    assert groups == [("1", ["13"]), ("2", ["12", "21"])]
+
+
+def test_aggregation_sums_the_rows_of_the_same_period():
+    fields = QgsFields()
+    for name, field_type in (
+        ("id", QVariant.String),
+        ("direction", QVariant.String),
+        ("autot", QVariant.Int),
+        ("period", QVariant.String),
+    ):
+        fields.append(QgsField(name, field_type))
+    feats = []
+    for autot, period in ((10, "morning"), (5, "morning"), (20, "evening")):
+        feat = QgsFeature(fields)
+        feat.setAttributes(["A1", "12", autot, period])
+        feats.append(feat)
+
+    ((intersection, aggregated_feats),) = aggregate_data_groups(
+        [("A1", feats)],
+        create_aggregated_fields(fields),
+        AggregationSettings("mean", "period"),
+    )
+    assert intersection == "A1"
+    # The mean of the periods, not of the rows
+    assert aggregated_feats[0]["autot"] == 18
+    assert json.loads(aggregated_feats[0][PERIOD_COUNTS_FIELD]) == {
+        "morning": 15,
+        "evening": 20,
+    }
+
+
+def test_batch_layer_names_are_unique():
+    assert batch_layer_names(
+        ["Laskenta 2021.csv", "laskenta-2021", "Batch summary", "***"]
+    ) == [
+        "laskenta_2021",
+        "laskenta_2021_2",
+        "batch_summary_2",
+        "intersections_visualized",
+    ]
+
+
+class BrokenPool:
+    def __init__(self, workers, branch_fallback):
+        self.closed = False
+
+    def map(self, intersection_inputs):
+        raise BrokenProcessPool("A worker could not be started")
+
+    def close(self):
+        self.closed = True
+
+
+def test_compute_intersections_falls_back_to_one_process(monkeypatch):
+    monkeypatch.setattr(risteyslaskenta_functions, "IntersectionPool", BrokenPool)
+    branches = [Branch("1", "1", 0.0, 10.0), Branch("1", "2", 10.0, 0.0)]
+    inputs = [("A1", [Flow("A1", "12", 10)], branches), ("A2", [], [])]
+    curves = list(compute_intersections(inputs, workers=2))
+    assert len(curves) == 2
+    assert curves[0].matched_rows == compute_intersection(*inputs[0][1:]).matched_rows
+    assert curves[1] is None
+
+
+def test_compute_intersections_records_the_time_of_each_intersection():
+    branches = [Branch("1", "1", 0.0, 10.0), Branch("1", "2", 10.0, 0.0)]
+    inputs = [("A1", [Flow("A1", "12", 10)], branches), ("A2", [], [])]
+    timer = StageTimer()
+    list(compute_intersections(inputs, timer=timer))
+    # The calculation time is added to the time of writing the intersection
+    timer.add_intersection("A1", 0.0)
+    timer.add_intersection("A2", 0.0)
+    assert all(
+        intersection["seconds"] > 0
+        for intersection in timer.report()["slowest_intersections"]
+    )
+
+
+def test_dataset_counts_match_query_counts(tmp_path):
+    data_layer = QgsVectorLayer("NoGeometry", "data", "memory")
+    data_layer.dataProvider().addAttributes(
+        [
+            QgsField("id", QVariant.String),
+            QgsField("direction", QVariant.String),
+            QgsField("autot", QVariant.Int),
+            QgsField("period", QVariant.String),
+        ]
+    )
+    data_layer.updateFields()
+    data_feats = []
+    for row in DATA_ROWS:
+        feat = QgsFeature(data_layer.fields())
+        feat.setAttributes(list(row))
+        data_feats.append(feat)
+    data_layer.dataProvider().addFeatures(data_feats)
+    points_layer = QgsVectorLayer("Point", "branches", "memory")
+    points_layer.dataProvider().addAttributes(
+        [
+            QgsField("RPH", QVariant.String),
+            QgsField("Piste", QVariant.String),
+            QgsField("Haara", QVariant.Int),
+        ]
+    )
+    points_layer.updateFields()
+    branch_feats = []
+    for branch in BRANCHES:
+        feat = QgsFeature(points_layer.fields())
+        feat.setAttributes(["A1", branch.piste, int(branch.haara)])
+        feat.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(branch.x, branch.y)))
+        branch_feats.append(feat)
+    points_layer.dataProvider().addFeatures(branch_feats)
+    data_index = group_features_by_field(data_layer, "id")
+    points_index = group_features_by_field(points_layer, "RPH")
+
+    path = str(tmp_path / "data.gpkg")
+    create_database(path)
+    connection = connect(path, path)
+    sql_counts = query_counts(connection, "data", "branches")
+    connection.close()
+
+    modes = ["global_max", "quantile_rank"]
+    normalizations = [
+        Normalization.from_counts(
+            modes, dataset_counts(data_index.items(), points_index)
+        ),
+        Normalization.from_counts(modes, sql_counts),
+    ]
+    intersections = [
+        (
+            data_feats,
+            compute_intersection(
+                [flow_from_feature(feat) for feat in data_feats],
+                [
+                    branch_from_feature(feat)
+                    for feat in points_index.get(intersection, [])
+                ],
+            ),
+        )
+        for intersection, data_feats in data_index.items()
+    ]
+    qgis_values, sql_values = (
+        normalize_intersections(intersections, normalization)
+        for normalization in normalizations
+    )
+    assert qgis_values == sql_values
+    # A1 has the normalized values of its two matched flows, B1 has no curves
+    assert [len(values[1]) for values in qgis_values] == [2, 0]
+    np.testing.assert_allclose([values[1] for values in qgis_values[0][1]], [0.5, 1.0])
+
+
+def test_run_summary_keeps_only_the_first_unmatched_ids():
+    fields = QgsFields()
+    fields.append(QgsField("id", QVariant.String))
+    fields.append(QgsField("direction", QVariant.String))
+    feats = []
+    for i in range(UNMATCHED_LOG_LIMIT + 10):
+        feat = QgsFeature(fields)
+        feat.setAttributes([str(i), "15"])
+        feats.append(feat)
+    summary = RunSummary()
+    summary.add_unmatched(feats[:10])
+    summary.add_unmatched(feats[10:])
+    assert summary.unmatched_count == UNMATCHED_LOG_LIMIT + 10
+    assert summary.unmatched_ids == [(str(i), "15") for i in range(UNMATCHED_LOG_LIMIT)]
+
+
+class ListSink:
+    def __init__(self):
+        self.features = []
+
+    def addFeatures(self, features):  # noqa N802
+        self.features.extend(features)
+        return True
+
+
+def create_intersection_groups():
+    data_fields = QgsFields()
+    for name, field_type in (
+        ("id", QVariant.String),
+        ("direction", QVariant.String),
+        ("autot", QVariant.Int),
+    ):
+        data_fields.append(QgsField(name, field_type))
+    data_groups = defaultdict(list)
+    for data_id, direction, autot, _ in DATA_ROWS:
+        feat = QgsFeature(data_fields)
+        feat.setAttributes([data_id, direction, autot])
+        data_groups[data_id].append(feat)
+    branch_fields = QgsFields()
+    for name in ("RPH", "Piste", "Haara"):
+        branch_fields.append(QgsField(name, QVariant.String))
+    branch_feats = []
+    for branch in BRANCHES:
+        feat = QgsFeature(branch_fields)
+        feat.setAttributes(["A1", branch.piste, branch.haara])
+        feat.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(branch.x, branch.y)))
+        branch_feats.append(feat)
+    return data_fields, data_groups, {"A1": branch_feats}
+
+
+def test_canceled_processing_counts_only_the_processed_intersections():
+    data_fields, data_groups, points_index = create_intersection_groups()
+    feedback = QgsFeedback()
+    feedback.progressChanged.connect(feedback.cancel)
+    summary = process_intersection_groups(
+        data_groups.items(),
+        points_index,
+        create_result_fields(data_fields),
+        FeatureBatchWriter(ListSink()),
+        feedback,
+        intersection_count=len(data_groups),
+    )
+    assert summary.intersection_count == 1
+
+
+def test_streaming_progress_counts_the_data_features_as_read():
+    data_fields, data_groups, points_index = create_intersection_groups()
+    # Only one feature of each group is left, as if they were aggregated
+    group_sizes = deque(len(data_feats) for data_feats in data_groups.values())
+    feedback = QgsFeedback()
+    process_intersection_groups(
+        (
+            (intersection, data_feats[:1])
+            for intersection, data_feats in data_groups.items()
+        ),
+        points_index,
+        create_result_fields(data_fields),
+        FeatureBatchWriter(ListSink()),
+        feedback,
+        feature_count=len(DATA_ROWS),
+        group_sizes=group_sizes,
+    )
+    assert feedback.progress() == 100
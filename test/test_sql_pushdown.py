@@ -0,0 +1,134 @@
+import sqlite3
+import struct
+
+import numpy as np
+
+from risteyslaskenta_package.intersection import (
+    Branch,
+    Flow,
+    compute_intersection,
+    matched_counts,
+)
+from risteyslaskenta_package.normalization import Normalization, normalize_counts
+from risteyslaskenta_package.sql_pushdown import (
+    connect,
+    count_intersections,
+    is_supported,
+    point_from_blob,
+    query_counts,
+    query_intersections,
+)
+
+BRANCHES = [
+    Branch("1", "1", 0.0, 10.0),
+    Branch("1", "2", 10.0, 0.0),
+    Branch("1", "3", 0.0, -10.0),
+    Branch("1", "4", -10.0, 0.0),
+]
+DATA_ROWS = [
+    ("A1", "12", 10, "morning"),
+    ("B1", "12", 7, "morning"),
+    ("A1", "13", 30, "evening"),
+    ("A1", "11", 5, "evening"),
+    ("A1", "15", 5, "evening"),
+]
+
+
+def gpkg_point(x: float, y: float) -> bytes:
+    # Little endian header without an envelope, followed by a WKB point
+    return b"GP\x00\x01" + struct.pack("<i", 3067) + struct.pack("<BIdd", 1, 1, x, y)
+
+
+def create_database(path: str) -> None:
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE gpkg_geometry_columns (table_name TEXT, column_name TEXT)"
+    )
+    connection.execute("INSERT INTO gpkg_geometry_columns VALUES ('branches', 'geom')")
+    connection.execute(
+        "CREATE TABLE branches (fid INTEGER PRIMARY KEY, geom BLOB, "
+        "RPH TEXT, Piste TEXT, Haara INTEGER)"
+    )
+    connection.executemany(
+        "INSERT INTO branches (geom, RPH, Piste, Haara) VALUES (?, 'A1', ?, ?)",
+        [
+            (gpkg_point(branch.x, branch.y), branch.piste, int(branch.haara))
+            for branch in BRANCHES
+        ],
+    )
+    connection.execute(
+        "CREATE TABLE data (fid INTEGER PRIMARY KEY, id TEXT, direction TEXT, "
+        "autot INTEGER, period TEXT)"
+    )
+    connection.executemany(
+        "INSERT INTO data (id, direction, autot, period) VALUES (?, ?, ?, ?)",
+        DATA_ROWS,
+    )
+    connection.commit()
+    connection.close()
+
+
+def test_point_from_blob():
+    assert point_from_blob(gpkg_point(1.5, -2.0)) == (1.5, -2.0)
+    assert point_from_blob(None) is None
+
+
+def test_query_intersections_matches_compute_intersection(tmp_path):
+    path = str(tmp_path / "data.gpkg")
+    create_database(path)
+    connection = connect(path, path)
+    assert count_intersections(connection, "data") == 2
+
+    results = list(query_intersections(connection, "data", "branches", ["period"]))
+    assert [intersection_id for intersection_id, _, _ in results] == ["A1", "B1"]
+
+    _, data_rows, curves = results[0]
+    assert data_rows == [(1, "morning"), (3, "evening"), (4, "evening"), (5, "evening")]
+    flows = [
+        Flow(data_id, direction, autot) for data_id, direction, autot, _ in DATA_ROWS
+    ]
+    expected = compute_intersection([flows[i] for i in (0, 2, 3, 4)], BRANCHES)
+    assert curves.matched_rows == expected.matched_rows
+    assert curves.unmatched_rows == expected.unmatched_rows
+    assert (curves.autot_max, curves.autot_min) == (30, 10)
+    np.testing.assert_allclose(curves.middle_points, expected.middle_points)
+
+    # B1 has no branch locations
+    assert results[1][2] is None
+    connection.close()
+
+
+def test_query_counts_of_matched_rows(tmp_path):
+    path = str(tmp_path / "data.gpkg")
+    create_database(path)
+    connection = connect(path, path)
+    counts = query_counts(connection, "data", "branches")
+    connection.close()
+    # The self-loop, the row without a branch and B1 without branches are left out
+    np.testing.assert_array_equal(counts, [10, 30])
+
+    flows = [
+        Flow(data_id, direction, autot) for data_id, direction, autot, _ in DATA_ROWS
+    ]
+    inputs = [
+        ([flows[i] for i in (0, 2, 3, 4)], BRANCHES),
+        ([flows[1]], []),
+    ]
+    modes = ["global_max", "quantile_rank"]
+    sql_values = normalize_counts(
+        [10, 30], ["1", "1"], normalization=Normalization.from_counts(modes, counts)
+    )
+    values = normalize_counts(
+        [10, 30],
+        ["1", "1"],
+        normalization=Normalization.from_counts(modes, matched_counts(inputs)),
+    )
+    for mode in modes:
+        np.testing.assert_array_equal(sql_values[mode], values[mode])
+
+
+def test_sql_pushdown_needs_window_functions(monkeypatch):
+    monkeypatch.setattr(sqlite3, "sqlite_version_info", (3, 22, 0))
+    assert not is_supported()
+    monkeypatch.setattr(sqlite3, "sqlite_version_info", (3, 25, 0))
+    assert is_supported()
@@ -0,0 +1,39 @@
+from qgis.core import QgsFeature, QgsField, QgsGeometry, QgsVectorLayer, QgsWkbTypes
+from qgis.PyQt.QtCore import QVariant
+
+from risteyslaskenta_package.vector_tiles import densify_to_lines, thinning_thresholds
+
+
+def test_thinning_thresholds():
+    assert thinning_thresholds(10, 16, 14) == [
+        (10, 10, 0.8),
+        (11, 11, 0.6),
+        (12, 12, 0.4),
+        (13, 13, 0.2),
+        (14, 16, 0.0),
+    ]
+    # All flows at all zooms
+    assert thinning_thresholds(12, 16, 12) == [(12, 16, 0.0)]
+    # Thinned at all zooms
+    assert thinning_thresholds(10, 11, 14) == [(10, 10, 0.8), (11, 11, 0.6)]
+
+
+def test_densify_to_lines():
+    layer = QgsVectorLayer("CompoundCurve?crs=EPSG:3067", "result", "memory")
+    layer.dataProvider().addAttributes(
+        [QgsField("intersection_autot_normalized", QVariant.Double)]
+    )
+    layer.updateFields()
+    feat = QgsFeature(layer.fields())
+    feat.setGeometry(
+        QgsGeometry.fromWkt("COMPOUNDCURVE(CIRCULARSTRING(0 0, 10 10, 20 0))")
+    )
+    feat.setAttributes([0.5])
+    layer.dataProvider().addFeatures([feat])
+
+    line_layer = densify_to_lines(layer, 0.5)
+    assert line_layer.wkbType() == QgsWkbTypes.LineString
+    line_feat = next(line_layer.getFeatures())
+    assert line_feat["intersection_autot_normalized"] == 0.5
+    assert line_feat.geometry().constGet().numPoints() > 3
+    assert densify_to_lines(line_layer, 0.5) is line_layer